@@ -1,103 +1,411 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 import sys
-from scanner.util.logger import configure_logger
-from scanner.util.aws_functions import get_aws_session, get_all_regions
-from scanner.util.ebs_volumes import get_all_volumes, get_unused_volume_savings, create_ebs_dataframe, get_gp2_to_gp3_savings
-from scanner.util.os_functions import save_report_to_csv, open_file, clear_log_file
-from scanner.util.ebs_snapshots import get_aws_snapshot_cost, create_snapshot_dataframe
-import time
+from scanner.util.logger import configure_logger, get_logger, log_context, DEFAULT_LOG_LEVEL, LOG_LEVELS, LOG_FORMATS
+from scanner.util.aws_functions import get_aws_session, get_all_regions, set_page_size, configure_client_pool, DEFAULT_REGION_DISCOVERY, REGION_CACHE_TTL
+from scanner.util.os_functions import open_file, clear_log_file
+from scanner.util.report import create_report_sinks, write_region_reports, close_report_sinks, DEFAULT_REPORT_FORMAT, REPORT_FORMATS
+from scanner.util.scan_engine import scan_regions, ANALYZERS, DEFAULT_MAX_WORKERS
+from scanner.util.pricing_cache import configure_pricing_cache, PRICING_CACHE_TTL
+from scanner.util.offer_index import set_offline_pricing
+from scanner.util.metrics import get_metrics, timed, start_profiling, profile_call, save_profile
+from scanner.util.service import ScannerService, serve, SCAN_INTERVAL, SERVICE_PORT
+from scanner.util.ebs_volumes import set_min_stopped_days, STOPPED_INSTANCE_SETTINGS
+from scanner.util.changed_blocks import configure_changed_blocks, CHANGED_BLOCKS_SETTINGS
 
 
 
-# Configure the logger to send logs to the logger.py file
-logger = configure_logger("app.log")
+# The logger is configured in main once the log options are parsed
+logger = get_logger()
 
+LOG_FILE_PATH = "logs/app.log"
 
-def main():
+# Exit codes of a run
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_PARTIAL = 3
+
+
+def parse_args(argv=None):
+    """
+    Parse the command-line arguments
+
+    Args:
+        argv (list): Arguments to parse, defaults to sys.argv
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="AWS EBS Volumes Analysis Tool")
+    parser.add_argument("profile", nargs="?", help="AWS profile name")
+    parser.add_argument("region", nargs="?", help="Only scan this region")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="Number of concurrent region analysis tasks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        help="Number of records requested per describe_volumes/describe_snapshots page",
+    )
+    parser.add_argument(
+        "--max-pool-connections",
+        type=int,
+        help="HTTP connections kept open per AWS client (default: the number of workers)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=5,
+        help="Maximum attempts per AWS API call, including retries (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retry-mode",
+        choices=["legacy", "standard", "adaptive"],
+        default="standard",
+        help="botocore retry mode (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--region-discovery",
+        choices=["auto", "opt-in", "probe"],
+        default=DEFAULT_REGION_DISCOVERY,
+        help="How accessible regions are discovered (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--region-cache-ttl",
+        type=int,
+        default=REGION_CACHE_TTL,
+        help="Seconds the discovered region list is cached for, 0 to disable (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pricing-cache-ttl",
+        type=int,
+        default=PRICING_CACHE_TTL,
+        help="Seconds cached prices are used before they are fetched again (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--refresh-pricing",
+        action="store_true",
+        help="Ignore the pricing cache and fetch every price again",
+    )
+    parser.add_argument(
+        "--offer-file",
+        help="Price from a local AWS bulk offer file for AmazonEC2 (JSON or CSV) instead of the Pricing API",
+    )
+    parser.add_argument(
+        "--offer-index",
+        help="Price from an EBS price index built from a bulk offer file instead of the Pricing API",
+    )
+    parser.add_argument(
+        "--stopped-days",
+        type=int,
+        default=STOPPED_INSTANCE_SETTINGS["min_stopped_days"],
+        help="Report volumes attached to instances stopped for at least this many days (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--changed-blocks",
+        action="store_true",
+        help="Measure the storage each snapshot adds with the EBS direct API instead of estimating it from the volume size",
+    )
+    parser.add_argument(
+        "--changed-blocks-workers",
+        type=int,
+        default=CHANGED_BLOCKS_SETTINGS["max_workers"],
+        help="Snapshot pairs measured concurrently in each region with --changed-blocks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--changed-blocks-max-pairs",
+        type=int,
+        default=CHANGED_BLOCKS_SETTINGS["max_pairs_per_volume"],
+        help="Snapshot pairs measured per volume with --changed-blocks, the others are extrapolated (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--changed-blocks-region-pairs",
+        type=int,
+        default=CHANGED_BLOCKS_SETTINGS["max_pairs_per_region"],
+        help="Snapshot pairs measured per region with --changed-blocks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--changed-blocks-max-pages",
+        type=int,
+        default=CHANGED_BLOCKS_SETTINGS["max_pages_per_pair"],
+        help="ListChangedBlocks pages listed per pair before the rest of the volume is extrapolated (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str.upper,
+        choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help="Lowest level written to the log (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default="text",
+        help="Write the log file as plain text or as JSON lines with region and phase fields (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Run non-interactively: do not open the reports and append to the log instead of clearing it",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="reports",
+        help="Folder the reports are written to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--format",
+        dest="report_format",
+        choices=list(REPORT_FORMATS),
+        default=DEFAULT_REPORT_FORMAT,
+        help="Report file format, parquet and arrow need pyarrow (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Print the phase timings and API call statistics and save them next to the reports (default: on)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="PATH",
+        help="Profile the run, including the worker threads, and save the stats to PATH for python -m pstats",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Keep running, rescan on a schedule and serve the latest results over HTTP on localhost",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=SERVICE_PORT,
+        help="Port of the HTTP endpoint in --serve mode (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=SCAN_INTERVAL,
+        help="Seconds between scans in --serve mode (default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """
     Main function
+
+    Args:
+        argv (list): Arguments to parse, defaults to sys.argv
+
+    Returns:
+        int: EXIT_OK, EXIT_ERROR, EXIT_USAGE, or EXIT_PARTIAL when some regions could not be analysed
     """
+    args = parse_args(argv)
+    if not args.batch:
+        # Clear the log file at the beginning of an interactive run
+        clear_log_file(LOG_FILE_PATH)
+    configure_logger("app.log", level=args.log_level, log_format=args.log_format)
 
     # Check if the AWS profile is provided
-    if len(sys.argv) < 2:
+    if not args.profile:
         logger.error(
             "Error occurred: Please provide the AWS profile as the first command-line argument. Example: python3 app.py my_aws_profile"
         )
-        return
-    
-    region = None
-    profile = sys.argv[1]
-    session = None
-    if len(sys.argv) == 3:
-        region = sys.argv[2]
+        return EXIT_USAGE
+
+    command = run_service if args.serve else run
+    if not args.cprofile:
+        exit_code = command(args)
+    else:
+        start_profiling()
+        try:
+            exit_code = profile_call(command, args)
+        finally:
+            save_profile(args.cprofile)
+
+    # The service serves the metrics of every scan itself
+    if args.metrics and not args.serve:
+        report_metrics(args.profile, args.output_dir)
+    return exit_code
+
+
+def report_metrics(profile, output_dir):
+    """
+    Print the metrics of the run and save them as JSON in the report folder
+
+    Args:
+        profile (str): AWS profile name
+        output_dir (str): Folder the reports are written to
+
+    Returns:
+        None
+    """
+    metrics = get_metrics()
+    print(metrics.format_summary())
+    try:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        metrics.write_json(os.path.join(output_dir, "{}-metrics.json".format(profile)))
+    except Exception as e:
+        logger.error("Error occurred while saving the metrics: %s", e)
+
+
+def configure(args):
+    """
+    Apply the client, pricing and session options shared by every mode
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+
+    Returns:
+        int: EXIT_ERROR if the options could not be applied, otherwise None
+    """
+    profile = args.profile
+    if args.page_size:
+        set_page_size(args.page_size)
+    configure_client_pool(
+        max_pool_connections=args.max_pool_connections or max(args.workers, 10),
+        max_attempts=args.max_attempts,
+        retry_mode=args.retry_mode,
+    )
+    configure_pricing_cache(ttl=args.pricing_cache_ttl, refresh=args.refresh_pricing)
+    set_min_stopped_days(args.stopped_days)
+    configure_changed_blocks(
+        enabled=args.changed_blocks,
+        max_workers=args.changed_blocks_workers,
+        max_pairs_per_volume=args.changed_blocks_max_pairs,
+        max_pairs_per_region=args.changed_blocks_region_pairs,
+        max_pages_per_pair=args.changed_blocks_max_pages,
+    )
+    if args.offer_file or args.offer_index:
+        try:
+            set_offline_pricing(offer_path=args.offer_file, index_path=args.offer_index)
+        except Exception as e:
+            logger.error("Error occurred while loading the offline price list: %s", e, exc_info=True)
+            return EXIT_ERROR
+    from botocore.exceptions import ProfileNotFound
+
     try:
-        session = get_aws_session(profile)
+        get_aws_session(profile)
         logger.info("Credentials loaded successfully")
 
+    except ProfileNotFound:
+        logger.error(
+            "Error occurred: AWS profile '%s' not found. Please check your credentials file (~/.aws/credentials).", profile
+        )
+        return EXIT_ERROR
     except Exception as e:
-        if e == "ProfileNotFound":
-            logger.error(f"Error Occurred: {str(e)}", exc_info=True)
-        else:
-            logger.error(
-                f"Error occurred: AWS profile '{profile}' not found. Please check your credentials file (~/.aws/credentials)."
-            )
-        return
+        logger.error("Error Occurred: %s", e, exc_info=True)
+        return EXIT_ERROR
+    return None
+
 
+def run_service(args):
+    """
+    Run the scanner as a service until interrupted
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+
+    Returns:
+        int: EXIT_OK once stopped, or EXIT_ERROR
+    """
+    exit_code = configure(args)
+    if exit_code is not None:
+        return exit_code
+    service = ScannerService(
+        args.profile,
+        regions=[args.region] if args.region else None,
+        interval=args.interval,
+        max_workers=args.workers,
+        discovery=args.region_discovery,
+        region_cache_ttl=args.region_cache_ttl,
+    )
     try:
-        # Get all available regions for the given profile
-        if not region:
-            regions = get_all_regions(profile)
-        else:
-            regions = [region]
+        serve(service, port=args.port)
+    except OSError as e:
+        logger.error("Error occurred while starting the HTTP endpoint: %s", e)
+        return EXIT_ERROR
+    return EXIT_OK
 
-        # Create the array of EbsVolumes objects and get potential savings
-        region_potential_savings = get_unused_volume_savings(profile, regions)
 
-        # Get the estimated gp2 to gp3 savings
-        gp2_to_gp3_savings = {}
-        snapshot_savings = {}
-        for region in regions:
-            ebs_volumes = get_all_volumes(profile, region)
-            gp2_to_gp3_savings[region] = get_gp2_to_gp3_savings(ebs_volumes, region)
-            snapshot_savings[region] = get_aws_snapshot_cost(profile, region)
+def run(args):
+    """
+    Scan the regions and write the reports
 
+    Args:
+        args (argparse.Namespace): Parsed arguments
 
-        snapshot_dataframe = create_snapshot_dataframe(snapshot_savings)
+    Returns:
+        int: EXIT_OK, EXIT_ERROR, or EXIT_PARTIAL when some regions could not be analysed
+    """
+    region = args.region
+    profile = args.profile
+    try:
+        # Each region is appended to the reports as soon as its analysis is done
+        sinks = create_report_sinks(profile, args.output_dir, args.report_format)
+    except Exception as e:
+        logger.error("Error occurred while creating the reports: %s", e)
+        return EXIT_ERROR
+    exit_code = configure(args)
+    if exit_code is not None:
+        close_report_sinks(sinks)
+        return exit_code
 
-        ebs_dataframe = {
-            "unused" : region_potential_savings, 
-            "gp2" : gp2_to_gp3_savings
-            }
+    try:
+        # Get all available regions for the given profile
+        if not region:
+            with log_context(phase="discovery"), timed("discovery"):
+                regions = get_all_regions(
+                    profile,
+                    discovery=args.region_discovery,
+                    cache_ttl=args.region_cache_ttl,
+                    max_workers=args.workers,
+                )
+        else:
+            regions = [region]
 
+        def write_region(region, region_results):
+            with log_context(region=region, phase="report"), timed("report", region):
+                write_region_reports(sinks, region, region_results)
 
-        # Create DataFrame from the results and save the report
-        ebs_volumes_dataframe = create_ebs_dataframe(
-            ebs_dataframe)
-        time.sleep(5)
+        try:
+            # Run the unused volume, gp2 to gp3 and snapshot analysis for every region concurrently
+            results = scan_regions(profile, regions, max_workers=args.workers, on_region=write_region)
+        finally:
+            # Write the total rows, keeping the regions already written if the scan failed
+            with log_context(phase="report"), timed("report"):
+                report_paths = close_report_sinks(sinks)
 
-        # Save the CSV report
-        if ebs_volumes_dataframe is not None:
-            save_report_to_csv(ebs_volumes_dataframe, profile+"-ebs_volumes_report.csv")
-            open_file("reports/"+profile+"-ebs_volumes_report.csv")
-        if snapshot_dataframe is not None:
-            save_report_to_csv(snapshot_dataframe, profile+"-snapshots_report.csv")
-            open_file("reports/"+profile+"-snapshots_report.csv")
-        if ebs_volumes_dataframe is None and snapshot_dataframe is None:
+        if not report_paths:
             logger.warning("No data to save.")
+        if not args.batch:
+            for report_path in report_paths:
+                open_file(report_path)
 
         logger.warning("These are estimates and not actual cost savings that will occur if resources are cleaned up.")
 
 
     except Exception as e:
         # Include traceback information
-        logger.error(f"Error occurred: {str(e)}", exc_info=True)
+        logger.error("Error occurred: %s", e, exc_info=True)
+        return EXIT_ERROR
 
+    failed = results["failed"]
+    if not failed:
+        return EXIT_OK
+    logger.error("Analysis failed for %s of %s regions: %s", len(failed), len(regions), ", ".join(sorted(failed)))
+    if sum(len(names) for names in failed.values()) == len(regions) * len(ANALYZERS):
+        return EXIT_ERROR
+    return EXIT_PARTIAL
 
-if __name__ == "__main__":
-    # Define the path to the log file
-    log_file_path = "logs/app.log"
 
-    # Clear the log file at the beginning of the script
-    clear_log_file(log_file_path)
-    main()
+if __name__ == "__main__":
+    sys.exit(main())
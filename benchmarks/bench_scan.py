@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+'''
+Benchmark the scan pipeline against a synthetic account
+
+API calls never leave the process: the boto3 session handed to the scanner
+answers describe_volumes, describe_snapshots, describe_images, describe_instances,
+get_products and list_changed_blocks from a generated account through botocore event handlers (before-parameter-build
+keeps the call parameters, before-call returns the response). Responses are
+generated page by page, so the fake account itself takes no memory, but the
+time spent generating pages is included in the wall times.
+
+Every account shape runs in its own interpreter so caches and peak memory do
+not leak between shapes. For each stage the wall time, the number of API
+calls and the peak traced memory are reported.
+
+Usage:
+    python3 benchmarks/bench_scan.py [--shape tiny small medium] [--output results.json]
+    python3 benchmarks/bench_scan.py --shape large --no-memory --compare results.json
+    python3 benchmarks/bench_scan.py --shape small --changed-blocks
+'''
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROFILE = "bench"
+
+# Account shapes: (volumes, snapshots, regions), spread evenly over the regions
+SHAPES = {
+    "tiny": (100, 300, 1),
+    "small": (2000, 20000, 4),
+    "medium": (20000, 200000, 8),
+    "large": (200000, 2000000, 16),
+}
+DEFAULT_SHAPES = ["tiny", "small", "medium"]
+
+REGIONS = [
+    "us-east-1", "us-east-2", "us-west-1", "us-west-2", "eu-west-1", "eu-west-2",
+    "eu-west-3", "eu-central-1", "eu-north-1", "ap-south-1", "ap-northeast-1",
+    "ap-northeast-2", "ap-southeast-1", "ap-southeast-2", "sa-east-1", "ca-central-1",
+]
+REGION_CODES = {
+    "us-east-1": "USE1", "us-east-2": "USE2", "us-west-1": "USW1", "us-west-2": "USW2",
+    "eu-west-1": "EU", "eu-west-2": "EUW2", "eu-west-3": "EUW3", "eu-central-1": "EUC1",
+    "eu-north-1": "EUN1", "ap-south-1": "APS3", "ap-northeast-1": "APN1",
+    "ap-northeast-2": "APN2", "ap-southeast-1": "APS1", "ap-southeast-2": "APS2",
+    "sa-east-1": "SAE1", "ca-central-1": "CAN1",
+}
+
+# Volume type mix and price per GB-month of the synthetic account
+VOLUME_TYPES = ["gp3", "gp2", "gp3", "io2", "gp2", "st1", "sc1", "standard"]
+VOLUME_PRICES = {
+    "gp2": 0.1, "gp3": 0.08, "io1": 0.125, "io2": 0.125, "st1": 0.045, "sc1": 0.015, "standard": 0.05,
+}
+SNAPSHOT_PRICE = 0.05
+
+# Every IMAGE_SNAPSHOT_STEP-th snapshot backs an AMI
+IMAGE_SNAPSHOT_STEP = 20
+
+# Every STOPPED_INSTANCE_STEP-th instance is stopped
+STOPPED_INSTANCE_STEP = 4
+
+# EBS direct API block size, a GiB holds 2048 blocks
+BLOCK_SIZE = 512 * 1024
+BLOCKS_PER_GIB = 1024 ** 3 // BLOCK_SIZE
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+class SyntheticAccount:
+    '''
+    Deterministic account whose resources are generated from their index
+
+    Args:
+        volumes (int): Number of volumes
+        snapshots (int): Number of snapshots
+        regions (int): Number of regions the resources are spread over
+    '''
+    def __init__(self, volumes, snapshots, regions):
+        self.regions = REGIONS[:regions]
+        self.region_index = {region: index for index, region in enumerate(self.regions)}
+        self.volumes_per_region = max(volumes // regions, 1)
+        self.snapshots_per_region = snapshots // regions
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.products = self.build_products()
+
+    def volume(self, region, index):
+        volume_id = "vol-{:04x}{:013x}".format(self.region_index[region], index)
+        attached = index % 5 != 0
+        return {
+            "VolumeId": volume_id,
+            "Size": 8 + (index * 37) % 500,
+            "VolumeType": VOLUME_TYPES[index % len(VOLUME_TYPES)],
+            "State": "in-use" if attached else "available",
+            "AvailabilityZone": region + "a",
+            "CreateTime": NOW - datetime.timedelta(days=index % 900),
+            "Encrypted": False,
+            "Attachments": [{
+                "VolumeId": volume_id,
+                "InstanceId": "i-{:017x}".format(index // 2),
+                "State": "attached",
+            }] if attached else [],
+        }
+
+    def snapshot(self, region, index):
+        volume_index = index % self.volumes_per_region
+        generation = index // self.volumes_per_region
+        volume = self.volume(region, volume_index)
+        # Every seventh volume has been deleted since its snapshots were taken
+        volume_id = volume["VolumeId"]
+        if volume_index % 7 == 3:
+            volume_id = "vol-{:04x}{:013x}".format(self.region_index[region], self.volumes_per_region + volume_index)
+        return {
+            "SnapshotId": self.snapshot_id(region, index),
+            "VolumeId": volume_id,
+            "VolumeSize": volume["Size"] + generation % 3,
+            "StartTime": NOW - datetime.timedelta(days=10 + generation * 45 + index % 30),
+            "State": "completed",
+            "Description": "Backup {} of {}".format(generation, volume["VolumeId"]),
+            "OwnerId": "123456789012",
+            "Encrypted": False,
+        }
+
+    def snapshot_id(self, region, index):
+        return "snap-{:04x}{:013x}".format(self.region_index[region], index)
+
+    def build_products(self):
+        products = []
+        for region in self.regions:
+            code = REGION_CODES[region]
+            for volume_type, price in VOLUME_PRICES.items():
+                products.append(self.product(
+                    region, "Storage", code + "-EBS:VolumeUsage." + volume_type, price, volume_type))
+                # Provisioned IOPS and throughput products share the volume type but not the family
+                products.append(self.product(
+                    region, "System Operation", code + "-EBS:VolumeP-IOPS." + volume_type, 0.005, volume_type))
+            products.append(self.product(region, "Storage Snapshot", code + "-EBS:SnapshotUsage", SNAPSHOT_PRICE))
+        return products
+
+    @staticmethod
+    def product(region, family, usage_type, price, volume_type=None):
+        attributes = {
+            "regionCode": region,
+            "usagetype": usage_type,
+            "location": region,
+            "locationType": "AWS Region",
+        }
+        if volume_type:
+            attributes["volumeApiName"] = volume_type
+        return {
+            "product": {"productFamily": family, "attributes": attributes},
+            "terms": {"OnDemand": {"TERM.CODE": {"priceDimensions": {"TERM.CODE.DIM": {
+                "unit": "GB-Mo", "pricePerUnit": {"USD": str(price)},
+            }}}}},
+        }
+
+    @staticmethod
+    def volume_filter_values(volume, name):
+        if name == "attachment.instance-id":
+            return [attachment["InstanceId"] for attachment in volume["Attachments"]]
+        return [volume[{"status": "State", "volume-type": "VolumeType", "volume-id": "VolumeId"}[name]]]
+
+    def describe_volumes(self, region, params):
+        matchers = [(volume_filter["Name"], set(volume_filter["Values"])) for volume_filter in params.get("Filters", [])]
+        start = int(params.get("NextToken") or 0)
+        limit = params.get("MaxResults") or 500
+        page = []
+        index = start
+        while index < self.volumes_per_region and len(page) < limit:
+            volume = self.volume(region, index)
+            index += 1
+            if all(values.intersection(self.volume_filter_values(volume, name)) for name, values in matchers):
+                page.append(volume)
+        response = {"Volumes": page}
+        if index < self.volumes_per_region:
+            response["NextToken"] = str(index)
+        return response
+
+    def describe_snapshots(self, region, params):
+        start = int(params.get("NextToken") or 0)
+        end = min(start + (params.get("MaxResults") or 1000), self.snapshots_per_region)
+        response = {"Snapshots": [self.snapshot(region, index) for index in range(start, end)]}
+        if end < self.snapshots_per_region:
+            response["NextToken"] = str(end)
+        return response
+
+    def instance(self, index):
+        if index % STOPPED_INSTANCE_STEP != 1:
+            return {"InstanceId": "i-{:017x}".format(index), "State": {"Name": "running"}, "StateTransitionReason": ""}
+        stopped_at = NOW - datetime.timedelta(days=index % 200)
+        return {
+            "InstanceId": "i-{:017x}".format(index),
+            "State": {"Name": "stopped"},
+            "StateTransitionReason": "User initiated ({} GMT)".format(stopped_at.strftime("%Y-%m-%d %H:%M:%S")),
+        }
+
+    def describe_instances(self, region, params):
+        # Two attached volumes per instance, see volume()
+        states = set()
+        for instance_filter in params.get("Filters", []):
+            if instance_filter["Name"] == "instance-state-name":
+                states.update(instance_filter["Values"])
+        count = (self.volumes_per_region + 1) // 2
+        start = int(params.get("NextToken") or 0)
+        end = min(start + (params.get("MaxResults") or 1000), count)
+        instances = [self.instance(index) for index in range(start, end)]
+        if states:
+            instances = [instance for instance in instances if instance["State"]["Name"] in states]
+        response = {"Reservations": [{"ReservationId": "r-{:017x}".format(start), "Instances": instances}]}
+        if end < count:
+            response["NextToken"] = str(end)
+        return response
+
+    def describe_images(self, region, params):
+        # One AMI for every twentieth snapshot
+        images = range(0, self.snapshots_per_region, IMAGE_SNAPSHOT_STEP)
+        start = int(params.get("NextToken") or 0)
+        end = min(start + (params.get("MaxResults") or 1000), len(images))
+        response = {"Images": [{
+            "ImageId": "ami-{:04x}{:013x}".format(self.region_index[region], images[index]),
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": self.snapshot_id(region, images[index])}}],
+        } for index in range(start, end)]}
+        if end < len(images):
+            response["NextToken"] = str(end)
+        return response
+
+    def list_changed_blocks(self, region, params):
+        # Between 1% and 9% of the volume changed, spread evenly over its blocks
+        index = int(params["SecondSnapshotId"][-13:], 16)
+        volume_size = self.snapshot(region, index)["VolumeSize"]
+        step = 100 // (1 + index % 9)
+        block_count = volume_size * BLOCKS_PER_GIB
+        start = int(params.get("NextToken") or 0)
+        end = min(start + (params.get("MaxResults") or 10000) * step, block_count)
+        response = {
+            "ChangedBlocks": [{"BlockIndex": block} for block in range(start, end, step)],
+            "BlockSize": BLOCK_SIZE,
+            "VolumeSize": volume_size,
+            "ExpiryTime": NOW + datetime.timedelta(minutes=10),
+        }
+        if end < block_count:
+            response["NextToken"] = str(end)
+        return response
+
+    def get_products(self, params):
+        products = self.products
+        for product_filter in params.get("Filters", []):
+            field, value = product_filter["Field"], product_filter["Value"]
+            products = [
+                product for product in products
+                if (product["product"]["productFamily"] if field == "productFamily"
+                    else product["product"]["attributes"].get(field)) == value
+            ]
+        start = int(params.get("NextToken") or 0)
+        end = start + (params.get("MaxResults") or 100)
+        response = {"PriceList": [json.dumps(product) for product in products[start:end]]}
+        if end < len(products):
+            response["NextToken"] = str(end)
+        return response
+
+    def handle(self, operation, region, params):
+        with self.calls_lock:
+            self.calls[operation] += 1
+        if operation == "DescribeVolumes":
+            return self.describe_volumes(region, params)
+        if operation == "DescribeSnapshots":
+            return self.describe_snapshots(region, params)
+        if operation == "DescribeImages":
+            return self.describe_images(region, params)
+        if operation == "DescribeInstances":
+            return self.describe_instances(region, params)
+        if operation == "GetProducts":
+            return self.get_products(params)
+        if operation == "ListChangedBlocks":
+            return self.list_changed_blocks(region, params)
+        raise NotImplementedError("The synthetic account does not serve {}".format(operation))
+
+
+def create_session(account):
+    '''
+    Create a boto3 session whose API calls are answered by the synthetic account
+
+    Args:
+        account (SyntheticAccount): Account serving the calls
+
+    Returns:
+        boto3.session.Session: AWS session
+    '''
+    import boto3
+    from botocore.awsrequest import AWSResponse
+
+    class EmptyBody:
+        def stream(self, **kwargs):
+            return iter([b""])
+
+    def keep_params(params, context, **kwargs):
+        # before-call only sees the serialized request, so keep the parameters here
+        context["bench_params"] = dict(params)
+
+    def serve(model, context, **kwargs):
+        parsed = account.handle(model.name, context.get("client_region"), context["bench_params"])
+        parsed["ResponseMetadata"] = {"HTTPStatusCode": 200, "HTTPHeaders": {}, "RetryAttempts": 0}
+        return AWSResponse("https://bench.invalid", 200, {}, EmptyBody()), parsed
+
+    session = boto3.session.Session(
+        aws_access_key_id="bench",
+        aws_secret_access_key="bench",
+        region_name="us-east-1",
+    )
+    session.events.register("before-parameter-build", keep_params)
+    session.events.register("before-call", serve)
+    return session
+
+
+class Stage:
+    '''
+    Measure the wall time, API calls and peak traced memory of a block
+
+    Args:
+        account (SyntheticAccount): Account counting the API calls
+        trace_memory (bool): Trace the peak memory of the block
+    '''
+    def __init__(self, account, trace_memory):
+        self.account = account
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        self.calls = sum(self.account.calls.values())
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.api_calls = sum(self.account.calls.values()) - self.calls
+        self.peak_mb = None
+        if self.trace_memory:
+            self.peak_mb = (tracemalloc.get_traced_memory()[1] - self.memory) / (1024 * 1024)
+
+    def result(self):
+        return {"seconds": self.seconds, "api_calls": self.api_calls, "peak_mb": self.peak_mb}
+
+
+def run_shape(shape, workers, trace_memory, changed_blocks=False):
+    '''
+    Run every benchmark stage for one account shape in this interpreter
+
+    Args:
+        shape (str): Account shape name
+        workers (int): Number of workers of the full scan
+        trace_memory (bool): Trace the peak memory of every stage
+        changed_blocks (bool): Also cost the snapshots with the sampled changed block listing
+
+    Returns:
+        dict: Dictionary of stage name to its measurements
+    '''
+    workdir = tempfile.mkdtemp(prefix="bench_scan_")
+    os.environ["SCANNER_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from scanner.util.logger import configure_logger
+    from scanner.util.aws_functions import set_aws_session
+    from scanner.util.ebs_pricing import get_ebs_price_matrix
+    from scanner.util.ebs_volumes import (
+        get_all_volumes,
+        get_unused_volume_savings,
+        get_gp2_to_gp3_savings,
+        get_region_stopped_instance_volume_savings,
+        create_ebs_dataframe,
+    )
+    from scanner.util.ebs_snapshots import get_aws_snapshot_cost, create_snapshot_dataframe
+    from scanner.util.changed_blocks import configure_changed_blocks
+    from scanner.util.inventory import clear_inventories
+    from scanner.util.os_functions import save_report_to_csv
+    from scanner.util.report import create_report_sinks, write_region_reports, close_report_sinks
+    from scanner.util.scan_engine import scan_regions
+
+    # Import the libraries the scanner loads lazily, so the stages measure work rather than imports
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+
+    configure_logger("bench.log", level="ERROR")
+    account = SyntheticAccount(*SHAPES[shape])
+    set_aws_session(PROFILE, create_session(account))
+    regions = account.regions
+    if trace_memory:
+        tracemalloc.start()
+
+    stages = {}
+    with Stage(account, trace_memory) as stage:
+        get_ebs_price_matrix(PROFILE)
+    stages["pricing"] = stage.result()
+
+    clear_inventories()
+    with Stage(account, trace_memory) as stage:
+        unused = get_unused_volume_savings(PROFILE, regions)
+    stages["get_unused_volume_savings"] = stage.result()
+
+    clear_inventories()
+    with Stage(account, trace_memory) as stage:
+        gp2 = {region: get_gp2_to_gp3_savings(get_all_volumes(PROFILE, region), region) for region in regions}
+    stages["get_gp2_to_gp3_savings"] = stage.result()
+
+    clear_inventories()
+    with Stage(account, trace_memory) as stage:
+        stopped = {region: get_region_stopped_instance_volume_savings(PROFILE, region) for region in regions}
+    stages["get_region_stopped_instance_volume_savings"] = stage.result()
+
+    clear_inventories()
+    with Stage(account, trace_memory) as stage:
+        snapshots = {region: get_aws_snapshot_cost(PROFILE, region) for region in regions}
+    stages["get_aws_snapshot_cost"] = stage.result()
+
+    if changed_blocks:
+        clear_inventories()
+        configure_changed_blocks(enabled=True)
+        with Stage(account, trace_memory) as stage:
+            for region in regions:
+                get_aws_snapshot_cost(PROFILE, region)
+        configure_changed_blocks(enabled=False)
+        stages["get_aws_snapshot_cost changed blocks"] = stage.result()
+
+    with Stage(account, trace_memory) as stage:
+        save_report_to_csv(create_ebs_dataframe({"unused": unused, "gp2": gp2, "stopped": stopped}), "ebs_volumes_report.csv")
+        save_report_to_csv(create_snapshot_dataframe(snapshots), "snapshots_report.csv")
+    stages["report"] = stage.result()
+    del unused, gp2, stopped, snapshots
+
+    clear_inventories()
+    with Stage(account, trace_memory) as stage:
+        sinks = create_report_sinks(PROFILE, "streamed")
+        scan_regions(
+            PROFILE, regions, max_workers=workers,
+            on_region=lambda region, results: write_region_reports(sinks, region, results),
+        )
+        close_report_sinks(sinks)
+    stages["scan_regions"] = stage.result()
+
+    return stages
+
+
+def print_results(results, baseline=None):
+    '''
+    Print the measurements as a table, with the wall time change against a baseline
+
+    Args:
+        results (dict): Dictionary of shape to stage measurements
+        baseline (dict): Earlier results to compare with
+
+    Returns:
+        None
+    '''
+    print("{:<8} {:<42} {:>10} {:>10} {:>10} {:>9}".format("shape", "stage", "seconds", "api calls", "peak MB", "change"))
+    for shape, stages in results.items():
+        for name, stage in stages.items():
+            peak = "{:.1f}".format(stage["peak_mb"]) if stage["peak_mb"] is not None else "-"
+            change = ""
+            previous = (baseline or {}).get(shape, {}).get(name)
+            if previous and previous["seconds"]:
+                change = "{:+.0%}".format(stage["seconds"] / previous["seconds"] - 1)
+            print("{:<8} {:<42} {:>10.3f} {:>10} {:>10} {:>9}".format(
+                shape, name, stage["seconds"], stage["api_calls"], peak, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan pipeline benchmark against a synthetic account")
+    parser.add_argument("--shape", nargs="+", choices=list(SHAPES), default=DEFAULT_SHAPES,
+                        help="Account shapes to run (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=8, help="Workers of the full scan (default: %(default)s)")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory, it slows the stages down")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare the wall times with")
+    parser.add_argument("--changed-blocks", action="store_true",
+                        help="Add a snapshot cost stage that lists changed blocks with the EBS direct API")
+    parser.add_argument("--run-shape", choices=list(SHAPES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_shape:
+        # Child interpreter: run one shape and hand the measurements back on stdout
+        print(json.dumps(run_shape(args.run_shape, args.workers, not args.no_memory, args.changed_blocks)))
+        return
+
+    results = {}
+    for shape in args.shape:
+        volumes, snapshots, regions = SHAPES[shape]
+        print("Running {}: {} volumes, {} snapshots, {} regions...".format(shape, volumes, snapshots, regions),
+              file=sys.stderr)
+        command = [sys.executable, os.path.abspath(__file__), "--run-shape", shape, "--workers", str(args.workers)]
+        if args.no_memory:
+            command.append("--no-memory")
+        if args.changed_blocks:
+            command.append("--changed-blocks")
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[shape] = json.loads(output.strip().splitlines()[-1])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
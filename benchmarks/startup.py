@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+Measure how long the scanner takes to start
+
+Every command is run in a fresh interpreter several times and the median and
+fastest wall times are reported. The "eager imports" row loads pandas, numpy
+and boto3 up front, which is what every run paid before they were imported
+lazily, so the difference to the other rows is the startup time saved.
+
+Usage:
+    python3 benchmarks/startup.py [--runs 20]
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "app.py --help": [os.path.join(ROOT, "app.py"), "--help"],
+    "app.py (no profile)": [os.path.join(ROOT, "app.py")],
+    "import scanner modules": [
+        "-c",
+        "import scanner.util.scan_engine, scanner.util.os_functions, scanner.util.offer_index",
+    ],
+    "eager imports": ["-c", "import pandas, numpy, boto3, botocore.config"],
+}
+
+
+def time_command(args, runs, workdir):
+    '''
+    Run a python command in fresh interpreters and time it
+
+    Args:
+        args (list): Arguments passed to the python interpreter
+        runs (int): Number of runs
+        workdir (str): Directory the command runs in, so logs are not written to the repository
+
+    Returns:
+        list: Wall time of every run in seconds
+    '''
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + args,
+            cwd=workdir,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scanner startup time benchmark")
+    parser.add_argument("--runs", type=int, default=20, help="Runs per command (default: %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Warm the filesystem cache and the bytecode cache before measuring
+        for command in COMMANDS.values():
+            time_command(command, 1, workdir)
+
+        print("{:<26} {:>10} {:>10}".format("command", "median ms", "min ms"))
+        for name, command in COMMANDS.items():
+            timings = time_command(command, args.runs, workdir)
+            print("{:<26} {:>10.1f} {:>10.1f}".format(name, statistics.median(timings) * 1000, min(timings) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import json
-from scanner.util.aws_functions import get_price, get_ebs_snapshots
+from scanner.util.aws_functions import get_price
+from scanner.util.inventory import get_inventory
+from scanner.util.pricing_cache import get_pricing_cache
+from scanner.util.offer_index import get_offline_index, SNAPSHOT_USAGE_TYPE
 import scanner.util.logger as log
-import os
 
 logger = log.get_logger()
 
@@ -31,86 +33,64 @@ class EBSSnapshots:
             float: Price per GB of EBS snapshots
         '''
         logger.info("Getting EBS snapshot cost...")
-        region_code_map = {
-            'eu-central-1': 'EUC1',
-            'eu-west-1': 'EU',
-            'eu-west-2': 'EUW2',
-            'eu-west-3': 'EUW3',
-            'us-east-1': 'USE1',
-            'us-east-2': 'USE2',
-            'us-west-1': 'USW1',
-            'us-west-2': 'USW2',
-            'ap-south-1': 'APS3',
-            'ap-northeast-1': 'APN1',
-            'ap-northeast-2': 'APN2',
-            'ap-southeast-1': 'APS1',
-            'ap-southeast-2': 'APS2',
-            'ap-east-1': 'APE1',
-            'sa-east-1': 'SAE1',
-            'ca-central-1': 'CAN1',
-            'cn-north-1': 'CNN1',
-            'cn-northwest-1': 'CNN2',
-            'me-south-1': 'MES1',
-            'af-south-1': 'AFS1',
-            'eu-south-1': 'EUS1',
-            'us-gov-east-1': 'UGW1',
-            'us-gov-west-1': 'UGW2',
-            'us-iso-east-1': 'UIE1',
-            'us-isob-east-1': 'UIE2',
-        }
-
-        filters=[
-                {
-                    "Type": "TERM_MATCH",
-                    "Field": "usagetype",
-                    "Value": (region_code_map[self.region] + "-EBS:SnapshotUsage")
-                }
-            ]
-        
-        service_code='AmazonEC2'
-        
-        logger.debug("Mapping region to region: {} to code: {}".format(self.region, region_code_map[self.region]))
-        logger.debug("Setting up filters: {}".format(filters))
-        logger.debug("Getting price for service code: {} and filters: {}".format(service_code, filters))
-
-
-
-
+        service_code = 'AmazonEC2'
+        usage_type = SNAPSHOT_USAGE_TYPE
+        offline_index = get_offline_index()
+        if offline_index is not None:
+            offline_price = offline_index.get_price(self.region, usage_type)
+            logger.info("Offline snapshot price per GB per month: %s", offline_price)
+            self.snapshot_pricing = offline_price
+            return offline_price
+
+        cache = get_pricing_cache()
+        cached_price = cache.get(service_code, self.region, usage_type)
+        if cached_price is not None:
+            logger.info("Using cached snapshot price per GB per month: %s", cached_price)
+            self.snapshot_pricing = cached_price
+            return cached_price
+
+        # Match on the region code rather than the usage type prefix, which differs per region
+        filters = [
+            {"Type": "TERM_MATCH", "Field": "regionCode", "Value": self.region},
+            {"Type": "TERM_MATCH", "Field": "productFamily", "Value": "Storage Snapshot"},
+            {"Type": "TERM_MATCH", "Field": "locationType", "Value": "AWS Region"},
+        ]
+        logger.debug("Getting price for service code: %s and filters: %s", service_code, filters)
         try:
             # Get the pricing information for the Amazon Elastic Block Store (EBS) snapshots
             logger.info("Getting pricing information for AmazonElasticBlockStore...")
             response = get_price(self.profile, service_code, filters)
-            logger.debug("Snapshot pricing response: {}".format(response))
-            json_dump = response
-            cache_file_path = os.path.join(os.path.dirname(__file__), "products.json")
-            with open(cache_file_path, "w") as outfile:
-                json.dump(json_dump, outfile)
-        except:
-            logger.error("Pricing information for AmazonElasticBlockStore is not available. Using cached data...")
-
-            cache_file_path = os.path.join(os.path.dirname(__file__), "products.json")
-
-            logger.info("Opening cached pricing data from {}".format(cache_file_path))
-            with open(cache_file_path, "r") as infile:
-                    response = json.load(infile)
-            logger.debug("Cached pricing data: {}".format(response))
-
+            logger.debug("Snapshot pricing response: %s", response)
+        except Exception as e:
+            logger.error("Pricing information for AmazonElasticBlockStore is not available, using cached data: %s", e)
+            cached_price = cache.get(service_code, self.region, usage_type, allow_expired=True)
+            logger.debug("Cached pricing data: %s", cached_price)
+            if cached_price is None:
+                logger.warning("No cached pricing information for snapshots in %s.", self.region)
+                return None
+            self.snapshot_pricing = cached_price
+            return cached_price
+
+        # The family also holds the archive tier and other snapshot SKUs, keep the standard storage one
+        pricing_data = None
+        for price_item in response['PriceList']:
+            product = json.loads(price_item) if isinstance(price_item, str) else price_item
+            if product['product']['attributes'].get('usagetype', '').endswith(usage_type):
+                pricing_data = product
+                break
 
         # Check if pricing data is available
-        if not response['PriceList']:
-            logger.warning(f"Pricing information for snapshots in {self.region} is not available.")
+        if pricing_data is None:
+            logger.warning("Pricing information for snapshots in %s is not available.", self.region)
             return None
 
-        # Parse the pricing details from the JSON string in the PriceList
-        pricing_data = json.loads(response['PriceList'][0])
-        logger.info("Converting pricing data to JSON...")
-        logger.debug("Pricing data: {}".format(pricing_data))
+        logger.debug("Pricing data: %s", pricing_data)
         if not pricing_data['terms']['OnDemand']:
-            logger.warning(f"Pricing information for AmazonElasticBlockStore in {self.region} is not available.")
+            logger.warning("Pricing information for AmazonElasticBlockStore in %s is not available.", self.region)
             return None
 
         pricing_details = pricing_data['terms']['OnDemand']
-        logger.debug("Pricing details: {}".format(pricing_details))
+        logger.debug("Pricing details: %s", pricing_details)
 
         # Find the correct price per unit for AmazonElasticBlockStore
         pricing_code = None
@@ -119,18 +99,22 @@ class EBSSnapshots:
         logger.info("Finding the correct price per unit for AmazonElasticBlockStore...")
         for code in pricing_details.keys():
             pricing_code = code
-            logger.debug("Pricing code: {}".format(pricing_code))
+            logger.debug("Pricing code: %s", pricing_code)
 
         for code in pricing_details[pricing_code]['priceDimensions'].keys():
             price_dimensions_code = code
-            logger.debug("Price dimensions code: {}".format(price_dimensions_code))
+            logger.debug("Price dimensions code: %s", price_dimensions_code)
         
         
-        snapshot_price_per_gb_month_str = pricing_details[pricing_code]['priceDimensions'][price_dimensions_code]['pricePerUnit']['USD']
+        price_dimension = pricing_details[pricing_code]['priceDimensions'][price_dimensions_code]
+        snapshot_price_per_gb_month_str = price_dimension['pricePerUnit']['USD']
         snapshot_price_per_gb_month = float(snapshot_price_per_gb_month_str)
 
-        logger.info("Snapshot price per GB per month: {}".format(snapshot_price_per_gb_month))
+        logger.info("Snapshot price per GB per month: %s", snapshot_price_per_gb_month)
         self.snapshot_pricing = snapshot_price_per_gb_month
+        cache.put(service_code, self.region, usage_type, snapshot_price_per_gb_month, price_dimension.get('unit'))
+        cache.save()
+        return snapshot_price_per_gb_month
 
     
     
@@ -142,11 +126,10 @@ class EBSSnapshots:
             region (str): AWS region
 
         Returns:
-            list: List of EBS snapshots
+            list: List of SnapshotRecord
         '''
 
         if self.snapshots is None:
-            self.snapshots = get_ebs_snapshots(self.profile, region)
+            self.snapshots = get_inventory(self.profile, region).get_snapshots()
 
         return self.snapshots
-
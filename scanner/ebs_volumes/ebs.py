@@ -1,8 +1,7 @@
-import json
 import scanner.util.logger as log
-from scanner.util.aws_functions import get_price, get_ebs_volumes
-import os
-import mmap
+from scanner.util.ebs_pricing import get_ebs_price_matrix
+from scanner.util.inventory import get_inventory
+from scanner.util.metrics import timed
 
 logger = log.get_logger()
 
@@ -11,16 +10,8 @@ class EbsVolumes:
     EBS volumes
     '''
 
-    pricing_info = {}
-
-    ebs_name_map = {
-        'standard': 'Magnetic',
-        'gp2': 'General Purpose',
-        'gp3': 'General Purpose',
-        'io1': 'Provisioned IOPS',
-        'st1': 'Throughput Optimized HDD',
-        'sc1': 'Cold HDD'
-    }
+    # Used for volume types without a known price
+    default_price_per_gb = 0.1
 
     def __init__(self, profile, region):
         '''
@@ -33,18 +24,14 @@ class EbsVolumes:
         '''
         self.profile = profile
         self.region = region
-        self.volumes = None
         self.volume_pricing = {}
-        if not EbsVolumes.pricing_info:
-            self.get_pricing_info()
-        else:
-
-            logger.debug("Price list already exists. Skipping...")
-            self.volume_pricing = EbsVolumes.pricing_info
+        self.get_pricing_info()
 
     def get_pricing_info(self):
         '''
-        Fetch the pricing information for EBS volumes
+        Fetch the pricing information for EBS volumes in the region
+
+        The prices come from the EBS price matrix shared by the whole run.
 
         Args:
             None
@@ -52,107 +39,28 @@ class EbsVolumes:
         Returns:
             None
         '''
-        json_dump = {}
-        cache_file_path = os.path.join(os.path.dirname(__file__), "products.json")
-        if not os.path.exists(cache_file_path):
-            for ebs_code in self.ebs_name_map:
-            
-
-                filters=[
-                    {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'volumeType',
-                    'Value': self.ebs_name_map[ebs_code]
-                    },
-                    {
-                        'Type': 'TERM_MATCH',
-                        'Field': 'location',
-                        'Value': 'US East (N. Virginia)'
-                    }
-                    ]
-                service_code='AmazonEC2'
-                price = None
-
-                try:
-                    
-                    price = get_price(self.profile, service_code, filters)
-                    
-                    for product in price['PriceList']:
-                        product_json = json.loads(product)
-                        json_dump[product] = product
-                        product_attributes = product_json['product']['attributes']
-                        volume_type = product_attributes.get('volumeApiName')
-                        if volume_type:
-                            price_dimensions = product_json['terms']['OnDemand'].values()
-                            price_per_unit = list(price_dimensions)[0]['priceDimensions']
-                            for price_dimension_key in price_per_unit:
-                                price = price_per_unit[price_dimension_key]['pricePerUnit']['USD']
-                                EbsVolumes.set_volume_pricing(volume_type, float(price))
-                                logger.info("Pricing for {}: {}".format(volume_type, price))
-                            continue
-
-                    cache_file_path = os.path.join(os.path.dirname(__file__), "products.json")
-                    with open(cache_file_path, "w") as outfile:
-                        json.dump(json_dump, outfile)
-
-                except Exception as e:
-                    logger.error(
-                        f"Error occurred while fetching pricing information: {str(e)}")
-                    logger.info("Looking for pricing information in the local file...")
-
-
-
-        try:
-            cache_file_path = os.path.join(os.path.dirname(__file__), "products.json")
-            with open(cache_file_path, "r") as infile:
-                products = json.load(infile)
-                for product in products:
-                    product_json = json.loads(product)
-                    product_attributes = product_json['product']['attributes']
-                    volume_type = product_attributes.get('volumeApiName')
-                    if volume_type:
-                        price_dimensions = product_json['terms']['OnDemand'].values()
-                        price_per_unit = list(price_dimensions)[0]['priceDimensions']
-                        for price_dimension_key in price_per_unit:
-                            price = price_per_unit[price_dimension_key]['pricePerUnit']['USD']
-                            self.set_volume_pricing(volume_type, float(price))
-                            logger.info(
-                                "Pricing for {}: {}".format(volume_type, price))
-                            continue
-        except Exception as e:
-            logger.error(
-                f"Error occurred while fetching pricing information from the local file: {str(e)}. Try removing the file and re-running the app", exc_info=True)
-
-
-    @staticmethod
-    def set_volume_pricing(volume_type, price):
-        '''
-        Set the pricing for the given volume type
-
-        Args:
-            volume_type (str): Volume type
-            price (float): Price per GB
-
-        Returns:
-            None
+        with timed("pricing", self.region):
+            self.volume_pricing = get_ebs_price_matrix(self.profile).get_region_prices(self.region)
+        if not self.volume_pricing:
+            logger.warning("Pricing information for EBS volumes in %s is not available.", self.region)
+        for volume_type, price in self.volume_pricing.items():
+            logger.debug("Pricing for %s in %s: %s", volume_type, self.region, price)
+
+    def get_volume_frame(self, region, filters=None):
         '''
-        EbsVolumes.pricing_info[volume_type] = price
+        Get the EBS volumes for the given region as a typed columnar frame with prices
 
-    def get_volumes(self, region):
-        '''
-        Get the EBS volumes for the given region
+        Errors fetching the volumes are raised so the caller can report the region as failed.
 
         Args:
-            None
+            region (str): AWS region
+            filters (dict): Dictionary of describe_volumes filter name to accepted values,
+                            None for every volume
 
         Returns:
-            list: List of EBS volumes
+            pandas.DataFrame: One row per volume with the Region, VolumeId, VolumeType,
+                              Size, State, Attached and PricePerGB columns
         '''
-        try:
-            
-
-            self.volumes = get_ebs_volumes(self.profile, region)
-            self.volumes_fetched = True
-            return self.volumes
-        except Exception as e:
-            logger.error('Error occurred while fetching EBS volumes: {}'.format(str(e)), exc_info=True)
\ No newline at end of file
+        frame = get_inventory(self.profile, region).get_volume_frame(filters)
+        price_per_gb = frame['VolumeType'].astype(str).map(self.volume_pricing).astype('float64')
+        return frame.assign(PricePerGB=price_per_gb.fillna(self.default_price_per_gb))
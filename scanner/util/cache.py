@@ -0,0 +1,94 @@
+import json
+import os
+import re
+import tempfile
+import time
+import scanner.util.logger as log
+
+
+logger = log.get_logger()
+
+APP_NAME = "ec2_other_scanner"
+
+
+def get_cache_dir():
+    '''
+    Get the directory used for the scanner's on-disk caches
+
+    The location can be overridden with the SCANNER_CACHE_DIR environment
+    variable, otherwise it follows XDG_CACHE_HOME (~/.cache by default).
+
+    Args:
+        None
+
+    Returns:
+        str: Path of the cache directory
+    '''
+    cache_dir = os.environ.get("SCANNER_CACHE_DIR")
+    if not cache_dir:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(base, APP_NAME)
+    return cache_dir
+
+
+def get_cache_path(*parts):
+    '''
+    Build the path of a cache file, making sure every part is a safe file name
+
+    Args:
+        *parts (str): Path components below the cache directory
+
+    Returns:
+        str: Path of the cache file
+    '''
+    safe_parts = [re.sub(r"[^A-Za-z0-9._-]", "_", part) for part in parts]
+    return os.path.join(get_cache_dir(), *safe_parts)
+
+
+def read_json_cache(path, ttl=None):
+    '''
+    Read a JSON cache file written by write_json_cache
+
+    Args:
+        path (str): Path of the cache file
+        ttl (float): Maximum age of the entry in seconds, None to never expire
+
+    Returns:
+        object: Cached data, or None if the file is missing, unreadable or expired
+    '''
+    try:
+        with open(path, "r") as infile:
+            entry = json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+    if ttl is not None and time.time() - entry.get("written_at", 0) > ttl:
+        logger.debug("Cache entry %s has expired", path)
+        return None
+    return entry.get("data")
+
+
+def write_json_cache(path, data):
+    '''
+    Atomically write data to a JSON cache file
+
+    The data is written to a temporary file in the same directory and moved
+    into place, so readers never see a partially written file.
+
+    Args:
+        path (str): Path of the cache file
+        data (object): JSON serialisable data
+
+    Returns:
+        None
+    '''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as outfile:
+            json.dump({"written_at": time.time(), "data": data}, outfile)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+import scanner.util.logger as log
+from scanner.util.aws_functions import count_changed_blocks
+
+
+logger = log.get_logger()
+
+GIB = float(1024 ** 3)
+
+# Changed block mode, off by default. At most max_pairs_per_volume snapshot pairs of a
+# volume and max_pairs_per_region pairs of a region are measured, each with at most
+# max_pages_per_pair ListChangedBlocks pages, so a region costs at most
+# max_pairs_per_region * max_pages_per_pair calls whatever the length of its snapshot chains.
+CHANGED_BLOCKS_SETTINGS = {
+    'enabled': False,
+    'max_workers': 8,
+    'max_pairs_per_volume': 12,
+    'max_pairs_per_region': 1000,
+    'max_pages_per_pair': 5,
+}
+
+# How the storage added by a snapshot was found. The first snapshot of a volume
+# holds a full copy, so it is costed at the whole volume size.
+CHANGE_FROM_VOLUME_SIZE = 'volume size'
+CHANGE_FULL_VOLUME = 'full volume'
+CHANGE_FROM_BLOCKS = 'changed blocks'
+CHANGE_FROM_SAMPLED_BLOCKS = 'sampled blocks'
+CHANGE_EXTRAPOLATED = 'extrapolated'
+
+
+def configure_changed_blocks(enabled=None, max_workers=None, max_pairs_per_volume=None,
+                             max_pairs_per_region=None, max_pages_per_pair=None):
+    '''
+    Change the changed block mode settings
+
+    Args:
+        enabled (bool): Measure the storage added by snapshots with the EBS direct API
+        max_workers (int): Number of snapshot pairs measured concurrently in a region
+        max_pairs_per_volume (int): Snapshot pairs measured per volume, the others are extrapolated
+        max_pairs_per_region (int): Snapshot pairs measured per region
+        max_pages_per_pair (int): ListChangedBlocks pages listed per pair before the rest is extrapolated
+
+    Returns:
+        None
+    '''
+    settings = {
+        'enabled': enabled,
+        'max_workers': max_workers,
+        'max_pairs_per_volume': max_pairs_per_volume,
+        'max_pairs_per_region': max_pairs_per_region,
+        'max_pages_per_pair': max_pages_per_pair,
+    }
+    for name, value in settings.items():
+        if value is not None:
+            CHANGED_BLOCKS_SETTINGS[name] = value
+
+
+def spread(count, limit):
+    '''
+    Pick up to limit evenly spaced positions out of count, always keeping the first and last
+
+    Args:
+        count (int): Number of positions
+        limit (int): Maximum number of positions to pick
+
+    Returns:
+        numpy.ndarray: Sorted positions
+    '''
+    import numpy as np
+
+    if count <= limit:
+        return np.arange(count)
+    return np.unique(np.linspace(0, count - 1, max(limit, 1)).round().astype(np.int64))
+
+
+def select_sample_pairs(volume_ids, max_pairs_per_volume, max_pairs_per_region):
+    '''
+    Pick the snapshot pairs to measure
+
+    Long chains are sampled evenly over time, then the picks of the whole
+    region are thinned evenly if there are still too many.
+
+    Args:
+        volume_ids (numpy.ndarray): Volume id of every pair, the pairs of a volume next to each other
+        max_pairs_per_volume (int): Maximum number of pairs picked per volume
+        max_pairs_per_region (int): Maximum number of pairs picked in total
+
+    Returns:
+        numpy.ndarray: Positions of the pairs to measure
+    '''
+    import numpy as np
+
+    if not len(volume_ids):
+        return np.arange(0)
+    starts = np.flatnonzero(np.r_[True, volume_ids[1:] != volume_ids[:-1]])
+    ends = np.r_[starts[1:], len(volume_ids)]
+    selected = np.concatenate([start + spread(end - start, max_pairs_per_volume) for start, end in zip(starts, ends)])
+    return selected[spread(len(selected), max_pairs_per_region)]
+
+
+def measure_pair(profile, region, first_snapshot_id, second_snapshot_id, max_pages):
+    '''
+    Measure the storage a snapshot added on top of the previous snapshot of its volume
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+        first_snapshot_id (str): Previous snapshot
+        second_snapshot_id (str): Snapshot to measure
+        max_pages (int): ListChangedBlocks pages listed before the rest is extrapolated
+
+    Returns:
+        tuple: Changed GiB and whether every block was listed, or None if the blocks could not be listed
+    '''
+    try:
+        result = count_changed_blocks(profile, region, first_snapshot_id, second_snapshot_id, max_pages=max_pages)
+    except Exception as e:
+        logger.debug("Unable to list the changed blocks of %s: %s", second_snapshot_id, e)
+        return None
+    changed = result['Blocks'] * result['BlockSize'] / GIB
+    if not result['Complete'] and result['BlockSize'] and result['VolumeSize']:
+        # Blocks come in index order, so scale the count up to the part of the volume not listed
+        covered = (result['LastBlockIndex'] + 1) * result['BlockSize'] / (result['VolumeSize'] * GIB)
+        if covered > 0:
+            changed = min(changed / covered, float(result['VolumeSize']))
+    return changed, result['Complete']
+
+
+def estimate_changed_storage(profile, region, pairs, fallback):
+    '''
+    Estimate the storage every snapshot added with the EBS direct ListChangedBlocks API
+
+    A bounded sample of the pairs is measured on a worker pool. The other
+    pairs are extrapolated from the share of the volume that changed per day
+    in the measured pairs of the same volume, or of the region when none of
+    the volume's pairs was measured. Sampled pairs whose listing failed, and
+    every pair when nothing could be measured, are left at the fallback.
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+        pairs (pandas.DataFrame): One row per snapshot with a previous snapshot, sorted by volume and time,
+                                  with the VolumeId, SnapshotId, PreviousSnapshotId, VolumeSize and
+                                  Interval (seconds since the previous snapshot) columns
+        fallback (numpy.ndarray): Changed GiB estimated from the volume size change
+
+    Returns:
+        tuple: Changed GiB of every pair (numpy.ndarray) and how it was found (numpy.ndarray of CHANGE_* values)
+    '''
+    import numpy as np
+    import pandas as pd
+
+    changed = np.array(fallback, dtype=np.float64)
+    source = np.full(len(pairs), CHANGE_FROM_VOLUME_SIZE, dtype=object)
+    if not len(pairs):
+        return changed, source
+
+    settings = CHANGED_BLOCKS_SETTINGS
+    volume_ids = pairs['VolumeId'].to_numpy()
+    first_ids = pairs['PreviousSnapshotId'].to_numpy()
+    second_ids = pairs['SnapshotId'].to_numpy()
+    selected = select_sample_pairs(volume_ids, settings['max_pairs_per_volume'], settings['max_pairs_per_region'])
+    logger.info("Listing the changed blocks of %s of %s snapshot pairs in %s...", len(selected), len(pairs), region)
+
+    def measure(position):
+        return measure_pair(profile, region, first_ids[position], second_ids[position], settings['max_pages_per_pair'])
+
+    with ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
+        measurements = list(executor.map(measure, selected))
+
+    measured = np.zeros(len(pairs), dtype=bool)
+    for position, measurement in zip(selected, measurements):
+        if measurement is None:
+            continue
+        changed[position], complete = measurement
+        source[position] = CHANGE_FROM_BLOCKS if complete else CHANGE_FROM_SAMPLED_BLOCKS
+        measured[position] = True
+    failures = len(selected) - int(measured.sum())
+    if failures:
+        logger.warning("Unable to list the changed blocks of %s snapshot pairs in %s", failures, region)
+    if not measured.any():
+        return changed, source
+
+    # GiB-days each pair covers, so changes can be compared between volume sizes and intervals
+    sizes = pairs['VolumeSize'].to_numpy(dtype=np.float64)
+    exposure = np.maximum(sizes, 1.0) * np.maximum(pairs['Interval'].to_numpy(dtype=np.float64) / 86400, 1.0 / 24)
+    sums = pd.DataFrame({
+        'VolumeId': volume_ids[measured],
+        'Changed': changed[measured],
+        'Exposure': exposure[measured],
+    }).groupby('VolumeId').sum()
+    volume_rates = sums['Changed'] / sums['Exposure']
+    region_rate = changed[measured].sum() / exposure[measured].sum()
+    rates = pd.Series(volume_ids).map(volume_rates).fillna(region_rate).to_numpy(dtype=np.float64)
+
+    # Only pairs outside the sample are extrapolated, a failed listing says nothing about its pair
+    unmeasured = np.ones(len(pairs), dtype=bool)
+    unmeasured[selected] = False
+    changed[unmeasured] = np.minimum(rates[unmeasured] * exposure[unmeasured], np.maximum(sizes[unmeasured], 0))
+    source[unmeasured] = CHANGE_EXTRAPOLATED
+    return changed, source
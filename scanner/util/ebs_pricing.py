@@ -0,0 +1,236 @@
+import json
+import threading
+import scanner.util.logger as log
+from scanner.util.aws_functions import get_products
+from scanner.util.pricing_cache import get_pricing_cache
+from scanner.util.offer_index import get_offline_index
+
+
+logger = log.get_logger()
+
+SERVICE_CODE = 'AmazonEC2'
+VOLUME_USAGE_PREFIX = 'EBS:VolumeUsage.'
+
+# Every EBS volume storage product in an AWS region, for all volume types
+STORAGE_FILTERS = [
+    {'Type': 'TERM_MATCH', 'Field': 'productFamily', 'Value': 'Storage'},
+    {'Type': 'TERM_MATCH', 'Field': 'locationType', 'Value': 'AWS Region'},
+]
+
+
+class EbsPriceMatrix:
+    '''
+    Price per GB-month of every EBS volume type in every region
+    '''
+
+    def __init__(self, prices=None):
+        '''
+        Initialise the class
+
+        Args:
+            prices (dict): Dictionary of (region, volumeApiName) to price per GB-month
+        '''
+        self.prices = prices or {}
+
+    def __len__(self):
+        return len(self.prices)
+
+    def set_price(self, region, volume_type, price):
+        '''
+        Set the price of a volume type in a region
+
+        Args:
+            region (str): AWS region
+            volume_type (str): Volume type, e.g. 'gp3'
+            price (float): Price per GB-month
+
+        Returns:
+            None
+        '''
+        self.prices[(region, volume_type)] = price
+
+    def get_price(self, region, volume_type, default=None):
+        '''
+        Get the price of a volume type in a region
+
+        Args:
+            region (str): AWS region
+            volume_type (str): Volume type, e.g. 'gp3'
+            default (float): Value returned if the price is unknown
+
+        Returns:
+            float: Price per GB-month
+        '''
+        return self.prices.get((region, volume_type), default)
+
+    def get_region_prices(self, region):
+        '''
+        Get the price of every volume type in a region
+
+        Args:
+            region (str): AWS region
+
+        Returns:
+            dict: Dictionary of volume type to price per GB-month
+        '''
+        return {
+            volume_type: price
+            for (price_region, volume_type), price in self.prices.items()
+            if price_region == region
+        }
+
+
+def parse_storage_product(product):
+    '''
+    Extract the region, volume type and price of an EBS storage product
+
+    Args:
+        product (str): Product JSON string from the price list
+
+    Returns:
+        tuple: (region, volume type, price per GB-month, unit), or None if the product
+               is not priced per GB-month
+    '''
+    product_json = json.loads(product)
+    attributes = product_json['product']['attributes']
+    region = attributes.get('regionCode')
+    volume_type = attributes.get('volumeApiName')
+    if not region or not volume_type:
+        return None
+
+    for term in product_json['terms'].get('OnDemand', {}).values():
+        for price_dimension in term['priceDimensions'].values():
+            if price_dimension.get('unit', 'GB-Mo') == 'GB-Mo':
+                return region, volume_type, float(price_dimension['pricePerUnit']['USD']), price_dimension.get('unit')
+    return None
+
+
+def fetch_ebs_price_matrix(profile, cache=None):
+    '''
+    Build the EBS price matrix from a single paginated sweep of the price list
+
+    Args:
+        profile (str): AWS profile name
+        cache (PricingCache): Cache the prices are also stored in
+
+    Returns:
+        EbsPriceMatrix: Price matrix
+    '''
+    logger.info("Loading EBS storage prices for every region...")
+    matrix = EbsPriceMatrix()
+    for product in get_products(profile, SERVICE_CODE, STORAGE_FILTERS):
+        parsed = parse_storage_product(product)
+        if parsed is None:
+            continue
+        region, volume_type, price, unit = parsed
+        matrix.set_price(region, volume_type, price)
+        if cache is not None:
+            cache.put(SERVICE_CODE, region, VOLUME_USAGE_PREFIX + volume_type, price, unit)
+    logger.info("Loaded %s EBS storage prices", len(matrix))
+    return matrix
+
+
+def get_cached_price_matrix(cache, allow_expired=False):
+    '''
+    Build the EBS price matrix from the pricing cache
+
+    Args:
+        cache (PricingCache): Pricing cache
+        allow_expired (bool): Include stale entries
+
+    Returns:
+        EbsPriceMatrix: Price matrix, empty if nothing usable is cached
+    '''
+    prices = cache.find(SERVICE_CODE, VOLUME_USAGE_PREFIX, allow_expired=allow_expired)
+    return EbsPriceMatrix({
+        (region, usage_type[len(VOLUME_USAGE_PREFIX):]): price
+        for (region, usage_type), price in prices.items()
+    })
+
+
+def get_offline_price_matrix(offline_index):
+    '''
+    Build the EBS price matrix from the offline price index
+
+    Args:
+        offline_index (OfferIndex): Index built from the AWS bulk offer file
+
+    Returns:
+        EbsPriceMatrix: Price matrix
+    '''
+    matrix = EbsPriceMatrix()
+    for region, usage_type, price in offline_index.iter_prices():
+        if usage_type.startswith(VOLUME_USAGE_PREFIX):
+            matrix.set_price(region, usage_type[len(VOLUME_USAGE_PREFIX):], price)
+    logger.info("Loaded %s EBS storage prices from the offline index", len(matrix))
+    return matrix
+
+
+def load_ebs_price_matrix(profile):
+    '''
+    Load the EBS price matrix, from the offline index when offline pricing is
+    enabled, otherwise from the pricing cache when it is fresh
+
+    The whole matrix is written to the cache in one sweep, so any fresh
+    cached entry means the sweep ran within the cache TTL.
+
+    Args:
+        profile (str): AWS profile name
+
+    Returns:
+        EbsPriceMatrix: Price matrix
+    '''
+    offline_index = get_offline_index()
+    if offline_index is not None:
+        return get_offline_price_matrix(offline_index)
+
+    cache = get_pricing_cache()
+    matrix = get_cached_price_matrix(cache)
+    if len(matrix):
+        logger.info("Using %s cached EBS storage prices", len(matrix))
+        return matrix
+
+    try:
+        matrix = fetch_ebs_price_matrix(profile, cache)
+        cache.save()
+    except Exception as e:
+        logger.error("Error occurred while fetching pricing information: %s", e)
+        logger.info("Looking for pricing information in the pricing cache...")
+        matrix = get_cached_price_matrix(cache, allow_expired=True)
+    return matrix
+
+
+_price_matrix = None
+_price_matrix_lock = threading.Lock()
+
+
+def get_ebs_price_matrix(profile):
+    '''
+    Get the EBS price matrix shared by the whole run, loading it on first use
+
+    Args:
+        profile (str): AWS profile name
+
+    Returns:
+        EbsPriceMatrix: Price matrix
+    '''
+    global _price_matrix
+    with _price_matrix_lock:
+        if _price_matrix is None:
+            _price_matrix = load_ebs_price_matrix(profile)
+        return _price_matrix
+
+
+def clear_ebs_price_matrix():
+    '''
+    Drop the shared EBS price matrix so the next use loads it again
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+    global _price_matrix
+    with _price_matrix_lock:
+        _price_matrix = None
@@ -1,8 +1,10 @@
+import logging
 from scanner.ebs_snapshots.snapshot import EBSSnapshots
-import pandas as pd
+from scanner.util.changed_blocks import estimate_changed_storage, CHANGED_BLOCKS_SETTINGS, CHANGE_FROM_VOLUME_SIZE, CHANGE_FULL_VOLUME
+from scanner.util.inventory import get_inventory
+from scanner.util.metrics import timed
 from datetime import datetime, timezone
 import scanner.util.logger as log
-import boto3
 
 
 logger = log.get_logger()
@@ -29,189 +31,306 @@ def get_snapshot_age(snapshot):
     Function to get the age of the given snapshot
 
     Args:
-        snapshot (dict): Snapshot details
+        snapshot (SnapshotRecord): Snapshot details
 
     Returns:
         int: Age of the snapshot in days
     '''
-    create_time = snapshot['StartTime']
-    logger.debug("Snapshot creation time: {}".format(create_time))
+    create_time = datetime.fromtimestamp(snapshot.StartTime, timezone.utc)
+    logger.debug("Snapshot creation time: %s", create_time)
     current_time = datetime.now(timezone.utc)
-    logger.debug("Current time: {}".format(current_time))
+    logger.debug("Current time: %s", current_time)
     age = (current_time - create_time).days
-    logger.debug("Snapshot age: {}".format(age))
+    logger.debug("Snapshot age: %s", age)
     return age
 
 
-def get_all_snapshots(profile, region):
-    session = boto3.Session(profile_name=profile, region_name=region)
-    return session.client('ec2')
+# Fallback used when no snapshot price can be found for a region
+DEFAULT_SNAPSHOT_PRICE_PER_GB_MONTH = 0.05
+
+# Source volume id of snapshots copied from another snapshot or whose volume was deleted
+UNKNOWN_VOLUME_ID = 'vol-ffffffff'
+
+# Status of a snapshot: backing an AMI, taken from a volume that still exists, or neither
+SNAPSHOT_AMI_BACKED = 'AMI-backed'
+SNAPSHOT_IN_USE = 'In Use'
+SNAPSHOT_ORPHANED = 'Orphaned'
+
+# Finding of the snapshot report for each status
+SNAPSHOT_FINDINGS = {
+    SNAPSHOT_AMI_BACKED: 'AMI-backed Snapshot',
+    SNAPSHOT_IN_USE: 'Snapshot Cost',
+    SNAPSHOT_ORPHANED: 'Orphaned Snapshot',
+}
+
+SNAPSHOT_COLUMNS = [
+    'SnapshotId', 'VolumeId', 'VolumeSize', 'AgeDays', 'CostUSD', 'description',
+    'Status', 'SnapshotSizeChange', 'ChangedGB', 'ChangedGBSource', 'IsUnused',
+]
+
+# Columns of the snapshot report and their types
+SNAPSHOT_REPORT_SCHEMA = {
+    'Region': 'string',
+    'ResourceType': 'string',
+    'VolumeId': 'string',
+    'SnapshotId': 'string',
+    'AgeDays': 'Int64',
+    'SnapshotSizeGB': 'Int64',
+    'Findings': 'string',
+    'MonthlySavings': 'float64',
+    'Description': 'string',
+    'ChangedGB': 'float64',
+    'ChangedGBSource': 'string',
+}
+
+
+def get_snapshot_price(profile, region):
+    '''
+    Function to get the snapshot price per GB per month for the given region
 
-def get_snapshot_age(snapshot):
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        float: Snapshot price per GB per month
     '''
-    Function to get the age of the given snapshot
+    try:
+        with timed("pricing", region):
+            price = get_all_snapshots(profile, region).snapshot_pricing
+    except Exception as e:
+        logger.warning("Unable to get the snapshot price for %s: %s", region, e)
+        price = None
+    if price is None:
+        logger.warning("Using the default snapshot price of %s per GB per month for %s",
+                       DEFAULT_SNAPSHOT_PRICE_PER_GB_MONTH, region)
+        price = DEFAULT_SNAPSHOT_PRICE_PER_GB_MONTH
+    return price
+
+
+def build_snapshot_frame(snapshots):
+    '''
+    Function to load snapshot records into a columnar frame
 
     Args:
-        snapshot (dict): Snapshot details
+        snapshots (list): List of SnapshotRecord
 
     Returns:
-        int: Age of the snapshot in days
+        pandas.DataFrame: One row per snapshot with the SnapshotId, VolumeId,
+                          VolumeSize, StartTime (epoch seconds) and Description columns
     '''
-    create_time = snapshot['StartTime']
-    logger.debug("Snapshot creation time: {}".format(create_time))
-    current_time = datetime.now(timezone.utc)
-    logger.debug("Current time: {}".format(current_time))
-    age = (current_time - create_time).days
-    logger.debug("Snapshot age: {}".format(age))
-    return age
+    import numpy as np
+    import pandas as pd
+
+    return pd.DataFrame({
+        'SnapshotId': [snapshot.SnapshotId for snapshot in snapshots],
+        'VolumeId': [snapshot.VolumeId for snapshot in snapshots],
+        'VolumeSize': np.fromiter((snapshot.VolumeSize for snapshot in snapshots), dtype=np.int64, count=len(snapshots)),
+        'StartTime': np.fromiter((snapshot.StartTime for snapshot in snapshots), dtype=np.float64, count=len(snapshots)),
+        'Description': [snapshot.Description for snapshot in snapshots],
+    })
+
+
+def classify_snapshots(snapshot_ids, volume_ids, image_snapshot_ids, live_volume_ids):
+    '''
+    Function to classify snapshots as AMI-backed, in use or orphaned
+
+    Every lookup is a hash set membership test, so no API call is made per snapshot.
 
+    Args:
+        snapshot_ids (pandas.Series): Snapshot ids
+        volume_ids (pandas.Series): Source volume ids of the snapshots
+        image_snapshot_ids (frozenset): Ids of the snapshots backing AMIs owned by the account
+        live_volume_ids (frozenset): Ids of the volumes that exist in the region
 
+    Returns:
+        numpy.ndarray: SNAPSHOT_AMI_BACKED, SNAPSHOT_IN_USE or SNAPSHOT_ORPHANED for every snapshot
+    '''
+    import numpy as np
 
+    ami_backed = np.fromiter((snapshot_id in image_snapshot_ids for snapshot_id in snapshot_ids), dtype=bool, count=len(snapshot_ids))
+    in_use = np.fromiter((volume_id in live_volume_ids for volume_id in volume_ids), dtype=bool, count=len(volume_ids))
+    return np.where(ami_backed, SNAPSHOT_AMI_BACKED, np.where(in_use, SNAPSHOT_IN_USE, SNAPSHOT_ORPHANED)).astype(object)
 
-def get_aws_snapshot_cost(profile, region):
+
+def get_aws_snapshot_cost(profile, region, min_age_days=365):
     '''
     Function to get the cost of EBS snapshots for the given region
 
+    Snapshots are grouped into per-volume lineages. The first snapshot of a
+    lineage holds a full copy of the volume and is costed at its whole
+    VolumeSize. The incremental size of a later snapshot is estimated from the
+    change in VolumeSize since the previous snapshot of the same volume, or
+    measured with the EBS direct API when the changed block mode is enabled,
+    and all ages and costs are computed for the whole region at once. Each
+    snapshot is classified against the AMIs of the region, fetched once, and
+    against the volumes it was taken from, which are looked up by id rather
+    than listing every volume of the region.
+
     Args:
         profile (str): AWS profile name
         region (str): AWS region
+        min_age_days (int): Only snapshots at least this old are reported
 
     Returns:
-        list: List of dictionaries containing information about each EBS snapshot:
+        pandas.DataFrame: One row per EBS snapshot with the columns:
             - 'SnapshotId': str
             - 'VolumeId': str
             - 'VolumeSize': int (in GB)
             - 'AgeDays': int
             - 'CostUSD': float (snapshot cost)
             - 'description': str (snapshot description)
-            - 'RetentionPolicy': str (e.g., 'Keep Forever', '7 days', etc.)
-            - 'SnapshotFrequency': str (e.g., 'Daily', 'Weekly', etc.)
-            - 'SnapshotSizeChange': float (size change from the previous snapshot in GB)
-            - 'IsUnused': bool (True if snapshot is not associated with any AMI, False otherwise)
-        float: Total cost of EBS snapshots
+            - 'Status': str ('AMI-backed', 'In Use' or 'Orphaned')
+            - 'SnapshotSizeChange': float (size change from the previous snapshot in GB, NaN for the first)
+            - 'ChangedGB': float (storage added since the previous snapshot in GB)
+            - 'ChangedGBSource': str ('full volume', 'volume size', 'changed blocks', 'sampled blocks' or 'extrapolated')
+            - 'IsUnused': bool (True if the snapshot backs no AMI and its volume no longer exists)
     '''
+    import numpy as np
+    import pandas as pd
 
-    # Get all snapshots for the given region
     logger.info("Getting all snapshots...")
-    snapshot_object = get_all_snapshots(profile, region)
-    logger.debug("Snapshot object: {}".format(snapshot_object))
-    snapshots = snapshot_object.describe_snapshots(OwnerIds=['self'])
-    snapshot_price_per_gb_month = 0.05  # Set the appropriate snapshot price per GB per month
-    logger.debug("Snapshot price per GB per month: {}".format(snapshot_price_per_gb_month))
-
-    # Collect information about snapshots and their costs
-    snapshots_info = []
-
-    logger.info("Sorting snapshots by creation time...")
-    sorted_snapshots = sorted(snapshots['Snapshots'], key=lambda s: s['StartTime'])
-
-    logger.info("Calculating the cost of snapshots...")
-    previous_snapshot = None
-
-    for snapshot in sorted_snapshots:
-        snapshot_age = get_snapshot_age(snapshot)
-        volume_id = snapshot['VolumeId']
-
-        if snapshot_age >= 365:
-            # If the snapshot is within 365 days and snapshot_age is not None, calculate its cost
-            if previous_snapshot is not None:
-                size_difference_gb = snapshot['VolumeSize'] - previous_snapshot['VolumeSize']
-                snapshot_cost = abs(size_difference_gb) * snapshot_price_per_gb_month
-                snapshot_cost = snapshot_cost/2
-
-                logger.info(f"SnapshotId: {snapshot['SnapshotId']}, "
-                            f"VolumeId: {volume_id}, "
-                            f"VolumeSize: {snapshot['VolumeSize']} GB, "
-                            f"AgeDays: {snapshot_age}, "
-                            f"SizeDifferenceGB: {size_difference_gb} GB, "
-                            f"CostUSD: {snapshot_cost} USD, "
-                            f"RetentionPolicy: Keep Forever, "  # Set the retention policy here
-                            f"SnapshotFrequency: Daily, "  # Set the snapshot frequency here
-                            f"SnapshotSizeChange: {size_difference_gb} GB, "
-                            f"IsUnused: True")  # Set the unused status here (True if unused)
-
-                snapshot_info = {
-                    'SnapshotId': snapshot['SnapshotId'],
-                    'VolumeId': volume_id,
-                    'VolumeSize': snapshot['VolumeSize'],
-                    'AgeDays': snapshot_age,
-                    'CostUSD': snapshot_cost,
-                    'description': snapshot.get('Description', ''),
-                    'RetentionPolicy': 'Keep Forever',  # You can set the retention policy here
-                    'SnapshotFrequency': 'Daily',  # You can set the snapshot frequency here
-                    'SnapshotSizeChange': size_difference_gb,
-                    'IsUnused': True,  # You can check if the snapshot is unused and set this flag accordingly
-                }
-                snapshots_info.append(snapshot_info)
-
-            # Update the previous_snapshot with the current snapshot
-            previous_snapshot = snapshot
-
-
-
-    return snapshots_info
-
-
-
-
+    inventory = get_inventory(profile, region)
+    frame = build_snapshot_frame(inventory.get_snapshots())
+    image_snapshot_ids = inventory.get_image_snapshot_ids()
+
+    snapshot_price_per_gb_month = get_snapshot_price(profile, region)
+    logger.debug("Snapshot price per GB per month: %s", snapshot_price_per_gb_month)
+
+    logger.info("Calculating the cost of %s snapshots...", len(frame))
+    now = datetime.now(timezone.utc).timestamp()
+    frame['AgeDays'] = ((now - frame['StartTime']) // 86400).astype(np.int64)
+    frame = frame[frame['AgeDays'] >= min_age_days]
+    has_volume = (frame['VolumeId'] != '') & (frame['VolumeId'] != UNKNOWN_VOLUME_ID)
+    live_volume_ids = inventory.get_existing_volume_ids(frame['VolumeId'][has_volume].unique())
+
+    # Order each volume's snapshots by creation time and diff consecutive sizes.
+    # Snapshots without a known source volume each start a lineage of their own.
+    lineage_ids = frame['VolumeId'].where(has_volume, frame['SnapshotId'])
+    frame = frame.assign(LineageId=lineage_ids).sort_values(['LineageId', 'StartTime'], kind='stable')
+    lineage = frame.groupby('LineageId', sort=False)
+    size_change = lineage['VolumeSize'].diff()
+    frame = frame.assign(SnapshotSizeChange=size_change)
+    has_previous = size_change.notna().to_numpy()
+
+    # The first snapshot of a lineage stores the whole volume, after that half of the
+    # size change is assumed to be new data unless the changed block mode measures it
+    changed_gb = np.where(has_previous, frame['SnapshotSizeChange'].abs().to_numpy() / 2, frame['VolumeSize'].to_numpy())
+    changed_gb_source = np.where(has_previous, CHANGE_FROM_VOLUME_SIZE, CHANGE_FULL_VOLUME).astype(object)
+    if CHANGED_BLOCKS_SETTINGS['enabled'] and has_previous.any():
+        pairs = frame.assign(
+            VolumeId=frame['LineageId'],
+            PreviousSnapshotId=lineage['SnapshotId'].shift(),
+            Interval=lineage['StartTime'].diff(),
+        )[has_previous]
+        changed_gb[has_previous], changed_gb_source[has_previous] = estimate_changed_storage(
+            profile, region, pairs, changed_gb[has_previous])
+    status = classify_snapshots(frame['SnapshotId'], frame['VolumeId'], image_snapshot_ids, live_volume_ids)
+
+    result = pd.DataFrame({
+        'SnapshotId': frame['SnapshotId'],
+        'VolumeId': frame['VolumeId'],
+        'VolumeSize': frame['VolumeSize'],
+        'AgeDays': frame['AgeDays'],
+        'CostUSD': changed_gb * snapshot_price_per_gb_month,
+        'description': frame['Description'],
+        'Status': status,
+        'SnapshotSizeChange': frame['SnapshotSizeChange'],
+        'ChangedGB': changed_gb,
+        'ChangedGBSource': changed_gb_source,
+        'IsUnused': status == SNAPSHOT_ORPHANED,
+    }, columns=SNAPSHOT_COLUMNS).reset_index(drop=True)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Found %s snapshots in %s costing %.2f USD", len(result), region, result['CostUSD'].sum())
+    return result
+
+
+def build_snapshot_region_frame(region, snapshot_savings):
+    """
+    Build the snapshot report rows of one region
 
+    Args:
+        region (str): AWS region
+        snapshot_savings (pandas.DataFrame): Frame returned by get_aws_snapshot_cost
 
-def create_snapshot_dataframe(snapshot_data):
+    Returns:
+        pandas.DataFrame: Report rows with the SNAPSHOT_REPORT_SCHEMA columns, or None if there are no findings
     """
-    Function to create the dataframe of snapshot data
+    import pandas as pd
+
+    if snapshot_savings is None or not len(snapshot_savings):
+        return None
+    snapshot_savings = pd.DataFrame(snapshot_savings)
+    # Only the volume size estimate keeps the historical assumption that half of it can be saved
+    estimated = snapshot_savings['ChangedGBSource'] == CHANGE_FROM_VOLUME_SIZE
+    return pd.DataFrame({
+        "Region": region,
+        "ResourceType": "EBS Snapshot",
+        "VolumeId": snapshot_savings['VolumeId'],
+        "SnapshotId": snapshot_savings['SnapshotId'],
+        "AgeDays": snapshot_savings['AgeDays'],
+        "SnapshotSizeGB": snapshot_savings['VolumeSize'],  # Including the snapshot size in GB
+        "Findings": snapshot_savings['Status'].map(SNAPSHOT_FINDINGS),
+        "MonthlySavings": snapshot_savings['CostUSD'].where(~estimated, snapshot_savings['CostUSD'] / 2),
+        "Description": snapshot_savings['description'],
+        "ChangedGB": snapshot_savings['ChangedGB'],
+        "ChangedGBSource": snapshot_savings['ChangedGBSource'],
+    }, columns=list(SNAPSHOT_REPORT_SCHEMA))
+
+
+def build_snapshot_total_frame(region, total):
     """
+    Build the total row of the snapshot report
 
-    # Create a list of dictionaries for snapshot data
-    snapshot_list = []
-    total_savings = 0
+    Args:
+        region (str): AWS region of a region total, None for the grand total
+        total (float): Total monthly savings
 
-    logger.info("Generating the snapshot dataframe...")
-    has_data = False
-    for region, snapshot_savings_dict in snapshot_data.items():
-        if(snapshot_savings_dict != []):
-            has_data = True
-        for snapshot in snapshot_savings_dict:
-            logger.debug("Snapshot: {}".format(snapshot))
-            snapshot_cost = snapshot['CostUSD']/2
-            volume_id = snapshot.get('VolumeId', '')
-            snapshot_id = snapshot.get('SnapshotId', '')
-            age_days = snapshot.get('AgeDays', '')
-            snapshot_size = snapshot.get('VolumeSize', '')
-            description = snapshot.get('description', '')
-
-            snapshot_data = {
-                "Region": region,
-                "ResourceType": "EBS Snapshot",
-                "VolumeId": volume_id,
-                "SnapshotId": snapshot_id,
-                "AgeDays": age_days,
-                "SnapshotSizeGB": snapshot_size,  # Including the snapshot size in GB
-                "Findings": "Snapshot Cost",
-                "MonthlySavings": f"${snapshot_cost:.2f}",
-                "Description": description
-            }
-            logger.debug('Snapshot data: {}'.format(snapshot_data))
-            snapshot_list.append(snapshot_data)
-            total_savings += snapshot_cost
+    Returns:
+        pandas.DataFrame: One report row with the SNAPSHOT_REPORT_SCHEMA columns, or None for
+                          a region as the snapshot report only has the grand total
+    """
+    import pandas as pd
 
-    # Add a row for the total savings from snapshots
+    if region is not None:
+        return None
     total_savings_row = {
         "Region": "Total Savings",
         "ResourceType": "EBS Snapshot",
         "VolumeId": "",
         "SnapshotId": "",
-        "AgeDays": "",
-        "SnapshotSizeGB": "",
+        "AgeDays": None,
+        "SnapshotSizeGB": None,
         "Findings": "",
-        "MonthlySavings": f"${total_savings:.2f}"
+        "MonthlySavings": float(total),
     }
-    logger.debug("Total savings row: {}".format(total_savings_row))
-    snapshot_list.append(total_savings_row)
+    logger.debug("Total savings row: %s", total_savings_row)
+    return pd.DataFrame([total_savings_row], columns=list(SNAPSHOT_REPORT_SCHEMA))
+
+
+def create_snapshot_dataframe(snapshot_data):
+    """
+    Function to create the dataframe of snapshot data
 
-    # Create a DataFrame for snapshots
-    if(has_data):
-        snapshot_dataframe = pd.DataFrame(snapshot_list)
-    else:
+    Args:
+        snapshot_data (dict): Dictionary of region to the frame returned by get_aws_snapshot_cost
+
+    Returns:
+        pandas.DataFrame: Dataframe of snapshot findings with a total row, or None if there is no data
+    """
+    import pandas as pd
+
+    logger.info("Generating the snapshot dataframe...")
+    region_frames = []
+    for region, snapshot_savings in snapshot_data.items():
+        region_frame = build_snapshot_region_frame(region, snapshot_savings)
+        if region_frame is not None:
+            region_frames.append(region_frame)
+
+    if not region_frames:
         return None
 
-    return snapshot_dataframe
\ No newline at end of file
+    # Add a row for the total savings from snapshots
+    total_savings = sum(frame['MonthlySavings'].sum() for frame in region_frames)
+    region_frames.append(build_snapshot_total_frame(None, total_savings))
+    return pd.concat(region_frames, ignore_index=True)
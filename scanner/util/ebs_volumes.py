@@ -1,11 +1,40 @@
+import time
 import scanner.util.logger as log
 from scanner.ebs_volumes.ebs import EbsVolumes
-import pandas as pd
+from scanner.util.inventory import get_inventory
 
 
 logger = log.get_logger()
 
-volumes = []
+# describe_volumes filters of the candidate volumes each analyzer looks at
+UNUSED_VOLUME_FILTERS = {'status': ['available']}
+GP2_VOLUME_FILTERS = {'volume-type': ['gp2']}
+
+# Volumes are only reported once every instance they are attached to has been stopped this long
+STOPPED_INSTANCE_SETTINGS = {
+    'min_stopped_days': 30,
+}
+
+# Findings of the volume report, keyed by analyzer name
+EBS_FINDINGS = {
+    "unused": "Unused EBS Volume",
+    "gp2": "GP2 to GP3 Savings",
+    "stopped": "Attached to Stopped Instance",
+}
+
+# Findings that save the whole cost of a volume, which already includes its gp2 to gp3 saving.
+# Other findings of the same volume stay in the report with no savings, so totals count it once.
+FULL_COST_FINDINGS = ("unused", "stopped")
+OVERLAP_FINDING_SUFFIX = " (counted in {})"
+
+# Columns of the volume report and their types
+EBS_REPORT_SCHEMA = {
+    "Region": "string",
+    "ResourceType": "string",
+    "VolumeId": "string",
+    "Findings": "string",
+    "MonthlySavings": "float64",
+}
 
 def get_all_volumes(profile, region):
     """
@@ -21,7 +50,7 @@ def get_all_volumes(profile, region):
     try:
         return EbsVolumes(profile, region)
     except Exception as e:
-        logger.warning(f"Error fetching EBS volumes for region {region}: {str(e)}")
+        logger.warning("Error fetching EBS volumes for region %s: %s", region, e)
         return None
     
 
@@ -30,26 +59,122 @@ def get_gp2_to_gp3_savings(ebs_volumes, region):
     Calculate the estimated gp2 to gp3 savings for each gp2 volume
 
     Args:
+        ebs_volumes (EbsVolumes): EbsVolumes object
+        region (str): AWS region
+
+    Returns:
+        pandas.DataFrame: VolumeId and monthly Savings of every gp2 volume
+    """
+    import pandas as pd
+
+    frame = ebs_volumes.get_volume_frame(region, GP2_VOLUME_FILTERS)
+    gp2_volumes = frame[frame['VolumeType'] == 'gp2']
+    if len(gp2_volumes):
+        logger.warning("%s GP2 volumes found in %s. Calculating potential savings...", len(gp2_volumes), region)
+    gp2_price_per_gb = ebs_volumes.volume_pricing.get('gp2', 0.1)
+    gp3_price_per_gb = ebs_volumes.volume_pricing.get('gp3', 0.08)
+    return pd.DataFrame({
+        "VolumeId": gp2_volumes['VolumeId'],
+        "Savings": gp2_volumes['Size'] * (gp2_price_per_gb - gp3_price_per_gb),
+    }).reset_index(drop=True)
+
+
+def get_region_unused_volume_savings(profile, region):
+    """
+    Function to get the potential savings from the unused EBS volumes of one region
+
+    Errors fetching the volumes are raised so the analysis of the region is marked as failed.
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        pandas.DataFrame: VolumeId and monthly Savings of every unused volume, or None if there are none
+    """
+    import pandas as pd
+
+    logger.info("Checking for volumes in %s...", region)
+    frame = EbsVolumes(profile, region).get_volume_frame(region, UNUSED_VOLUME_FILTERS)
+    unused_volumes = frame[~frame['Attached']]
+    if not len(unused_volumes):
+        logger.info("%s: No unused volumes found.", region)
+        return None
+    logger.warning("%s unused volumes found in %s", len(unused_volumes), region)
+    return pd.DataFrame({
+        "VolumeId": unused_volumes['VolumeId'],
+        "Savings": unused_volumes['Size'] * unused_volumes['PricePerGB'],
+    }).reset_index(drop=True)
+
+
+def set_min_stopped_days(days):
+    '''
+    Change how long an instance must have been stopped before its volumes are reported
+
+    Args:
+        days (int): Minimum number of days
+
+    Returns:
         None
+    '''
+    STOPPED_INSTANCE_SETTINGS['min_stopped_days'] = days
+
+
+def get_region_stopped_instance_volume_savings(profile, region):
+    """
+    Function to get the potential savings from the volumes attached to long-stopped instances of one region
+
+    The stopped instances of the region are fetched once and indexed by id,
+    and only the volumes attached to the instances stopped long enough are
+    looked up, so regions without such instances fetch no volumes. A volume
+    is reported when every instance it is attached to has been stopped for at
+    least STOPPED_INSTANCE_SETTINGS['min_stopped_days'].
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
 
     Returns:
-        dict: Dictionary of gp2 to gp3 savings
-    """
-    gp2_to_gp3_savings = {}
-    volumes = ebs_volumes.get_volumes(region)
-    if volumes:
-        for volume in volumes['Volumes']:
-            if volume['VolumeType'] == 'gp2':
-                logger.warning("GP2 volumes found. Calculating potential savings...")
-                volume_size = volume['Size']
-                gp2_price_per_gb = ebs_volumes.volume_pricing.get('gp2', 0.1)
-                gp3_price_per_gb = ebs_volumes.volume_pricing.get('gp3', 0.08)
-                gp2_savings = volume_size * gp2_price_per_gb
-                gp3_savings = volume_size * gp3_price_per_gb
-                gp2_to_gp3_savings[volume['VolumeId']] = gp2_savings - gp3_savings
-    return gp2_to_gp3_savings
+        pandas.DataFrame: VolumeId, InstanceId, StoppedDays and monthly Savings of every volume,
+                          or None if there are none
+    """
+    import pandas as pd
+
+    ebs_volumes = get_all_volumes(profile, region)
+    if ebs_volumes is None:
+        raise RuntimeError("Unable to load the EBS volumes for {}".format(region))
+    inventory = get_inventory(profile, region)
+    stopped_instances = inventory.get_stopped_instances()
+
+    now = time.time()
+    cutoff = now - STOPPED_INSTANCE_SETTINGS['min_stopped_days'] * 86400
+    # Instances without a stop time in their state reason cannot be aged, so they are skipped
+    candidate_ids = [
+        instance_id for instance_id, instance in stopped_instances.items()
+        if instance.StoppedAt is not None and instance.StoppedAt <= cutoff
+    ]
+    if not candidate_ids:
+        return None
+
+    rows = []
+    for volume in inventory.get_instance_volumes(candidate_ids):
+        instances = [stopped_instances.get(instance_id) for instance_id in volume.InstanceIds]
+        # Multi-attach volumes are only reported when all of their instances are long stopped
+        if any(instance is None or instance.StoppedAt is None or instance.StoppedAt > cutoff for instance in instances):
+            continue
+        price_per_gb = ebs_volumes.volume_pricing.get(volume.VolumeType, ebs_volumes.default_price_per_gb)
+        rows.append((
+            volume.VolumeId,
+            ",".join(volume.InstanceIds),
+            int((now - max(instance.StoppedAt for instance in instances)) // 86400),
+            volume.Size * price_per_gb,
+        ))
+    if not rows:
+        return None
+    logger.warning("%s volumes attached to stopped instances found in %s", len(rows), region)
+    return pd.DataFrame(rows, columns=["VolumeId", "InstanceId", "StoppedDays", "Savings"])
+
 
-    
 def get_unused_volume_savings(profile, regions):
     """
     Function to get the potential savings from unused EBS volumes
@@ -59,174 +184,126 @@ def get_unused_volume_savings(profile, regions):
         regions (list): List of AWS regions
 
     Returns:
-        dict: Dictionary of unused EBS volumes and their potential savings
-    """
-
-    def get_unused_volumes_and_savings(volumes, region):
-        '''
-        Get a dictionary of unused EBS volumes and their potential savings
-
-        Args:
-            profile (str): AWS profile name
-            region (str): AWS region
-
-        Returns:
-            EbsVolumes: EbsVolumes object
-        '''
-        ebs_volumes = volumes.get_volumes(region)
-        unused_volumes = {}
-        if ebs_volumes:
-            for ebs in ebs_volumes['Volumes']:
-                volume_id = ebs['VolumeId']
-                if not ebs['Attachments']:
-                    volume_type = ebs['VolumeType']
-                    volume_size = ebs['Size']
-                    # Default to 0.1 USD per GB if price not found
-                    price_per_gb = volumes.volume_pricing.get(volume_type, 0.1)
-                    savings = volume_size * price_per_gb
-                    unused_volumes[volume_id] = savings
-            return unused_volumes  # Return the EbsVolumes object
-        else:
-            pass
-            return None
-        
-    def get_unused_volumes_in_region(profile, regions):
-        """
-        Function to create the dictionary of EbsVolumes objects
-
-        Args:
-            profile (str): AWS profile name
-            regions (list): List of AWS regions
-
-        Returns:
-            dict: Dictionary of EbsVolumes objects
-        """
-
-        logger.info("Getting list of EBS volumes...")
-        region_potential_savings = {}
-        for region in regions:
-            try:
-                logger.info("Checking for volumes in {}...".format(region))
-                all_volumes = EbsVolumes(profile, region)
-                unused_volumes = get_unused_volumes_and_savings(all_volumes, region)
-                if unused_volumes:
-                    logger.warning("Unused volumes: {}".format(unused_volumes))
-                    region_potential_savings[region] = unused_volumes
-                else:
-                    logger.info(f"{region}: No volumes found.")
-            except Exception as e:
-                logger.error(f"Error occurred in {region}: {str(e)}", exc_info=True)
-        return region_potential_savings
-
-
-
-
-    ebs_volumes_list = get_unused_volumes_in_region(profile, regions)
-    savings = {}
+        dict: Dictionary of region to a frame of unused VolumeIds and their monthly Savings
+    """
+    logger.info("Getting list of EBS volumes...")
     unused_potential_savings = {}
-    
-    for region, ebs_volumes in ebs_volumes_list.items():
-        unused_volumes = ebs_volumes_list[region]
-        for volume in unused_volumes.items():
-            volume_id = volume[0]
-            savings = volume[1]
-            
-            savings = {
-                "VolumeId" : volume_id, 
-                "Savings" : float(savings)
-                }
-            try:
-                logger.debug("Mapping Unused Volume: {} to savings: {}".format(volume_id, savings))
-                if not region in unused_potential_savings:
-                    unused_potential_savings[region] = []
-                unused_potential_savings[region].insert(len(unused_potential_savings[region]), savings)
-            except Exception as e:
-                logger.error(f"Error Occurred: {str(e)}", exc_info=True)
+    for region in regions:
+        try:
+            savings = get_region_unused_volume_savings(profile, region)
+            if savings is not None:
+                unused_potential_savings[region] = savings
+        except Exception as e:
+            logger.error("Error occurred in %s: %s", region, e, exc_info=True)
     return unused_potential_savings
-    
+
+
+def build_ebs_region_frame(region, results):
+    """
+    Build the volume report rows of one region
+
+    A volume reported by a FULL_COST_FINDINGS analyzer keeps its other
+    findings, but with no savings, so the region total counts it once.
+
+    Args:
+        region (str): AWS region
+        results (dict): Dictionary with the 'unused', 'gp2' and 'stopped' results of the region,
+                        each a frame of VolumeId and Savings
+
+    Returns:
+        pandas.DataFrame: Report rows with the EBS_REPORT_SCHEMA columns, or None if there are no findings
+    """
+    import pandas as pd
+
+    full_cost_volumes = {}
+    for name in FULL_COST_FINDINGS:
+        savings = results.get(name)
+        if savings is not None:
+            full_cost_volumes.update(dict.fromkeys(savings['VolumeId'], EBS_FINDINGS[name]))
+
+    frames = []
+    for name, finding in EBS_FINDINGS.items():
+        savings = results.get(name)
+        if savings is None or not len(savings):
+            continue
+        monthly_savings = savings['Savings'].astype(float)
+        findings = pd.Series(finding, index=savings.index, dtype=object)
+        if name not in FULL_COST_FINDINGS and full_cost_volumes:
+            counted_in = savings['VolumeId'].map(full_cost_volumes)
+            overlap = counted_in.notna()
+            monthly_savings = monthly_savings.mask(overlap, 0.0)
+            findings = findings.mask(overlap, finding + counted_in.map(OVERLAP_FINDING_SUFFIX.format, na_action='ignore'))
+        frames.append(pd.DataFrame({
+            "Region": region,
+            "ResourceType": "EBS Volume",
+            "VolumeId": savings['VolumeId'],
+            "Findings": findings,
+            "MonthlySavings": monthly_savings,
+        }))
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def build_ebs_total_frame(region, total):
+    """
+    Build the total row of the volume report
+
+    Args:
+        region (str): AWS region of a region total, None for the grand total
+        total (float): Total monthly savings
+
+    Returns:
+        pandas.DataFrame: One report row with the EBS_REPORT_SCHEMA columns
+    """
+    import pandas as pd
+
+    return pd.DataFrame({
+        "Region": [region if region is not None else "Total Savings"],
+        "ResourceType": "EBS Volume",
+        "VolumeId": "",
+        "Findings": "Region Total" if region is not None else "",
+        "MonthlySavings": float(total),
+    })
 
 
 def create_ebs_dataframe(dataframe):
     """
     Function to create the dataframe of EBSVolumes objects
 
+    Every finding keeps its MonthlySavings as a number. The findings of each
+    region are followed by a total row for the region, and the report ends with
+    the grand total.
+
     Args:
-        dataframe (dict): Dictionary of EBSVolumes objects
+        dataframe (dict): Dictionary with the 'unused', 'gp2' and 'stopped' results, each a
+                          dictionary of region to a frame of VolumeId and Savings
 
     Returns:
         pandas.DataFrame: Dataframe of EBSVolumes objects
     """
-    logger.info("Creating dataframe...")
-    unused = dataframe['unused']
-    gp2 = dataframe['gp2']
+    import pandas as pd
+
     logger.info("Generating report...")
-    has_data = False
-    if not unused and not gp2:
+    regions = []
+    for name in EBS_FINDINGS:
+        regions.extend(region for region in dataframe.get(name, {}) if region not in regions)
+
+    frames = []
+    total = 0.0
+    for region in regions:
+        region_frame = build_ebs_region_frame(
+            region, {name: dataframe.get(name, {}).get(region) for name in EBS_FINDINGS})
+        if region_frame is None:
+            continue
+        region_total = region_frame["MonthlySavings"].sum()
+        frames.extend([region_frame, build_ebs_total_frame(region, region_total)])
+        total += region_total
+
+    if not frames:
         logger.warning("No data to create dataframe.")
         return None
 
-    # Create a list of dictionaries for unused volumes
-    ebs_volumes_list = []
-    logger.info("Creating Unused Volumes dataframe...")
-    total_savings = 0  # Initialize total savings
-    for region, ebs_volumes in unused.items():
-        has_data = True
-        logger.debug("Region: {}".format(region))
-        logger.debug("Transforming data: {}...".format(ebs_volumes))
-        for volume in ebs_volumes:
-            ebs_volume_data = {
-                "Region": region,
-                "ResourceType": "EBS Volume",
-                "VolumeId": volume['VolumeId'],
-                "Findings": "Unused EBS Volume",
-                "MonthlySavings": f"${volume['Savings']/2:.2f}"
-            }
-            logger.debug("Transformed data: {}".format(ebs_volume_data))
-            ebs_volumes_list.append(ebs_volume_data)
-            total_savings += volume['Savings'] # Add savings to the total
-            
-
-    # Create a list of dictionaries for gp2 to gp3 savings
-    gp2_to_gp3_list = []
-    logger.info("Creating GP2 to GP3 Savings dataframe...")
-    for region, gp2_to_gp3_savings_dict in gp2.items():
-        for volume_id, estimated_savings in gp2_to_gp3_savings_dict.items():
-            has_data = True
-            logger.debug("Region: {}".format(region))
-            logger.debug("Transforming data: {}...".format(gp2_to_gp3_savings_dict))
-            gp2_to_gp3_data = {
-                "Region": region,
-                "ResourceType": "EBS Volume",
-                "VolumeId": volume_id,
-                "Findings": "GP2 to GP3 Savings",
-                "MonthlySavings": f"${estimated_savings:.2f}"
-            }
-            logger.debug("Transformed data: {}".format(gp2_to_gp3_data))
-            gp2_to_gp3_list.append(gp2_to_gp3_data)
-            total_savings += estimated_savings # Add savings to the total
-
-    # Combine the two lists
-    logger.info("combining lists...")
-    combined_list = ebs_volumes_list + gp2_to_gp3_list
-    logger.debug('Combined list: {}'.format(combined_list))
-
-    # Add a row for the total savings
-    total_savings_row = {
-        "Region": "Total Savings",
-        "ResourceType": "EBS Volume",
-        "VolumeId": "",
-        "Findings": "",
-        "MonthlySavings": f"${total_savings:.2f}"
-    }
-    logger.info("Adding total savings row...")
-    logger.debug("Total savings row: {}".format(total_savings_row))
-    combined_list.append(total_savings_row)
-
-    logger.info("Transform data into dataframe...")
-    
-    if(has_data):
-        ebs_volumes_dataframe = pd.DataFrame(combined_list)
-    else:
-        ebs_volumes_dataframe = None
-    
-    return ebs_volumes_dataframe
\ No newline at end of file
+    logger.info("Adding total savings rows...")
+    frames.append(build_ebs_total_frame(None, total))
+    return pd.concat(frames, ignore_index=True)
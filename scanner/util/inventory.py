@@ -0,0 +1,352 @@
+import threading
+from concurrent.futures import Future
+import scanner.util.logger as log
+from scanner.util.aws_functions import (
+    get_ebs_volumes,
+    get_ebs_snapshots,
+    get_image_snapshot_ids,
+    get_ec2_instances,
+    normalize_volume_filters,
+    plan_volume_fetches,
+    volume_filters_cover,
+    volume_matches_filters,
+    VOLUME_FILTER_FIELDS,
+)
+from scanner.util.metrics import timed
+
+
+logger = log.get_logger()
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+# EC2 accepts up to 200 values in a describe_volumes filter. Looking volume or instance ids up takes
+# one call per chunk, so past VOLUME_ID_LOOKUP_MAX_CALLS chunks the whole inventory is fetched instead.
+VOLUME_ID_FILTER_LIMIT = 200
+VOLUME_ID_LOOKUP_MAX_CALLS = 20
+
+# Normalized filters of a fetch returning every volume attached to an instance
+IN_USE_VOLUME_FILTERS = {'status': ('in-use',)}
+
+
+class RegionInventory:
+    '''
+    Per-run inventory of the EBS resources in a single region
+
+    Every resource type is fetched from AWS at most once and the result is
+    shared by all analyzers working on the region. Analyzers register the
+    volume filters they need up front, so only candidate volumes are fetched.
+
+    Each resource type has its own lock, and volume fetches run outside the
+    state lock with a future per fetch, so analyzers waiting on different
+    resources of a region fetch them in parallel.
+    '''
+
+    def __init__(self, profile, region):
+        '''
+        Initialise the class
+
+        Args:
+            profile (str): AWS profile name
+            region (str): AWS region
+        '''
+        self.profile = profile
+        self.region = region
+        self._volumes = {}
+        self._volume_needs = []
+        self._fetched_volume_needs = []
+        self._volume_fetches = []
+        self._volume_frame = None
+        self._existing_volume_ids = set()
+        self._missing_volume_ids = set()
+        self._snapshots = None
+        self._image_snapshot_ids = None
+        self._stopped_instances = None
+        self._lock = threading.Lock()
+        self._snapshots_lock = threading.Lock()
+        self._image_snapshot_ids_lock = threading.Lock()
+        self._stopped_instances_lock = threading.Lock()
+
+    def require_volumes(self, filters=None):
+        '''
+        Register the volumes an analyzer will ask for, before anything is fetched
+
+        Args:
+            filters (dict): Dictionary of describe_volumes filter name to accepted values,
+                            None for every volume
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._volume_needs.append(normalize_volume_filters(filters))
+
+    def _fetch_volumes(self, need):
+        with self._lock:
+            # Fetches already in flight may hold volumes this need asks for, so they are waited on too
+            in_flight = [future for _, future in self._volume_fetches]
+            covered = self._fetched_volume_needs + [other for needs, _ in self._volume_fetches for other in needs]
+            pending = [
+                other for other in self._volume_needs + [need]
+                if not any(volume_filters_cover(fetched, other) for fetched in covered)
+            ]
+            self._volume_needs = []
+            if pending:
+                plans = plan_volume_fetches(pending, covered)
+                fetch = (pending, Future())
+                self._volume_fetches.append(fetch)
+
+        if pending:
+            try:
+                volumes = []
+                for plan in plans:
+                    logger.info("Fetching volume inventory for %s with filters %s...", self.region, plan)
+                    with timed("fetch_volumes", self.region):
+                        volumes.extend(get_ebs_volumes(self.profile, self.region, filters=plan))
+            except Exception as e:
+                # The needs stay registered, so the next analyzer asking for volumes fetches them again
+                with self._lock:
+                    self._volume_fetches.remove(fetch)
+                    self._volume_needs.extend(pending)
+                fetch[1].set_exception(e)
+                raise
+            with self._lock:
+                for volume in volumes:
+                    self._volumes.setdefault(volume.VolumeId, volume)
+                self._fetched_volume_needs.extend(pending)
+                self._volume_fetches.remove(fetch)
+                self._volume_frame = None
+            fetch[1].set_result(None)
+
+        for future in in_flight:
+            future.result()
+
+    def get_volumes(self, filters=None):
+        '''
+        Get the EBS volumes in the region, fetching them on first use
+
+        Args:
+            filters (dict): Dictionary of describe_volumes filter name to accepted values,
+                            None for every volume
+
+        Returns:
+            list: List of VolumeRecord
+        '''
+        need = normalize_volume_filters(filters)
+        self._fetch_volumes(need)
+        with self._lock:
+            return [volume for volume in self._volumes.values() if volume_matches_filters(volume, need)]
+
+    def get_volume_frame(self, filters=None):
+        '''
+        Get the EBS volumes in the region as a typed columnar frame, built on first use
+
+        Args:
+            filters (dict): Dictionary of describe_volumes filter name to accepted values,
+                            None for every volume
+
+        Returns:
+            pandas.DataFrame: One row per volume with the Region, VolumeId, VolumeType,
+                              Size (GB), State and Attached columns
+        '''
+        import numpy as np
+        import pandas as pd
+
+        need = normalize_volume_filters(filters)
+        self._fetch_volumes(need)
+        with self._lock:
+            if self._volume_frame is None:
+                volumes = list(self._volumes.values())
+                self._volume_frame = pd.DataFrame({
+                    'Region': pd.Categorical([self.region] * len(volumes)),
+                    'VolumeId': [volume.VolumeId for volume in volumes],
+                    'VolumeType': pd.Categorical([volume.VolumeType for volume in volumes]),
+                    'Size': np.fromiter((volume.Size for volume in volumes), dtype=np.int64, count=len(volumes)),
+                    'State': pd.Categorical([volume.State for volume in volumes]),
+                    'Attached': np.fromiter((volume.Attached for volume in volumes), dtype=bool, count=len(volumes)),
+                })
+            frame = self._volume_frame
+
+        if need is None:
+            return frame
+        mask = np.ones(len(frame), dtype=bool)
+        for name, values in need.items():
+            mask &= frame[VOLUME_FILTER_FIELDS[name]].isin(values).to_numpy()
+        return frame[mask]
+
+    def get_snapshots(self):
+        '''
+        Get the EBS snapshots owned by the account in the region, fetching them on first use
+
+        Args:
+            None
+
+        Returns:
+            list: List of SnapshotRecord
+        '''
+        with self._snapshots_lock:
+            if self._snapshots is None:
+                logger.info("Fetching snapshot inventory for %s...", self.region)
+                with timed("fetch_snapshots", self.region):
+                    self._snapshots = list(get_ebs_snapshots(self.profile, self.region))
+            return self._snapshots
+
+    def get_existing_volume_ids(self, volume_ids):
+        '''
+        Check which of the given volumes still exist in the region
+
+        Volumes already in the inventory are answered from it, the others are
+        looked up with volume-id filters, so the filtered fetches planned for
+        the analyzers are kept. When that would take more than
+        VOLUME_ID_LOOKUP_MAX_CALLS calls the whole volume inventory is fetched.
+
+        Args:
+            volume_ids (iterable): Volume ids, e.g. the source volumes of the snapshots
+
+        Returns:
+            frozenset: The volume ids that exist
+        '''
+        volume_ids = {volume_id for volume_id in volume_ids if volume_id}
+        with self._lock:
+            unknown = sorted(volume_ids - self._volumes.keys() - self._existing_volume_ids - self._missing_volume_ids)
+            fetched_all = None in self._fetched_volume_needs
+        if not fetched_all:
+            if len(unknown) > VOLUME_ID_FILTER_LIMIT * VOLUME_ID_LOOKUP_MAX_CALLS:
+                self._fetch_volumes(None)
+            elif unknown:
+                self._lookup_volume_ids(unknown)
+        with self._lock:
+            if None in self._fetched_volume_needs:
+                return frozenset(volume_id for volume_id in volume_ids if volume_id in self._volumes)
+            return frozenset(
+                volume_id for volume_id in volume_ids
+                if volume_id in self._volumes or volume_id in self._existing_volume_ids
+            )
+
+    def _lookup_volume_ids(self, volume_ids):
+        logger.info("Looking up %s snapshot source volumes in %s...", len(volume_ids), self.region)
+        found = set()
+        with timed("fetch_volumes", self.region):
+            for start in range(0, len(volume_ids), VOLUME_ID_FILTER_LIMIT):
+                chunk = volume_ids[start:start + VOLUME_ID_FILTER_LIMIT]
+                found.update(volume.VolumeId for volume in get_ebs_volumes(self.profile, self.region, filters={'volume-id': chunk}))
+        with self._lock:
+            self._existing_volume_ids.update(found.intersection(volume_ids))
+            self._missing_volume_ids.update(set(volume_ids) - found)
+
+    def get_instance_volumes(self, instance_ids):
+        '''
+        Get the EBS volumes attached to the given instances
+
+        Volumes are answered from the inventory when a fetch already returned
+        every in-use volume, otherwise they are looked up with
+        attachment.instance-id filters, so regions without candidate instances
+        never download their in-use volumes.
+
+        Args:
+            instance_ids (iterable): Instance ids, e.g. the long-stopped instances
+
+        Returns:
+            list: List of VolumeRecord attached to at least one of the instances
+        '''
+        instance_ids = sorted(set(instance_ids))
+        if not instance_ids:
+            return []
+        with self._lock:
+            if any(volume_filters_cover(fetched, IN_USE_VOLUME_FILTERS) for fetched in self._fetched_volume_needs):
+                wanted = set(instance_ids)
+                return [volume for volume in self._volumes.values() if wanted.intersection(volume.InstanceIds)]
+
+        logger.info("Looking up the volumes of %s instances in %s...", len(instance_ids), self.region)
+        volumes = {}
+        with timed("fetch_volumes", self.region):
+            for start in range(0, len(instance_ids), VOLUME_ID_FILTER_LIMIT):
+                chunk = instance_ids[start:start + VOLUME_ID_FILTER_LIMIT]
+                for volume in get_ebs_volumes(self.profile, self.region, filters={'attachment.instance-id': chunk}):
+                    volumes.setdefault(volume.VolumeId, volume)
+        return list(volumes.values())
+
+    def get_image_snapshot_ids(self):
+        '''
+        Get the ids of the snapshots backing the AMIs owned by the account, fetching them on first use
+
+        Args:
+            None
+
+        Returns:
+            frozenset: Snapshot ids
+        '''
+        with self._image_snapshot_ids_lock:
+            if self._image_snapshot_ids is None:
+                logger.info("Fetching AMI inventory for %s...", self.region)
+                with timed("fetch_images", self.region):
+                    self._image_snapshot_ids = frozenset(get_image_snapshot_ids(self.profile, self.region))
+            return self._image_snapshot_ids
+
+    def get_stopped_instances(self):
+        '''
+        Get the stopped EC2 instances in the region, fetching them on first use
+
+        Args:
+            None
+
+        Returns:
+            dict: Dictionary of instance id to InstanceRecord
+        '''
+        with self._stopped_instances_lock:
+            if self._stopped_instances is None:
+                logger.info("Fetching stopped instances for %s...", self.region)
+                with timed("fetch_instances", self.region):
+                    self._stopped_instances = {
+                        instance.InstanceId: instance
+                        for instance in get_ec2_instances(self.profile, self.region, states=['stopped'])
+                        if instance.State == 'stopped'
+                    }
+            return self._stopped_instances
+
+
+def get_inventory(profile, region):
+    '''
+    Get the shared inventory for the given profile and region
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        RegionInventory: Inventory of the region
+    '''
+    with _inventories_lock:
+        key = (profile, region)
+        if key not in _inventories:
+            _inventories[key] = RegionInventory(profile, region)
+        return _inventories[key]
+
+
+def release_inventory(profile, region):
+    '''
+    Drop the inventory of a region once every analyzer has finished with it
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        None
+    '''
+    with _inventories_lock:
+        _inventories.pop((profile, region), None)
+
+
+def clear_inventories():
+    '''
+    Drop every cached inventory so the next run fetches fresh data
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+    with _inventories_lock:
+        _inventories.clear()
@@ -1,5 +1,26 @@
+import atexit
+import contextlib
+import contextvars
+import json
 import logging
+import logging.handlers
 import os
+import queue
+
+# Log files are rotated once they reach this size, keeping this many old files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Default log level and the formats configure_logger accepts
+DEFAULT_LOG_LEVEL = "INFO"
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_FORMATS = ("text", "json")
+
+# Fields such as the region and phase attached to every record logged in the current context
+_log_context = contextvars.ContextVar("log_context", default={})
+
+# Background listener that writes queued records, replaced on every configure_logger call
+_listener = None
 
 # Custom formatter class to handle color formatting
 class ColoredFormatter(logging.Formatter):
@@ -33,24 +54,113 @@ class ColoredFormatter(logging.Formatter):
         log_message = super().format(record)
         return f"\x1b[{color_code}m{log_message}\x1b[0m"
 
-class FileHandler(logging.Handler):
+
+class JsonFormatter(logging.Formatter):
     '''
-    Custom logging handler that forwards INFO messages to a file
+    Formatter that renders each record as one JSON object per line
 
     Args:
-        logging.Handler (class): Logging handler class
+        logging.Formatter (class): Logging formatter class
+
+    Returns:
+        None
+    '''
+    def format(self, record):
+        '''
+        Format the log record as JSON
+
+        Args:
+            record (logging.LogRecord): Log record
+
+        Returns:
+            str: JSON log line
+        '''
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "region": getattr(record, "region", None),
+            "phase": getattr(record, "phase", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ContextFilter(logging.Filter):
+    '''
+    Filter that copies the fields of the current log context onto each record
+
+    It runs in the thread that logs, before the record is queued for the listener.
+
+    Args:
+        logging.Filter (class): Logging filter class
 
     Returns:
         None
     '''
-    def __init__(self, filename):
-        super().__init__()
-        self.filename = filename
+    def filter(self, record):
+        for name, value in _log_context.get().items():
+            setattr(record, name, value)
+        return True
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    '''
+    Attach fields such as region and phase to every record logged inside the block
+
+    Args:
+        fields (dict): Field names and values
+
+    Yields:
+        None
+    '''
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class FileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Custom logging handler that writes messages to a rotating log file
+
+    The file stays open between records and is only flushed when the
+    listener has drained its queue, so bursts of records share one write.
+
+    Args:
+        logging.handlers.RotatingFileHandler (class): Rotating file handler class
+
+    Returns:
+        None
+    '''
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.size = None
+
+    def _open(self):
+        stream = super()._open()
+        self.size = os.path.getsize(self.baseFilename)
+        return stream
+
+    def shouldRollover(self, record):
+        # Track the size ourselves, telling the position would flush the buffer
+        return self.maxBytes > 0 and self.size is not None and self.size >= self.maxBytes
 
     def emit(self, record):
-        log_message = self.format(record)
-        with open(self.filename, "a") as file:
-            file.write(log_message + "\n")
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            log_message = self.format(record) + self.terminator
+            self.stream.write(log_message)
+            self.size += len(log_message)
+        except Exception:
+            self.handleError(record)
 
 
 class ConsoleHandler(logging.Handler):
@@ -69,16 +179,59 @@ class ConsoleHandler(logging.Handler):
             print(log_message)
 
 
-def configure_logger(log_filename):
+class QueueListener(logging.handlers.QueueListener):
     '''
-    Configure the logger to send logs to the logger.py file
+    Queue listener that flushes its handlers whenever the queue runs empty
+
+    Args:
+        logging.handlers.QueueListener (class): Queue listener class
+
+    Returns:
+        None
+    '''
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def stop_logger():
+    '''
+    Write out every queued record and stop the background listener
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def configure_logger(log_filename, level=DEFAULT_LOG_LEVEL, log_format="text", max_bytes=LOG_MAX_BYTES,
+                     backup_count=LOG_BACKUP_COUNT):
+    '''
+    Configure the logger to queue records for a background listener that
+    writes them to the log file and the console
 
     Args:
         log_filename (str): Log file name
+        level (str): Lowest level that is logged, one of LOG_LEVELS
+        log_format (str): "text" for plain log lines or "json" for JSON lines, one of LOG_FORMATS
+        max_bytes (int): Size at which the log file is rotated, 0 to never rotate
+        backup_count (int): Number of rotated log files to keep
 
     Returns:
         logging.Logger: Logger object
     '''
+    global _listener
     logs_folder = "logs"
     if not os.path.exists(logs_folder):
         os.makedirs(logs_folder)
@@ -91,14 +244,19 @@ def configure_logger(log_filename):
 
     # Create a logger
     logger = logging.getLogger("application_log")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(level)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    stop_logger()
 
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if log_format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-    file_handler = FileHandler(log_filepath)
+    file_handler = FileHandler(log_filepath, max_bytes, backup_count)
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
     console_handler = ConsoleHandler()
     console_handler.setLevel(logging.DEBUG)  # Use DEBUG level for console to show all log levels
@@ -106,7 +264,14 @@ def configure_logger(log_filename):
         "%(asctime)s - %(levelname)s - %(message)s"
     )
     console_handler.setFormatter(color_formatter)
-    logger.addHandler(console_handler)
+
+    # Workers only enqueue records, the listener thread does the I/O
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.addHandler(queue_handler)
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
 
     return logger
 
@@ -122,3 +287,6 @@ def get_logger():
         logging.Logger: Logger object
     '''
     return logging.getLogger("application_log")
+
+
+atexit.register(stop_logger)
@@ -0,0 +1,407 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+import scanner.util.logger as log
+
+
+logger = log.get_logger()
+
+# Error codes AWS returns when a call is throttled
+THROTTLE_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+
+# Latency percentiles reported per API operation
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    '''
+    Get a percentile of a list of numbers using the nearest rank
+
+    Args:
+        values (list): Numbers
+        percent (float): Percentile between 0 and 100
+
+    Returns:
+        float: The percentile, or None if there are no values
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class ScanMetrics:
+    '''
+    Wall time of each phase and region, and statistics of every AWS API operation
+
+    Phases can nest, e.g. fetching volumes happens inside an analyzer, so
+    phase times overlap and do not add up to the run time.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.phases = {}
+        self.regions = {}
+        self.api_calls = {}
+
+    def record_phase(self, phase, seconds, region=None):
+        '''
+        Add the wall time of a phase
+
+        Args:
+            phase (str): Phase name, e.g. 'discovery', 'pricing' or 'report'
+            seconds (float): Wall time in seconds
+            region (str): AWS region the phase ran for, None for the whole run
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            totals = self.phases.setdefault(phase, {'seconds': 0.0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['count'] += 1
+            if region is not None:
+                region_phases = self.regions.setdefault(region, {})
+                region_phases[phase] = region_phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, phase, region=None):
+        '''
+        Record the wall time of the block as a phase
+
+        Args:
+            phase (str): Phase name
+            region (str): AWS region the phase runs for, None for the whole run
+
+        Yields:
+            None
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - start, region)
+
+    def _operation(self, service, operation):
+        return self.api_calls.setdefault((service, operation), {
+            'calls': 0,
+            'errors': 0,
+            'retries': 0,
+            'throttles': 0,
+            'bytes_received': 0,
+            'latencies': [],
+        })
+
+    def record_call(self, service, operation, seconds, retries=0, error=False):
+        '''
+        Add a finished API call, including its retries
+
+        Args:
+            service (str): AWS service name
+            operation (str): API operation name
+            seconds (float): Latency of the call in seconds
+            retries (int): Number of retries
+            error (bool): True if the call failed
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            stats = self._operation(service, operation)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['errors'] += int(error)
+            stats['latencies'].append(seconds)
+
+    def record_response(self, service, operation, bytes_received, throttled):
+        '''
+        Add an HTTP response of an API call attempt
+
+        Args:
+            service (str): AWS service name
+            operation (str): API operation name
+            bytes_received (int): Size of the response body
+            throttled (bool): True if AWS throttled the attempt
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            stats = self._operation(service, operation)
+            stats['bytes_received'] += bytes_received
+            stats['throttles'] += int(throttled)
+
+    def to_dict(self):
+        '''
+        Get the metrics in a JSON serializable form
+
+        Args:
+            None
+
+        Returns:
+            dict: Dictionary with the run time, phases, regions and API operations
+        '''
+        with self._lock:
+            api_calls = []
+            for (service, operation), stats in sorted(self.api_calls.items()):
+                entry = {key: value for key, value in stats.items() if key != 'latencies'}
+                entry.update({'service': service, 'operation': operation})
+                for percent in LATENCY_PERCENTILES:
+                    entry['latency_p{}_ms'.format(percent)] = _milliseconds(percentile(stats['latencies'], percent))
+                api_calls.append(entry)
+            return {
+                'started_at': self.started_at,
+                'run_seconds': time.time() - self.started_at,
+                'phases': {phase: dict(totals) for phase, totals in self.phases.items()},
+                'regions': {region: dict(phases) for region, phases in self.regions.items()},
+                'api_calls': api_calls,
+            }
+
+    def format_summary(self):
+        '''
+        Format the metrics as a human readable summary
+
+        Args:
+            None
+
+        Returns:
+            str: Summary table of the phases, slowest regions and API operations
+        '''
+        data = self.to_dict()
+        lines = ["Run time: {:.2f}s".format(data['run_seconds']), "", "{:<24} {:>10} {:>6}".format("Phase", "Seconds", "Count")]
+        for phase, totals in sorted(data['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("{:<24} {:>10.2f} {:>6}".format(phase, totals['seconds'], totals['count']))
+
+        if data['regions']:
+            lines += ["", "{:<24} {:>10}".format("Region", "Seconds")]
+            region_totals = {region: sum(phases.values()) for region, phases in data['regions'].items()}
+            for region, seconds in sorted(region_totals.items(), key=lambda item: -item[1])[:10]:
+                lines.append("{:<24} {:>10.2f}".format(region, seconds))
+
+        if data['api_calls']:
+            lines += ["", "{:<36} {:>7} {:>7} {:>8} {:>7} {:>7} {:>7} {:>10}".format(
+                "API operation", "Calls", "Retries", "Throttle", "p50 ms", "p90 ms", "p99 ms", "KB")]
+            for entry in data['api_calls']:
+                lines.append("{:<36} {:>7} {:>7} {:>8} {:>7} {:>7} {:>7} {:>10.1f}".format(
+                    "{}.{}".format(entry['service'], entry['operation']),
+                    entry['calls'],
+                    entry['retries'],
+                    entry['throttles'],
+                    _format_ms(entry['latency_p50_ms']),
+                    _format_ms(entry['latency_p90_ms']),
+                    _format_ms(entry['latency_p99_ms']),
+                    entry['bytes_received'] / 1024.0,
+                ))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        '''
+        Write the metrics to a JSON file
+
+        Args:
+            path (str): JSON file path
+
+        Returns:
+            None
+        '''
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        logger.info("Metrics saved as %s", path)
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _format_ms(value):
+    return "-" if value is None else "{:.0f}".format(value)
+
+
+def instrument_client(client):
+    '''
+    Record the latency, retries, throttles and response size of every call made with a client
+
+    Args:
+        client (botocore.client.BaseClient): AWS client
+
+    Returns:
+        None
+    '''
+    service = client.meta.service_model.service_id.hyphenize()
+    events = client.meta.events
+
+    def start_call(context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def finish_call(http_response, parsed, model, context, **kwargs):
+        started = context.get('metrics_started')
+        if started is None:
+            return
+        metadata = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+        error = http_response is not None and http_response.status_code >= 300
+        get_metrics().record_call(
+            service, model.name, time.perf_counter() - started, metadata.get('RetryAttempts', 0), error)
+
+    def fail_call(event_name, context, **kwargs):
+        started = context.get('metrics_started')
+        if started is not None:
+            operation = event_name.rsplit('.', 1)[-1]
+            get_metrics().record_call(service, operation, time.perf_counter() - started, error=True)
+
+    def receive_response(event_name, response_dict, parsed_response, **kwargs):
+        # Called for every attempt, so retried and throttled attempts are counted too
+        if response_dict is None:
+            return
+        operation = event_name.rsplit('.', 1)[-1]
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        get_metrics().record_response(service, operation, len(response_dict.get('body') or b''), code in THROTTLE_CODES)
+
+    events.register('before-parameter-build.{}'.format(service), start_call)
+    events.register('after-call.{}'.format(service), finish_call)
+    events.register('after-call-error.{}'.format(service), fail_call)
+    events.register('response-received.{}'.format(service), receive_response)
+
+
+_metrics = ScanMetrics()
+
+# From Python 3.12 cProfile is built on sys.monitoring, which allows one active profiler
+# per process and reports the calls of every thread to it
+PROFILER_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+# Profiles of the main thread and every profiled worker task, None when profiling is off
+_profiles = None
+_profiles_lock = threading.Lock()
+
+
+def get_metrics():
+    '''
+    Get the metrics of the current run
+
+    Args:
+        None
+
+    Returns:
+        ScanMetrics: Shared metrics
+    '''
+    return _metrics
+
+
+def reset_metrics():
+    '''
+    Start recording metrics for a new run
+
+    Args:
+        None
+
+    Returns:
+        ScanMetrics: The new shared metrics
+    '''
+    global _metrics
+    _metrics = ScanMetrics()
+    return _metrics
+
+
+def timed(phase, region=None):
+    '''
+    Record the wall time of a block as a phase of the current run
+
+    Args:
+        phase (str): Phase name
+        region (str): AWS region the phase runs for, None for the whole run
+
+    Returns:
+        contextlib.AbstractContextManager: Context manager timing the block
+    '''
+    return get_metrics().timed(phase, region)
+
+
+def start_profiling():
+    '''
+    Profile every call made through profile_call and profile_task from now on
+
+    Before Python 3.12 cProfile only sees the thread it runs in, so each worker
+    task gets its own profiler and the profiles are merged when they are saved.
+    From 3.12 the profiler of the run sees the workers too, and a second
+    profiler could not be started while it runs.
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+    global _profiles
+    with _profiles_lock:
+        _profiles = []
+
+
+def profile_call(function, *args):
+    '''
+    Call a function under its own profiler when profiling is on
+
+    Args:
+        function (function): Function to call
+        args: Arguments of the function
+
+    Returns:
+        The result of the function
+    '''
+    if _profiles is None:
+        return function(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        with _profiles_lock:
+            _profiles.append(profiler)
+
+
+def profile_task(function, *args):
+    '''
+    Call a worker task under its own profiler when profiling is on and cProfile only sees one thread
+
+    Args:
+        function (function): Function to call
+        args: Arguments of the function
+
+    Returns:
+        The result of the function
+    '''
+    if PROFILER_SEES_ALL_THREADS:
+        return function(*args)
+    return profile_call(function, *args)
+
+
+def save_profile(path):
+    '''
+    Merge the recorded profiles and write them in pstats format
+
+    Args:
+        path (str): Profile file path, readable with python -m pstats
+
+    Returns:
+        None
+    '''
+    with _profiles_lock:
+        profiles = list(_profiles or [])
+    if not profiles:
+        return
+    stats = pstats.Stats(profiles[0])
+    for profiler in profiles[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+    logger.info("Profile of %s threads saved as %s", len(profiles), path)
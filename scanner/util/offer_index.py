@@ -0,0 +1,395 @@
+import bisect
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import scanner.util.logger as log
+from scanner.util.cache import get_cache_path
+
+
+logger = log.get_logger()
+
+VOLUME_USAGE_PREFIX = 'EBS:VolumeUsage.'
+SNAPSHOT_USAGE_TYPE = 'EBS:SnapshotUsage'
+
+# Index layout: magic, record count, then fixed-width records sorted by key
+INDEX_MAGIC = b'EBSIDX01'
+INDEX_HEADER = struct.Struct('<8sI')
+INDEX_RECORD = struct.Struct('<32s32sd')
+
+_offline_index_path = None
+_offline_index = None
+_offline_index_lock = threading.Lock()
+
+
+class _JsonStream:
+    '''
+    Minimal incremental JSON reader
+
+    Objects can be walked key by key so that only one child value is decoded
+    at a time, which keeps memory bounded on multi-gigabyte offer files.
+    '''
+
+    def __init__(self, infile, chunk_size=1 << 20):
+        self.infile = infile
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.infile.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expected '{}' at offset {}".format(char, self.pos))
+        self.pos += 1
+
+    def read_value(self):
+        '''
+        Decode the next complete JSON value
+        '''
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value is only complete once the delimiter after it has been read,
+                # otherwise a number split across two chunks would be cut short
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in ' \t\r\n,:}]'):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_object(self):
+        '''
+        Walk the object at the current position, yielding each key
+
+        The caller must consume the value of every key before moving on.
+        '''
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(':')
+            yield key
+            char = self._peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("Expected ',' or '}}' at offset {}".format(self.pos))
+
+    def skip_value(self, depth=2):
+        '''
+        Skip the value at the current position, walking the top levels of
+        large objects instead of decoding them whole
+        '''
+        if depth and self._peek() == '{':
+            for _ in self.iter_object():
+                self.skip_value(depth - 1)
+        else:
+            self.read_value()
+
+
+def _classify_product(product_family, attributes):
+    '''
+    Work out the index usage type of an offer file product
+
+    Args:
+        product_family (str): Product family, e.g. 'Storage'
+        attributes (dict): Product attributes
+
+    Returns:
+        tuple: (region, usage type), or None if the product is not an EBS storage or snapshot SKU
+    '''
+    if attributes.get('locationType', 'AWS Region') != 'AWS Region':
+        return None
+    region = attributes.get('regionCode')
+    if not region:
+        return None
+    if product_family == 'Storage' and attributes.get('volumeApiName'):
+        return region, VOLUME_USAGE_PREFIX + attributes['volumeApiName']
+    if product_family == 'Storage Snapshot' and attributes.get('usagetype', '').endswith(SNAPSHOT_USAGE_TYPE):
+        return region, SNAPSHOT_USAGE_TYPE
+    return None
+
+
+def iter_json_offer_prices(infile, chunk_size=1 << 20):
+    '''
+    Stream-parse an AWS bulk offer file in JSON format
+
+    Args:
+        infile (file): Offer file opened in text mode
+        chunk_size (int): Number of characters read at a time
+
+    Yields:
+        tuple: (region, usage type, price per GB-month)
+    '''
+    stream = _JsonStream(infile, chunk_size)
+    skus = {}
+    for section in stream.iter_object():
+        if section == 'products':
+            for sku in stream.iter_object():
+                product = stream.read_value()
+                classified = _classify_product(product.get('productFamily'), product.get('attributes', {}))
+                if classified:
+                    skus[sku] = classified
+            logger.info("Found %s EBS storage and snapshot SKUs", len(skus))
+        elif section == 'terms':
+            for term_type in stream.iter_object():
+                if term_type != 'OnDemand':
+                    stream.skip_value()
+                    continue
+                for sku in stream.iter_object():
+                    terms = stream.read_value()
+                    if sku not in skus:
+                        continue
+                    for term in terms.values():
+                        for price_dimension in term['priceDimensions'].values():
+                            if price_dimension.get('unit') == 'GB-Mo':
+                                region, usage_type = skus[sku]
+                                yield region, usage_type, float(price_dimension['pricePerUnit']['USD'])
+                                break
+        else:
+            stream.skip_value()
+
+
+def iter_csv_offer_prices(infile):
+    '''
+    Stream-parse an AWS bulk offer file in CSV format
+
+    Args:
+        infile (file): Offer file opened in text mode
+
+    Yields:
+        tuple: (region, usage type, price per GB-month)
+    '''
+    reader = csv.reader(infile)
+    columns = None
+    # The header row follows a few lines of offer metadata
+    for row in reader:
+        if row and row[0] == 'SKU':
+            columns = {name.strip().lower().replace(' ', ''): index for index, name in enumerate(row)}
+            break
+    if columns is None:
+        raise ValueError("No header row found in the CSV offer file")
+
+    def column(row, name):
+        index = columns.get(name)
+        return row[index] if index is not None and index < len(row) else ''
+
+    for row in reader:
+        if column(row, 'termtype') != 'OnDemand' or column(row, 'unit') != 'GB-Mo':
+            continue
+        attributes = {
+            'locationType': column(row, 'locationtype') or 'AWS Region',
+            'regionCode': column(row, 'regioncode'),
+            'volumeApiName': column(row, 'volumeapiname'),
+            'usagetype': column(row, 'usagetype'),
+        }
+        classified = _classify_product(column(row, 'productfamily'), attributes)
+        if classified:
+            region, usage_type = classified
+            yield region, usage_type, float(column(row, 'priceperunit'))
+
+
+def build_offer_index(offer_path, index_path=None):
+    '''
+    Build the compact EBS price index from an AWS bulk offer file
+
+    Args:
+        offer_path (str): Path of the AmazonEC2 offer file (.json or .csv)
+        index_path (str): Path of the index to write, defaults to the cache directory
+
+    Returns:
+        str: Path of the index
+    '''
+    index_path = index_path or get_default_index_path()
+    logger.info("Building EBS price index from %s...", offer_path)
+    prices = {}
+    with open(offer_path, 'r', encoding='utf-8', newline='') as infile:
+        if offer_path.lower().endswith('.csv'):
+            records = iter_csv_offer_prices(infile)
+        else:
+            records = iter_json_offer_prices(infile)
+        for region, usage_type, price in records:
+            prices[(region, usage_type)] = price
+
+    directory = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(prices)))
+            for (region, usage_type), price in sorted(prices.items()):
+                outfile.write(INDEX_RECORD.pack(region.encode(), usage_type.encode(), price))
+        os.replace(tmp_path, index_path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    logger.info("Wrote %s prices to %s", len(prices), index_path)
+    return index_path
+
+
+class OfferIndex:
+    '''
+    Read-only, memory-mapped view of an index written by build_offer_index
+    '''
+
+    def __init__(self, index_path):
+        '''
+        Initialise the class
+
+        Args:
+            index_path (str): Path of the index
+        '''
+        self.index_path = index_path
+        with open(index_path, 'rb') as infile:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError("{} is not an EBS price index".format(index_path))
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, position):
+        region, usage_type, _ = INDEX_RECORD.unpack_from(self._map, INDEX_HEADER.size + position * INDEX_RECORD.size)
+        return region.rstrip(b'\0'), usage_type.rstrip(b'\0')
+
+    def get_price(self, region, usage_type):
+        '''
+        Look up a price with a binary search over the mapped records
+
+        Args:
+            region (str): AWS region
+            usage_type (str): Usage type, e.g. 'EBS:VolumeUsage.gp3'
+
+        Returns:
+            float: Price per GB-month, or None if the index has no entry
+        '''
+        key = (region.encode(), usage_type.encode())
+        keys = _IndexKeys(self)
+        position = bisect.bisect_left(keys, key)
+        if position < self.count and keys[position] == key:
+            return INDEX_RECORD.unpack_from(self._map, INDEX_HEADER.size + position * INDEX_RECORD.size)[2]
+        return None
+
+    def iter_prices(self):
+        '''
+        Iterate over every indexed price
+
+        Yields:
+            tuple: (region, usage type, price per GB-month)
+        '''
+        for position in range(self.count):
+            region, usage_type, price = INDEX_RECORD.unpack_from(
+                self._map, INDEX_HEADER.size + position * INDEX_RECORD.size)
+            yield region.rstrip(b'\0').decode(), usage_type.rstrip(b'\0').decode(), price
+
+    def close(self):
+        self._map.close()
+
+
+class _IndexKeys:
+    '''
+    Sequence view of the index keys used by bisect
+    '''
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, position):
+        return self.index._key(position)
+
+
+def get_default_index_path():
+    '''
+    Get the default location of the EBS price index
+
+    Args:
+        None
+
+    Returns:
+        str: Path of the index
+    '''
+    return get_cache_path('offer-index', 'AmazonEC2-ebs.idx')
+
+
+def set_offline_pricing(offer_path=None, index_path=None):
+    '''
+    Switch the pricing layer to the offline price index
+
+    If an offer file is given, the index is (re)built when it is missing or
+    older than the offer file.
+
+    Args:
+        offer_path (str): Path of an AWS bulk offer file for AmazonEC2
+        index_path (str): Path of the EBS price index
+
+    Returns:
+        None
+    '''
+    global _offline_index_path, _offline_index
+    index_path = index_path or get_default_index_path()
+    if offer_path:
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(offer_path):
+            build_offer_index(offer_path, index_path)
+    _offline_index_path = index_path
+    _offline_index = None
+
+
+def get_offline_index():
+    '''
+    Get the offline price index, if offline pricing is enabled
+
+    Args:
+        None
+
+    Returns:
+        OfferIndex: Price index, or None when prices come from the Pricing API
+    '''
+    global _offline_index
+    if _offline_index_path is None:
+        return None
+    with _offline_index_lock:
+        if _offline_index is None:
+            _offline_index = OfferIndex(_offline_index_path)
+            logger.info("Using offline EBS price index %s (%s prices)", _offline_index_path, len(_offline_index))
+        return _offline_index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python3 -m scanner.util.offer_index OFFER_FILE [INDEX_FILE]")
+        sys.exit(1)
+    log.configure_logger("offer_index.log")
+    print(build_offer_index(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -1,45 +1,45 @@
 import scanner.util.logger as log
 import os
-import pandas as pd
-import time
+import shutil
 import subprocess
-import tkinter as tk
-from tkinter import messagebox
+import sys
 
 logger = log.get_logger()
 
-def save_report_to_csv(input, output_file):
+def save_report_to_csv(input, output_file, report_folder="reports"):
     """
     Function to save the report as a CSV file
 
     Args:
         ebs_volumes_dataframe (DataFrame): DataFrame of EBSVolumes objects
         output_file (str): Output file name
+        report_folder (str): Folder the report is written to
 
     Returns:
-        None
+        str: Path of the CSV report, or None if there was no data
     """
     logger.info("Saving report...")
     if input is None:
         logger.warning("No data to save.")
+        return None
     else:
-        report_folder = "reports"
         if not os.path.exists(report_folder):
             os.makedirs(report_folder)
 
         csv_filepath = os.path.join(report_folder, output_file)
 
-        df = pd.DataFrame(input)
-        df.to_csv(csv_filepath, index=False)
-        logger.info(f"CSV report saved as {csv_filepath}")
+        import pandas as pd
 
-        # Sleep for a few seconds before opening the CSV file
-        time.sleep(5)
+        df = pd.DataFrame(input)
+        # Savings are kept numeric in the dataframes and rounded to cents in the CSV
+        df.to_csv(csv_filepath, index=False, float_format="%.2f")
+        logger.info("CSV report saved as %s", csv_filepath)
+        return csv_filepath
 
 
 def open_file(csv_file_path):
     """
-    Function to open files
+    Function to open files with the default viewer of the platform
 
     Args:
         csv_file_path (str): CSV file path
@@ -49,12 +49,21 @@ def open_file(csv_file_path):
     """
     logger.info("Opening Report...")
     try:
-        subprocess.run(["open", csv_file_path])
+        if sys.platform.startswith("win"):
+            os.startfile(csv_file_path)
+            return
+        command = "open" if sys.platform == "darwin" else "xdg-open"
+        if shutil.which(command) is None:
+            logger.warning("No viewer available to open %s", csv_file_path)
+            return
+        # The viewer is not waited for, it may keep running after the scan
+        subprocess.Popen([command, csv_file_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except Exception as e:
-        logger.error(f"Error occurred while opening files: {str(e)}")
+        logger.error("Error occurred while opening files: %s", e)
 
 
 def clear_log_file(log_file_path):
     """Clear the content of the log file."""
+    os.makedirs(os.path.dirname(log_file_path) or ".", exist_ok=True)
     with open(log_file_path, 'w') as log_file:
         log_file.write("")
\ No newline at end of file
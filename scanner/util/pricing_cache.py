@@ -0,0 +1,206 @@
+import threading
+import time
+import scanner.util.logger as log
+from scanner.util.cache import get_cache_path, read_json_cache, write_json_cache
+
+
+logger = log.get_logger()
+
+# Prices rarely change, so cached entries are trusted for a week
+PRICING_CACHE_TTL = 7 * 24 * 60 * 60
+
+
+class PricingCache:
+    '''
+    Persistent store of parsed prices keyed by (service, region, usage type)
+
+    Entries hold the price per unit as a float, so loading the cache does not
+    require re-parsing any product JSON. Writes are atomic and merge with
+    entries saved by other processes in the meantime.
+    '''
+
+    def __init__(self, path=None, ttl=PRICING_CACHE_TTL):
+        '''
+        Initialise the class
+
+        Args:
+            path (str): Path of the cache file, defaults to pricing.json in the cache directory
+            ttl (float): Seconds an entry stays fresh
+        '''
+        self.path = path or get_cache_path("pricing.json")
+        self.ttl = ttl
+        # Entries fetched before this time are refreshed whatever their age, None to trust the TTL
+        self.refresh_before = None
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(service, region, usage_type):
+        '''
+        Build the key of a cache entry
+
+        Args:
+            service (str): AWS service code, e.g. 'AmazonEC2'
+            region (str): AWS region
+            usage_type (str): Usage type without the region prefix, e.g. 'EBS:SnapshotUsage'
+
+        Returns:
+            str: Cache key
+        '''
+        return "|".join((service, region, usage_type))
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = read_json_cache(self.path) or {}
+            logger.debug("Loaded %s cached prices from %s", len(self._entries), self.path)
+        return self._entries
+
+    def is_fresh(self, entry):
+        '''
+        Check whether a cache entry can be used without refreshing it
+
+        Args:
+            entry (dict): Cache entry
+
+        Returns:
+            bool: True if the entry is fresh
+        '''
+        if self.refresh_before is not None and entry["fetched_at"] < self.refresh_before:
+            return False
+        return self.ttl is None or time.time() - entry["fetched_at"] <= self.ttl
+
+    def get(self, service, region, usage_type, allow_expired=False):
+        '''
+        Get a cached price
+
+        Args:
+            service (str): AWS service code
+            region (str): AWS region
+            usage_type (str): Usage type
+            allow_expired (bool): Return the price even if the entry is stale
+
+        Returns:
+            float: Price per unit, or None if there is no usable entry
+        '''
+        with self._lock:
+            entry = self._load().get(self.make_key(service, region, usage_type))
+            if entry is None:
+                return None
+            if not allow_expired and not self.is_fresh(entry):
+                return None
+            return entry["price"]
+
+    def find(self, service, usage_prefix, region=None, allow_expired=False):
+        '''
+        Get every cached price whose usage type starts with the given prefix
+
+        Args:
+            service (str): AWS service code
+            usage_prefix (str): Start of the usage type, e.g. 'EBS:VolumeUsage.'
+            region (str): Only return entries for this region, None for every region
+            allow_expired (bool): Include stale entries
+
+        Returns:
+            dict: Dictionary of (region, usage type) to price per unit
+        '''
+        prices = {}
+        with self._lock:
+            for key, entry in self._load().items():
+                entry_service, entry_region, usage_type = key.split("|", 2)
+                if entry_service != service or not usage_type.startswith(usage_prefix):
+                    continue
+                if region is not None and entry_region != region:
+                    continue
+                if allow_expired or self.is_fresh(entry):
+                    prices[(entry_region, usage_type)] = entry["price"]
+        return prices
+
+    def put(self, service, region, usage_type, price, unit=None):
+        '''
+        Store a price in the cache
+
+        Args:
+            service (str): AWS service code
+            region (str): AWS region
+            usage_type (str): Usage type
+            price (float): Price per unit in USD
+            unit (str): Pricing unit, e.g. 'GB-Mo'
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._load()[self.make_key(service, region, usage_type)] = {
+                "price": float(price),
+                "unit": unit,
+                "fetched_at": time.time(),
+            }
+            self._dirty = True
+
+    def save(self):
+        '''
+        Write the cache to disk if it changed
+
+        Entries written by other processes since the cache was loaded are kept
+        unless this cache holds a newer version of them.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = read_json_cache(self.path) or {}
+            for key, entry in self._entries.items():
+                if key not in entries or entries[key]["fetched_at"] < entry["fetched_at"]:
+                    entries[key] = entry
+            try:
+                write_json_cache(self.path, entries)
+            except OSError as e:
+                logger.warning("Unable to save the pricing cache to %s: %s", self.path, e)
+                return
+            self._entries = entries
+            self._dirty = False
+            logger.debug("Saved %s prices to %s", len(entries), self.path)
+
+
+_pricing_cache = None
+_pricing_cache_lock = threading.Lock()
+
+
+def get_pricing_cache():
+    '''
+    Get the pricing cache shared by the whole run
+
+    Args:
+        None
+
+    Returns:
+        PricingCache: Pricing cache
+    '''
+    global _pricing_cache
+    with _pricing_cache_lock:
+        if _pricing_cache is None:
+            _pricing_cache = PricingCache()
+        return _pricing_cache
+
+
+def configure_pricing_cache(ttl=None, refresh=False):
+    '''
+    Change how the shared pricing cache is used
+
+    Args:
+        ttl (float): Seconds an entry stays fresh, None to keep the default
+        refresh (bool): Fetch every price again once, ignoring the entries cached so far
+
+    Returns:
+        None
+    '''
+    cache = get_pricing_cache()
+    if ttl is not None:
+        cache.ttl = ttl
+    cache.refresh_before = time.time() if refresh else None
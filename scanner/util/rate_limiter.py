@@ -0,0 +1,302 @@
+import random
+import threading
+import time
+import scanner.util.logger as log
+from scanner.util.metrics import THROTTLE_CODES
+
+
+logger = log.get_logger()
+
+# Sustained requests per second and burst size of each API, by 'service.Operation' or service.
+# EC2 refills describe calls at 20 per second with a bucket of 100 per account and region,
+# the Pricing API allows about 10 calls per second per account and the EBS direct API
+# lists changed blocks at 50 calls per second per account and region.
+RATE_LIMITS = {
+    'ec2': (20.0, 100),
+    'pricing': (10.0, 10),
+    'ebs.ListChangedBlocks': (50.0, 50),
+}
+DEFAULT_RATE_LIMIT = (10.0, 20)
+
+# The rate of a bucket is multiplied by THROTTLE_BACKOFF when AWS throttles a call,
+# at most once per THROTTLE_COOLDOWN seconds, and never goes below MIN_RATE
+THROTTLE_BACKOFF = 0.5
+THROTTLE_COOLDOWN = 1.0
+MIN_RATE = 0.5
+
+# Share of the configured rate recovered by each successful call
+RATE_RECOVERY = 0.02
+
+# Retries of a whole region task once botocore has given up on a throttled call
+REGION_RETRY_ATTEMPTS = 3
+REGION_RETRY_BASE_DELAY = 2.0
+REGION_RETRY_MAX_DELAY = 30.0
+
+
+class TokenBucket:
+    '''
+    Token bucket whose rate adapts to throttling
+
+    Tokens refill continuously at the current rate up to the burst size.
+    A throttled call halves the rate and empties the bucket, and every
+    successful call adds back a little of the configured rate, so the
+    request rate settles just below the limit AWS actually enforces.
+
+    Args:
+        rate (float): Configured requests per second
+        burst (int): Maximum number of requests sent back to back
+    '''
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.throttles = 0
+        self._updated = time.monotonic()
+        self._last_throttle = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        '''
+        Take a token, waiting until one is available
+
+        The token is reserved under the lock and the wait happens outside it,
+        so waiting callers are served in order without holding each other up.
+
+        Args:
+            None
+
+        Returns:
+            float: Seconds waited
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        '''
+        Slow down after AWS throttled a call
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            # Calls sent before the last slow down come back throttled too, only react once to them
+            if now - self._last_throttle < THROTTLE_COOLDOWN:
+                return
+            self._last_throttle = now
+            self._refill(now)
+            self.rate = max(self.rate * THROTTLE_BACKOFF, MIN_RATE)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        '''
+        Speed back up towards the configured rate after a successful call
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+
+class RateLimiter:
+    '''
+    Token buckets of every account, region and API operation of a run
+
+    Accounts are told apart by their profile name.
+    '''
+    def __init__(self, limits=None):
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, profile, region, service, operation):
+        '''
+        Get the bucket of an API operation, creating it on first use
+
+        Args:
+            profile (str): AWS profile name
+            region (str): AWS region
+            service (str): AWS service name, e.g. 'ec2'
+            operation (str): API operation name, e.g. 'DescribeVolumes'
+
+        Returns:
+            TokenBucket: Bucket of the operation
+        '''
+        key = (profile, region, '{}.{}'.format(service, operation))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    rate, burst = self.limits.get(key[2]) or self.limits.get(service) or DEFAULT_RATE_LIMIT
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def get_rates(self):
+        '''
+        Get the current rate of every bucket
+
+        Args:
+            None
+
+        Returns:
+            dict: Dictionary of 'profile/region/service.Operation' to requests per second
+        '''
+        with self._lock:
+            return {'/'.join(str(part) for part in key): bucket.rate for key, bucket in self._buckets.items()}
+
+
+_rate_limiter = RateLimiter()
+
+
+def get_rate_limiter():
+    '''
+    Get the rate limiter shared by every client of the run
+
+    Args:
+        None
+
+    Returns:
+        RateLimiter: Shared rate limiter
+    '''
+    return _rate_limiter
+
+
+def configure_rate_limits(limits):
+    '''
+    Replace the request rates, dropping the current buckets
+
+    Clients created before keep the buckets they already took tokens from.
+
+    Args:
+        limits (dict): Dictionary of 'service.Operation' or service to (requests per second, burst size)
+
+    Returns:
+        RateLimiter: The new shared rate limiter
+    '''
+    global _rate_limiter
+    _rate_limiter = RateLimiter(limits)
+    return _rate_limiter
+
+
+def attach_rate_limiter(client, profile, region):
+    '''
+    Send every request of a client through the rate limiter
+
+    A token is taken before each attempt, retries included, and throttled
+    responses slow the bucket down before botocore decides how long to back off.
+    The handlers are registered first so they run before any other handler of
+    the same event, including handlers that answer the request themselves.
+
+    Args:
+        client (botocore.client.BaseClient): AWS client
+        profile (str): AWS profile name
+        region (str): AWS region the client calls
+
+    Returns:
+        None
+    '''
+    service = client.meta.service_model.service_id.hyphenize()
+    limiter = get_rate_limiter()
+
+    def acquire(event_name, **kwargs):
+        operation = event_name.rsplit('.', 1)[-1]
+        waited = limiter.get_bucket(profile, region, service, operation).acquire()
+        if waited > 1:
+            logger.debug("Waited %.1fs to call %s.%s in %s", waited, service, operation, region)
+
+    def observe(event_name, response, **kwargs):
+        if response is None:
+            return
+        operation = event_name.rsplit('.', 1)[-1]
+        bucket = limiter.get_bucket(profile, region, service, operation)
+        code = (response[1] or {}).get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            bucket.throttled()
+            logger.debug("%s.%s throttled in %s, rate lowered to %.1f/s", service, operation, region, bucket.rate)
+        elif response[0] is not None and response[0].status_code < 300:
+            bucket.succeeded()
+
+    client.meta.events.register_first('before-send.{}'.format(service), acquire)
+    client.meta.events.register_first('needs-retry.{}'.format(service), observe)
+
+
+def is_throttling_error(error):
+    '''
+    Check whether an exception, or one it was raised from, is an AWS throttling error
+
+    Args:
+        error (Exception): Exception to check
+
+    Returns:
+        bool: True if AWS throttled the call
+    '''
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        response = getattr(error, 'response', None)
+        if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLE_CODES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def get_retry_delay(attempt, base_delay=REGION_RETRY_BASE_DELAY, max_delay=REGION_RETRY_MAX_DELAY):
+    '''
+    Get a random delay before a retry, using full jitter exponential backoff
+
+    Args:
+        attempt (int): Number of the retry, starting at 1
+        base_delay (float): Upper bound of the first delay in seconds
+        max_delay (float): Upper bound of any delay in seconds
+
+    Returns:
+        float: Seconds to wait
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def call_with_retries(function, *args, attempts=REGION_RETRY_ATTEMPTS):
+    '''
+    Call a function, retrying it after a jittered delay when AWS throttled it
+
+    Other errors are raised straight away.
+
+    Args:
+        function (function): Function to call
+        args: Arguments of the function
+        attempts (int): Maximum number of calls
+
+    Returns:
+        The result of the function
+    '''
+    for attempt in range(1, attempts + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == attempts or not is_throttling_error(e):
+                raise
+            delay = get_retry_delay(attempt)
+            logger.warning("Throttled by AWS, retrying in %.1fs (attempt %s of %s): %s", delay, attempt + 1, attempts, e)
+            time.sleep(delay)
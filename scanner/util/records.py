@@ -0,0 +1,165 @@
+import re
+import sys
+from datetime import datetime, timezone
+
+
+# Shared by every volume without attachments
+NO_INSTANCES = ()
+
+
+def intern(value):
+    '''
+    Intern a string that repeats across records, such as a region or a volume type
+
+    Args:
+        value (str): String to intern, or None
+
+    Returns:
+        str: The interned string, '' for None
+    '''
+    return sys.intern(value) if value else ''
+
+
+class VolumeRecord:
+    '''
+    The fields of an EBS volume the analysis reads
+
+    Attribute names follow the describe_volumes fields, so the filters and the
+    frame columns use the same names. Slots keep each record to a few pointers
+    instead of the dictionary of a full API response.
+    '''
+    __slots__ = ('VolumeId', 'Region', 'VolumeType', 'Size', 'State', 'InstanceIds')
+
+    def __init__(self, VolumeId, Region, VolumeType, Size, State, InstanceIds=NO_INSTANCES):
+        self.VolumeId = VolumeId
+        self.Region = Region
+        self.VolumeType = VolumeType
+        self.Size = Size
+        self.State = State
+        self.InstanceIds = InstanceIds
+
+    @classmethod
+    def from_api(cls, volume, region):
+        '''
+        Convert a describe_volumes record
+
+        Args:
+            volume (dict): EBS volume returned by describe_volumes
+            region (str): AWS region of the volume
+
+        Returns:
+            VolumeRecord: Compact volume record
+        '''
+        attachments = volume.get('Attachments')
+        instance_ids = tuple(intern(attachment.get('InstanceId')) for attachment in attachments) if attachments else NO_INSTANCES
+        return cls(
+            volume['VolumeId'],
+            intern(region),
+            intern(volume.get('VolumeType')),
+            volume.get('Size') or 0,
+            intern(volume.get('State')),
+            instance_ids,
+        )
+
+    @property
+    def Attached(self):
+        return bool(self.InstanceIds)
+
+    def __repr__(self):
+        return "VolumeRecord({}, {}, {}, {} GB, {})".format(self.VolumeId, self.Region, self.VolumeType, self.Size, self.State)
+
+
+class SnapshotRecord:
+    '''
+    The fields of an EBS snapshot the analysis reads
+
+    StartTime is kept as epoch seconds rather than a datetime. Volume ids and
+    descriptions are interned, since every snapshot of a volume or of a backup
+    plan repeats them.
+    '''
+    __slots__ = ('SnapshotId', 'Region', 'VolumeId', 'VolumeSize', 'StartTime', 'Description')
+
+    def __init__(self, SnapshotId, Region, VolumeId, VolumeSize, StartTime, Description=''):
+        self.SnapshotId = SnapshotId
+        self.Region = Region
+        self.VolumeId = VolumeId
+        self.VolumeSize = VolumeSize
+        self.StartTime = StartTime
+        self.Description = Description
+
+    @classmethod
+    def from_api(cls, snapshot, region):
+        '''
+        Convert a describe_snapshots record
+
+        Args:
+            snapshot (dict): EBS snapshot returned by describe_snapshots
+            region (str): AWS region of the snapshot
+
+        Returns:
+            SnapshotRecord: Compact snapshot record
+        '''
+        return cls(
+            snapshot['SnapshotId'],
+            intern(region),
+            intern(snapshot.get('VolumeId')),
+            snapshot.get('VolumeSize') or 0,
+            snapshot['StartTime'].timestamp(),
+            intern(snapshot.get('Description')),
+        )
+
+    def __repr__(self):
+        return "SnapshotRecord({}, {}, {}, {} GB)".format(self.SnapshotId, self.Region, self.VolumeId, self.VolumeSize)
+
+
+# Time an instance was stopped, as written in its StateTransitionReason
+STOP_TIME_PATTERN = re.compile(r'\((\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) GMT\)')
+
+
+def parse_stop_time(reason):
+    '''
+    Get the time an instance was stopped from its StateTransitionReason
+
+    Args:
+        reason (str): StateTransitionReason, e.g. 'User initiated (2024-01-31 12:00:00 GMT)'
+
+    Returns:
+        float: Epoch seconds of the stop, or None if the reason has no time
+    '''
+    match = STOP_TIME_PATTERN.search(reason or '')
+    if match is None:
+        return None
+    stopped_at = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return stopped_at.timestamp()
+
+
+class InstanceRecord:
+    '''
+    The state of an EC2 instance and, for a stopped instance, when it was stopped
+    '''
+    __slots__ = ('InstanceId', 'Region', 'State', 'StoppedAt')
+
+    def __init__(self, InstanceId, Region, State, StoppedAt=None):
+        self.InstanceId = InstanceId
+        self.Region = Region
+        self.State = State
+        self.StoppedAt = StoppedAt
+
+    @classmethod
+    def from_api(cls, instance, region):
+        '''
+        Convert a describe_instances record
+
+        Args:
+            instance (dict): EC2 instance returned by describe_instances
+            region (str): AWS region of the instance
+
+        Returns:
+            InstanceRecord: Compact instance record
+        '''
+        state = intern(instance.get('State', {}).get('Name'))
+        stopped_at = parse_stop_time(instance.get('StateTransitionReason')) if state == 'stopped' else None
+        return cls(intern(instance['InstanceId']), intern(region), state, stopped_at)
+
+    def __repr__(self):
+        return "InstanceRecord({}, {}, {})".format(self.InstanceId, self.Region, self.State)
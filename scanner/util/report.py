@@ -0,0 +1,375 @@
+import abc
+import os
+import scanner.util.logger as log
+from scanner.util.ebs_volumes import (
+    build_ebs_region_frame,
+    build_ebs_total_frame,
+    EBS_FINDINGS,
+    EBS_REPORT_SCHEMA,
+)
+from scanner.util.ebs_snapshots import (
+    build_snapshot_region_frame,
+    build_snapshot_total_frame,
+    SNAPSHOT_REPORT_SCHEMA,
+)
+
+
+logger = log.get_logger()
+
+# Reports written by a scan: file name suffix, column types, region row builder and total row builder
+REPORTS = {
+    "ebs_volumes": ("ebs_volumes_report", EBS_REPORT_SCHEMA, build_ebs_region_frame, build_ebs_total_frame),
+    "snapshots": ("snapshots_report", SNAPSHOT_REPORT_SCHEMA, build_snapshot_region_frame, build_snapshot_total_frame),
+}
+
+DEFAULT_REPORT_FORMAT = "csv"
+
+# Compression of the Parquet and Arrow IPC reports
+REPORT_COMPRESSION = "zstd"
+
+# Arrow types of the pandas column types used in the report schemas
+ARROW_TYPES = {
+    "string": "string",
+    "float64": "float64",
+    "Int64": "int64",
+}
+
+
+def import_pyarrow():
+    '''
+    Import pyarrow, which is only needed for the Parquet and Arrow reports
+
+    Args:
+        None
+
+    Returns:
+        module: The pyarrow module
+    '''
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "The parquet and arrow report formats need pyarrow. Install it with: pip install pyarrow"
+        ) from e
+    return pyarrow
+
+
+def get_arrow_schema(schema):
+    '''
+    Get the Arrow schema of a report
+
+    Args:
+        schema (dict): Dictionary of report column to pandas type
+
+    Returns:
+        pyarrow.Schema: Arrow schema
+    '''
+    pa = import_pyarrow()
+    return pa.schema([(column, getattr(pa, ARROW_TYPES[dtype])()) for column, dtype in schema.items()])
+
+
+class ReportSink(abc.ABC):
+    '''
+    Report written region by region as the analysis of each region finishes
+
+    The rows of a region are written as soon as they are known, so only one
+    region is held in memory and the regions already written survive a failure
+    later in the scan. The total row is written when the sink is closed.
+
+    Args:
+        path (str): Report file path
+        schema (dict): Dictionary of report column to pandas type
+        build_region_frame (function): Builds the rows of a region from its analyzer result
+        build_total_frame (function): Builds the total row of a region, or of the report when the region is None
+    '''
+    def __init__(self, path, schema, build_region_frame, build_total_frame):
+        self.path = path
+        self.schema = schema
+        self.build_region_frame = build_region_frame
+        self.build_total_frame = build_total_frame
+        self.total = 0.0
+        self.rows = 0
+        self.region_totals = {}
+
+    def write_region(self, region, result):
+        '''
+        Write the rows of a region followed by its total row, if the report has one
+
+        Args:
+            region (str): AWS region
+            result: Analyzer result of the region accepted by build_region_frame
+
+        Returns:
+            None
+        '''
+        import pandas as pd
+
+        frame = self.build_region_frame(region, result)
+        if frame is None or not len(frame):
+            return
+        region_total = frame["MonthlySavings"].sum()
+        # The rows and the total row of a region go out in one write, e.g. one Parquet row group
+        total_frame = self.build_total_frame(region, region_total)
+        if total_frame is not None:
+            self.write_frame(self.prepare(pd.concat([frame, total_frame], ignore_index=True)))
+        else:
+            self.write_frame(self.prepare(frame))
+        self.total += region_total
+        self.rows += len(frame)
+        self.region_totals[region] = self.region_totals.get(region, 0.0) + region_total
+
+    def prepare(self, frame):
+        '''
+        Put report rows in the column order and types of the report schema
+
+        Args:
+            frame (pandas.DataFrame): Report rows
+
+        Returns:
+            pandas.DataFrame: Typed report rows
+        '''
+        return frame.reindex(columns=list(self.schema)).astype(self.schema)
+
+    @abc.abstractmethod
+    def write_frame(self, frame):
+        '''
+        Append typed rows to the report file
+
+        Args:
+            frame (pandas.DataFrame): Report rows with the schema columns and types
+
+        Returns:
+            None
+        '''
+
+    @abc.abstractmethod
+    def finish(self):
+        '''
+        Flush and close the report file
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+    def close(self):
+        '''
+        Write the total row and close the report
+
+        Args:
+            None
+
+        Returns:
+            str: Path of the report, or None if no region had findings
+        '''
+        if not self.rows:
+            self.finish()
+            return None
+        self.write_frame(self.prepare(self.build_total_frame(None, self.total)))
+        self.finish()
+        if self.path is not None:
+            logger.info("Report saved as %s (%s rows, %.2f USD)", self.path, self.rows, self.total)
+        return self.path
+
+
+class CsvReportSink(ReportSink):
+    '''
+    Report sink that appends rows to a CSV file
+
+    The file is only created when the first region with findings is written.
+    '''
+    def __init__(self, path, schema, build_region_frame, build_total_frame):
+        super().__init__(path, schema, build_region_frame, build_total_frame)
+        self.file = None
+
+    def write_frame(self, frame):
+        header = self.file is None
+        if header:
+            self.file = open(self.path, "w", newline="")
+        # Savings are kept numeric in the frames and rounded to cents in the CSV
+        frame.to_csv(self.file, index=False, header=header, float_format="%.2f")
+        self.file.flush()
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class JsonlReportSink(ReportSink):
+    '''
+    Report sink that appends rows to a JSON Lines file, one object per row
+
+    Numbers stay numbers and missing values are written as null.
+    '''
+    def __init__(self, path, schema, build_region_frame, build_total_frame):
+        super().__init__(path, schema, build_region_frame, build_total_frame)
+        self.file = None
+
+    def write_frame(self, frame):
+        if self.file is None:
+            self.file = open(self.path, "w")
+        # Every line, including the last one, ends with a newline
+        self.file.write(frame.to_json(orient="records", lines=True))
+        self.file.flush()
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ArrowReportSink(ReportSink):
+    '''
+    Report sink that writes a compressed Arrow IPC file, one record batch per region
+
+    pyarrow is imported when the sink is created, so a missing install is
+    reported before the scan starts.
+    '''
+    def __init__(self, path, schema, build_region_frame, build_total_frame):
+        super().__init__(path, schema, build_region_frame, build_total_frame)
+        self.pa = import_pyarrow()
+        self.arrow_schema = get_arrow_schema(schema)
+        self.writer = None
+
+    def open_writer(self):
+        options = self.pa.ipc.IpcWriteOptions(compression=REPORT_COMPRESSION)
+        return self.pa.ipc.new_file(self.path, self.arrow_schema, options=options)
+
+    def write_frame(self, frame):
+        if self.writer is None:
+            self.writer = self.open_writer()
+        table = self.pa.Table.from_pandas(frame, schema=self.arrow_schema, preserve_index=False)
+        # Arrow-backed string columns may arrive in several chunks, each of which would become a record batch
+        self.writer.write_table(table.combine_chunks())
+
+    def finish(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ParquetReportSink(ArrowReportSink):
+    '''
+    Report sink that writes a compressed Parquet file, one row group per region
+    '''
+    def open_writer(self):
+        return self.pa.parquet.ParquetWriter(self.path, self.arrow_schema, compression=REPORT_COMPRESSION)
+
+
+class FrameReportSink(ReportSink):
+    '''
+    Report sink that keeps the typed rows in memory instead of writing a file
+
+    Used by the scanner service, which serves the latest reports over HTTP.
+    '''
+    def __init__(self, schema, build_region_frame, build_total_frame):
+        super().__init__(None, schema, build_region_frame, build_total_frame)
+        self.frames = []
+
+    def write_frame(self, frame):
+        self.frames.append(frame)
+
+    def finish(self):
+        pass
+
+    def to_frame(self):
+        '''
+        Get every row written so far, total rows included
+
+        Args:
+            None
+
+        Returns:
+            pandas.DataFrame: Report rows with the schema columns and types
+        '''
+        import pandas as pd
+
+        if not self.frames:
+            return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in self.schema.items()})
+        return pd.concat(self.frames, ignore_index=True)
+
+
+# Report formats: sink class and file extension
+REPORT_FORMATS = {
+    "csv": (CsvReportSink, ".csv"),
+    "jsonl": (JsonlReportSink, ".jsonl"),
+    "parquet": (ParquetReportSink, ".parquet"),
+    "arrow": (ArrowReportSink, ".arrow"),
+}
+
+
+def create_report_sinks(profile, output_dir="reports", report_format=DEFAULT_REPORT_FORMAT):
+    '''
+    Create a sink for every report of a scan
+
+    Args:
+        profile (str): AWS profile name
+        output_dir (str): Folder the reports are written to
+        report_format (str): One of REPORT_FORMATS
+
+    Returns:
+        dict: Dictionary of report name to ReportSink
+    '''
+    sink_class, extension = REPORT_FORMATS[report_format]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    sinks = {}
+    for name, (suffix, schema, build_region_frame, build_total_frame) in REPORTS.items():
+        path = os.path.join(output_dir, "{}-{}{}".format(profile, suffix, extension))
+        sinks[name] = sink_class(path, schema, build_region_frame, build_total_frame)
+    return sinks
+
+
+def create_frame_report_sinks():
+    '''
+    Create an in-memory sink for every report of a scan
+
+    Args:
+        None
+
+    Returns:
+        dict: Dictionary of report name to FrameReportSink
+    '''
+    return {
+        name: FrameReportSink(schema, build_region_frame, build_total_frame)
+        for name, (suffix, schema, build_region_frame, build_total_frame) in REPORTS.items()
+    }
+
+
+def write_region_reports(sinks, region, results):
+    '''
+    Write the results of a region to every report
+
+    Args:
+        sinks (dict): Dictionary of report name to ReportSink
+        region (str): AWS region
+        results (dict): Dictionary of analyzer name to the result of the region
+
+    Returns:
+        None
+    '''
+    sinks["ebs_volumes"].write_region(region, {name: results.get(name) for name in EBS_FINDINGS})
+    sinks["snapshots"].write_region(region, results.get("snapshots"))
+
+
+def close_report_sinks(sinks):
+    '''
+    Write the total rows and close every report
+
+    Args:
+        sinks (dict): Dictionary of report name to ReportSink
+
+    Returns:
+        list: Paths of the reports that were written
+    '''
+    paths = []
+    for sink in sinks.values():
+        path = sink.close()
+        if path is not None:
+            paths.append(path)
+    return paths
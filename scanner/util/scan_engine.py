@@ -0,0 +1,186 @@
+import scanner.util.logger as log
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from scanner.util.ebs_volumes import (
+    get_all_volumes,
+    get_region_unused_volume_savings,
+    get_gp2_to_gp3_savings,
+    get_region_stopped_instance_volume_savings,
+    UNUSED_VOLUME_FILTERS,
+    GP2_VOLUME_FILTERS,
+)
+from scanner.util.ebs_snapshots import get_aws_snapshot_cost
+from scanner.util.inventory import get_inventory, release_inventory
+from scanner.util.metrics import profile_task, timed
+from scanner.util.rate_limiter import call_with_retries
+
+
+logger = log.get_logger()
+
+DEFAULT_MAX_WORKERS = 8
+
+
+def scan_unused_volumes(profile, region):
+    '''
+    Analyse the unused EBS volumes in a single region
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        pandas.DataFrame: VolumeId and monthly Savings of every unused volume in the region
+    '''
+    return get_region_unused_volume_savings(profile, region)
+
+
+def scan_gp2_volumes(profile, region):
+    '''
+    Analyse the gp2 to gp3 savings in a single region
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        dict: Dictionary of gp2 to gp3 savings for the region
+    '''
+    ebs_volumes = get_all_volumes(profile, region)
+    if ebs_volumes is None:
+        raise RuntimeError("Unable to load the EBS volumes for {}".format(region))
+    return get_gp2_to_gp3_savings(ebs_volumes, region)
+
+
+def scan_stopped_instance_volumes(profile, region):
+    '''
+    Analyse the volumes attached to long-stopped instances in a single region
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        pandas.DataFrame: VolumeId and monthly Savings of every volume attached to a long-stopped instance
+    '''
+    return get_region_stopped_instance_volume_savings(profile, region)
+
+
+def scan_snapshots(profile, region):
+    '''
+    Analyse the EBS snapshot costs in a single region
+
+    Args:
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        list: List of snapshot costs for the region
+    '''
+    return get_aws_snapshot_cost(profile, region)
+
+
+ANALYZERS = {
+    "unused": scan_unused_volumes,
+    "gp2": scan_gp2_volumes,
+    "stopped": scan_stopped_instance_volumes,
+    "snapshots": scan_snapshots,
+}
+
+
+def run_analyzer(name, analyzer, profile, region):
+    '''
+    Run an analyzer with its region and name attached to every log record
+
+    The wall time of the analyzer is recorded as a phase of the region. An
+    analyzer that AWS kept throttling after botocore's retries is run again
+    after a jittered delay, so the region is not lost.
+
+    Args:
+        name (str): Analyzer name
+        analyzer (function): Analyzer function
+        profile (str): AWS profile name
+        region (str): AWS region
+
+    Returns:
+        pandas.DataFrame: Analyzer result
+    '''
+    with log.log_context(region=region, phase=name), timed(name, region):
+        return profile_task(call_with_retries, analyzer, profile, region)
+
+
+# Volumes each analyzer needs, registered with the inventory so they are fetched together
+ANALYZER_VOLUME_FILTERS = {
+    "unused": UNUSED_VOLUME_FILTERS,
+    "gp2": GP2_VOLUME_FILTERS,
+    # The stopped instance analyzer looks up the volumes of its instances by instance id,
+    # and the snapshot analyzer the source volumes of its snapshots by volume id instead
+}
+
+
+def scan_regions(profile, regions, max_workers=DEFAULT_MAX_WORKERS, on_region=None):
+    '''
+    Run every analyzer for every region on a shared worker pool
+
+    Each (analyzer, region) pair is submitted as its own task so the total
+    wall-clock time is close to the slowest single region rather than the
+    sum of all regions.
+
+    Args:
+        profile (str): AWS profile name
+        regions (list): List of AWS regions
+        max_workers (int): Maximum number of concurrent tasks
+        on_region (function): Called with the region and a dictionary of analyzer name
+                              to result as soon as every analyzer of a region is done.
+                              The results are then handed over instead of kept.
+
+    Returns:
+        dict: Results keyed by analyzer name ('unused', 'gp2', 'stopped', 'snapshots'),
+              each holding a dictionary of region to analyzer result, and
+              'failed' holding a dictionary of region to the analyzers that failed
+    '''
+    results = {name: {} for name in ANALYZERS}
+    results["failed"] = {}
+    if not regions:
+        return results
+
+    # Load the shared pricing data once before the workers start so they
+    # do not all race to fetch it
+    with log.log_context(phase="pricing"), timed("pricing"):
+        get_all_volumes(profile, regions[0])
+
+    logger.info("Scanning %s regions with %s workers...", len(regions), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        pending = {}
+        for region in regions:
+            pending[region] = len(ANALYZERS)
+            inventory = get_inventory(profile, region)
+            for filters in ANALYZER_VOLUME_FILTERS.values():
+                inventory.require_volumes(filters)
+            for name, analyzer in ANALYZERS.items():
+                futures[executor.submit(run_analyzer, name, analyzer, profile, region)] = (name, region)
+
+        region_results = {region: {} for region in regions}
+        for future in as_completed(futures):
+            name, region = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Error occurred in %s (%s): %s", region, name, e, exc_info=True)
+                results["failed"].setdefault(region, []).append(name)
+            else:
+                if result is not None and len(result):
+                    region_results[region][name] = result
+                logger.info("Finished %s analysis for %s", name, region)
+
+            pending[region] -= 1
+            if pending[region]:
+                continue
+            # Every analyzer is done with the region, free its inventory
+            release_inventory(profile, region)
+            if on_region is not None:
+                on_region(region, region_results.pop(region))
+            else:
+                for name, result in region_results.pop(region).items():
+                    results[name][region] = result
+
+    return results
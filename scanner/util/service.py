@@ -0,0 +1,361 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import scanner.util.logger as log
+from scanner.util.aws_functions import get_all_regions, DEFAULT_REGION_DISCOVERY, REGION_CACHE_TTL
+from scanner.util.ebs_pricing import clear_ebs_price_matrix
+from scanner.util.metrics import get_metrics, reset_metrics, timed
+from scanner.util.report import create_frame_report_sinks, write_region_reports, close_report_sinks, REPORTS
+from scanner.util.scan_engine import scan_regions, DEFAULT_MAX_WORKERS
+
+
+logger = log.get_logger()
+
+# The endpoint only listens on the loopback interface
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8080
+
+# Seconds between two scheduled scans
+SCAN_INTERVAL = 60 * 60
+
+# Seconds the EBS price matrix is kept before it is loaded again from the pricing cache
+PRICE_RELOAD_INTERVAL = 24 * 60 * 60
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class ScanResult:
+    '''
+    Reports, totals and metrics of a finished scan
+
+    Each response body is rendered on first request and kept, so repeated
+    requests for the same scan are answered without touching the frames.
+
+    Args:
+        started_at (float): Epoch seconds the scan started at
+        regions (list): Scanned regions
+        sinks (dict): Dictionary of report name to closed FrameReportSink
+        failed (dict): Dictionary of region to the analyzers that failed
+        metrics (dict): Metrics of the scan from ScanMetrics.to_dict
+    '''
+    def __init__(self, started_at, regions, sinks, failed, metrics):
+        self.started_at = started_at
+        self.finished_at = time.time()
+        self.regions = regions
+        self.reports = {name: sink.to_frame() for name, sink in sinks.items()}
+        self.totals = {name: dict(sink.region_totals, Total=sink.total) for name, sink in sinks.items()}
+        self.failed = failed
+        self.metrics = metrics
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def summary(self):
+        '''
+        Get a short description of the scan
+
+        Args:
+            None
+
+        Returns:
+            dict: Start and finish times, regions, failed regions and total savings of every report
+        '''
+        return {
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": round(self.finished_at - self.started_at, 3),
+            "regions": self.regions,
+            "failed": self.failed,
+            "savings": {name: round(totals["Total"], 2) for name, totals in self.totals.items()},
+        }
+
+    def get_totals_frame(self):
+        '''
+        Get the monthly savings of every region and report as rows
+
+        Args:
+            None
+
+        Returns:
+            pandas.DataFrame: Report, Region and MonthlySavings columns
+        '''
+        import pandas as pd
+
+        rows = [
+            {"Report": name, "Region": region, "MonthlySavings": total}
+            for name, totals in self.totals.items()
+            for region, total in totals.items()
+        ]
+        return pd.DataFrame(rows, columns=["Report", "Region", "MonthlySavings"])
+
+    def render(self, resource, body_format):
+        '''
+        Get the response body of a resource, rendering it on first use
+
+        Args:
+            resource (str): A report name, 'totals' or 'metrics'
+            body_format (str): 'json' or 'csv', metrics are only available as JSON
+
+        Returns:
+            bytes: Response body, or None if the resource does not exist
+        '''
+        key = (resource, body_format)
+        with self._lock:
+            if key not in self._bodies:
+                self._bodies[key] = self._render(resource, body_format)
+            return self._bodies[key]
+
+    def _render(self, resource, body_format):
+        if resource == "metrics":
+            return json.dumps(self.metrics).encode() if body_format == "json" else None
+        frame = self.get_totals_frame() if resource == "totals" else self.reports.get(resource)
+        if frame is None:
+            return None
+        if body_format == "csv":
+            return frame.to_csv(index=False, float_format="%.2f").encode()
+        return frame.to_json(orient="records").encode()
+
+
+class ScannerService:
+    '''
+    Long-running scanner that rescans on a schedule and keeps the latest results
+
+    Sessions, clients, the region list and prices stay loaded between scans,
+    so a rescan only fetches the volumes and snapshots again. The volume and
+    snapshot inventories are what a rescan is for, so they are not kept.
+
+    Args:
+        profile (str): AWS profile name
+        regions (list): Regions to scan, None to discover them before every scan
+        interval (float): Seconds between the end of a scan and the start of the next one
+        max_workers (int): Maximum number of concurrent analysis tasks
+        discovery (str): Region discovery mode, see get_all_regions
+        region_cache_ttl (float): Seconds the discovered region list is cached for
+    '''
+    def __init__(self, profile, regions=None, interval=SCAN_INTERVAL, max_workers=DEFAULT_MAX_WORKERS,
+                 discovery=DEFAULT_REGION_DISCOVERY, region_cache_ttl=REGION_CACHE_TTL):
+        self.profile = profile
+        self.regions = regions
+        self.interval = interval
+        self.max_workers = max_workers
+        self.discovery = discovery
+        self.region_cache_ttl = region_cache_ttl
+        self.latest = None
+        self.scans = 0
+        self.scanning = False
+        self.next_scan_at = None
+        self._prices_loaded_at = time.time()
+        self._scan_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def get_regions(self):
+        '''
+        Get the regions of the next scan
+
+        Args:
+            None
+
+        Returns:
+            list: List of regions
+        '''
+        if self.regions:
+            return self.regions
+        with log.log_context(phase="discovery"), timed("discovery"):
+            return get_all_regions(
+                self.profile,
+                discovery=self.discovery,
+                cache_ttl=self.region_cache_ttl,
+                max_workers=self.max_workers,
+            )
+
+    def scan(self):
+        '''
+        Scan every region and replace the latest results when the scan finishes
+
+        The previous results keep being served while the scan runs.
+
+        Args:
+            None
+
+        Returns:
+            ScanResult: Results of the scan, or None if it failed
+        '''
+        with self._scan_lock:
+            self.scanning = True
+            try:
+                reset_metrics()
+                started_at = time.time()
+                if started_at - self._prices_loaded_at > PRICE_RELOAD_INTERVAL:
+                    clear_ebs_price_matrix()
+                    self._prices_loaded_at = started_at
+                sinks = create_frame_report_sinks()
+
+                def write_region(region, region_results):
+                    with log.log_context(region=region, phase="report"), timed("report", region):
+                        write_region_reports(sinks, region, region_results)
+
+                regions = self.get_regions()
+                results = scan_regions(self.profile, regions, max_workers=self.max_workers, on_region=write_region)
+                close_report_sinks(sinks)
+                result = ScanResult(started_at, regions, sinks, results["failed"], get_metrics().to_dict())
+            except Exception as e:
+                logger.error("Error occurred during the scan: %s", e, exc_info=True)
+                return None
+            finally:
+                self.scanning = False
+
+            self.latest = result
+            self.scans += 1
+            logger.info("Scan %s of %s regions finished in %.1fs", self.scans, len(regions), result.finished_at - started_at)
+            return result
+
+    def request_scan(self):
+        '''
+        Start the next scheduled scan now instead of waiting for the interval
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        self._wake.set()
+
+    def run_schedule(self):
+        '''
+        Scan, wait for the interval or a scan request, and repeat until stopped
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                # Keep the schedule alive, the previous results are still served
+                logger.error("Error occurred in the scan schedule: %s", e, exc_info=True)
+            self.next_scan_at = time.time() + self.interval
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def stop(self):
+        '''
+        Stop the schedule after the current scan
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        self._stop.set()
+        self._wake.set()
+
+    def status(self):
+        '''
+        Get the state of the service
+
+        Args:
+            None
+
+        Returns:
+            dict: Profile, scan count, whether a scan is running, next scan time and the latest scan
+        '''
+        latest = self.latest
+        return {
+            "profile": self.profile,
+            "scans": self.scans,
+            "scanning": self.scanning,
+            "next_scan_at": None if self.scanning else self.next_scan_at,
+            "latest": latest.summary() if latest is not None else None,
+        }
+
+
+class ScannerRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP handler of the scanner service
+
+    GET /status                   state of the service and summary of the latest scan
+    GET /reports/<name>.json|csv  latest report, <name> is ebs_volumes or snapshots
+    GET /totals.json|csv          monthly savings of every region and report
+    GET /metrics.json             phase timings and API statistics of the latest scan
+    POST /scan                    start a scan now
+    '''
+    server_version = "ec2-other-scanner"
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path in ("", "/status"):
+            return self.send_body(200, json.dumps(service.status()).encode(), "json")
+
+        resource, _, body_format = path.lstrip("/").rpartition(".")
+        if resource.startswith("reports/") and resource[len("reports/"):] in REPORTS:
+            resource = resource[len("reports/"):]
+        elif resource not in ("totals", "metrics"):
+            return self.send_error_body(404, "Unknown resource {}".format(path))
+        if body_format not in CONTENT_TYPES:
+            return self.send_error_body(404, "Unknown format {}, use json or csv".format(body_format))
+
+        latest = service.latest
+        if latest is None:
+            return self.send_error_body(503, "The first scan has not finished yet")
+        body = latest.render(resource, body_format)
+        if body is None:
+            return self.send_error_body(404, "{} is not available as {}".format(resource, body_format))
+        self.send_body(200, body, body_format, latest.finished_at)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/scan":
+            return self.send_error_body(404, "Unknown resource {}".format(self.path))
+        self.server.service.request_scan()
+        self.send_body(202, json.dumps({"status": "scan requested"}).encode(), "json")
+
+    def send_body(self, status, body, body_format, finished_at=None):
+        self.send_response(status)
+        self.send_header("Content-Type", CONTENT_TYPES[body_format])
+        self.send_header("Content-Length", str(len(body)))
+        if finished_at is not None:
+            self.send_header("Last-Modified", self.date_time_string(finished_at))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_body(self, status, message):
+        self.send_body(status, json.dumps({"error": message}).encode(), "json")
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(service, port=SERVICE_PORT, host=SERVICE_HOST):
+    '''
+    Run the scan schedule in the background and serve the results until interrupted
+
+    Args:
+        service (ScannerService): Scanner service
+        port (int): TCP port of the endpoint
+        host (str): Address the endpoint listens on
+
+    Returns:
+        None
+    '''
+    server = ThreadingHTTPServer((host, port), ScannerRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    scheduler = threading.Thread(target=service.run_schedule, name="scan-schedule", daemon=True)
+    scheduler.start()
+    logger.info("Serving scan results on http://%s:%s, scanning every %ss", host, server.server_address[1], service.interval)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the scanner service...")
+    finally:
+        service.stop()
+        server.server_close()
@@ -0,0 +1,64 @@
+import pytest
+from scanner.util.aws_functions import (
+    normalize_volume_filters,
+    plan_volume_fetches,
+    volume_filters_cover,
+    volume_matches_filters,
+)
+from scanner.util.records import VolumeRecord
+
+AVAILABLE = {'status': ('available',)}
+IN_USE = {'status': ('in-use',)}
+GP2 = {'volume-type': ('gp2',)}
+
+
+def test_filters_are_normalized():
+    assert normalize_volume_filters({'status': ['in-use', 'available', 'in-use']}) == {'status': ('available', 'in-use')}
+    assert normalize_volume_filters({}) is None
+    assert normalize_volume_filters(None) is None
+    with pytest.raises(ValueError):
+        normalize_volume_filters({'tag:Name': ['web']})
+
+
+def test_filters_cover_narrower_filters():
+    assert volume_filters_cover(None, GP2)
+    assert not volume_filters_cover(GP2, None)
+    assert volume_filters_cover({'status': ('available', 'in-use')}, AVAILABLE)
+    assert volume_filters_cover(AVAILABLE, dict(GP2, **AVAILABLE))
+    assert not volume_filters_cover(AVAILABLE, GP2)
+    assert not volume_filters_cover(dict(GP2, **AVAILABLE), AVAILABLE)
+
+
+def test_filters_are_matched_on_the_client():
+    volume = VolumeRecord("vol-1", "us-east-1", "gp2", 10, "available")
+
+    assert volume_matches_filters(volume, None)
+    assert volume_matches_filters(volume, dict(GP2, **AVAILABLE))
+    assert not volume_matches_filters(volume, IN_USE)
+
+
+def test_status_fetches_are_excluded_from_the_other_fetches():
+    assert plan_volume_fetches([AVAILABLE, GP2, IN_USE]) == [
+        AVAILABLE,
+        IN_USE,
+        {'volume-type': ('gp2',), 'status': ('creating', 'deleted', 'deleting', 'error')},
+    ]
+
+
+def test_covered_needs_are_dropped():
+    assert plan_volume_fetches([GP2, {'volume-type': ('gp2', 'io1')}]) == [{'volume-type': ('gp2', 'io1')}]
+    assert plan_volume_fetches([AVAILABLE, None, GP2]) == [None]
+    assert plan_volume_fetches([AVAILABLE, GP2], fetched=[None]) == []
+    assert plan_volume_fetches([AVAILABLE], fetched=[{'status': ('available', 'in-use')}]) == []
+
+
+def test_earlier_fetches_are_excluded():
+    assert plan_volume_fetches([GP2], fetched=[AVAILABLE]) == [
+        {'volume-type': ('gp2',), 'status': ('creating', 'deleted', 'deleting', 'error', 'in-use')},
+    ]
+
+
+def test_needs_fully_returned_by_earlier_fetches_are_not_fetched():
+    every_status = {'status': ('available', 'creating', 'deleted', 'deleting', 'error', 'in-use')}
+
+    assert plan_volume_fetches([GP2], fetched=[every_status]) == []
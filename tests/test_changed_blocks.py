@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scanner.util.changed_blocks as changed_blocks
+from scanner.util.changed_blocks import (
+    estimate_changed_storage,
+    measure_pair,
+    select_sample_pairs,
+    spread,
+    CHANGE_EXTRAPOLATED,
+    CHANGE_FROM_BLOCKS,
+    CHANGE_FROM_SAMPLED_BLOCKS,
+    CHANGE_FROM_VOLUME_SIZE,
+)
+from scanner.util.ebs_snapshots import build_snapshot_region_frame
+
+BLOCK_SIZE = 512 * 1024
+BLOCKS_PER_GIB = 2048
+DAY = 86400.0
+
+
+def blocks(count, volume_size=100, last_block_index=None, complete=True):
+    return {
+        'Blocks': count,
+        'BlockSize': BLOCK_SIZE,
+        'VolumeSize': volume_size,
+        'LastBlockIndex': count - 1 if last_block_index is None else last_block_index,
+        'Complete': complete,
+    }
+
+
+def pairs(volume_ids, volume_size=100, interval=DAY):
+    return pd.DataFrame({
+        'VolumeId': volume_ids,
+        'SnapshotId': ["snap-{}".format(index) for index in range(len(volume_ids))],
+        'PreviousSnapshotId': ["prev-{}".format(index) for index in range(len(volume_ids))],
+        'VolumeSize': volume_size,
+        'Interval': interval,
+    })
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = dict(changed_blocks.CHANGED_BLOCKS_SETTINGS, enabled=True, max_workers=2)
+    monkeypatch.setattr(changed_blocks, "CHANGED_BLOCKS_SETTINGS", settings)
+    return settings
+
+
+@pytest.fixture
+def listed(monkeypatch):
+    listed = {}
+
+    def count_changed_blocks(profile, region, first_snapshot_id, second_snapshot_id, max_pages=None):
+        result = listed[second_snapshot_id]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(changed_blocks, "count_changed_blocks", count_changed_blocks)
+    return listed
+
+
+def test_spread_keeps_the_first_and_last_positions():
+    assert list(spread(3, 5)) == [0, 1, 2]
+    assert list(spread(10, 4)) == [0, 3, 6, 9]
+
+
+def test_sample_is_capped_per_volume_and_region():
+    volume_ids = np.array(["vol-a"] * 50 + ["vol-b"] * 3 + ["vol-c"])
+
+    per_volume = select_sample_pairs(volume_ids, 5, 100)
+    assert list(per_volume) == [0, 12, 24, 37, 49, 50, 51, 52, 53]
+
+    per_region = select_sample_pairs(volume_ids, 5, 4)
+    assert len(per_region) == 4
+    assert per_region[0] == 0 and per_region[-1] == 53
+    assert set(per_region) <= set(per_volume)
+
+    assert len(select_sample_pairs(np.array([]), 5, 4)) == 0
+
+
+def test_truncated_listing_is_scaled_to_the_whole_volume(listed):
+    listed["snap-1"] = blocks(2048, last_block_index=50 * BLOCKS_PER_GIB - 1, complete=False)
+
+    changed, complete = measure_pair("test", "us-east-1", "prev-1", "snap-1", max_pages=1)
+
+    assert changed == pytest.approx(2.0)
+    assert not complete
+
+
+def test_unmeasured_pairs_are_extrapolated_from_their_volume(settings, listed):
+    settings.update(max_pairs_per_volume=1, max_pairs_per_region=10)
+    # Ten pairs of one volume, only the first is listed: 1 GiB of a 100 GiB volume in a day
+    listed["snap-0"] = blocks(BLOCKS_PER_GIB)
+
+    changed, source = estimate_changed_storage("test", "us-east-1", pairs(["vol-a"] * 10, interval=np.arange(1, 11) * DAY), np.zeros(10))
+
+    assert source[0] == CHANGE_FROM_BLOCKS
+    assert list(source[1:]) == [CHANGE_EXTRAPOLATED] * 9
+    assert changed == pytest.approx(np.arange(1, 11, dtype=float))
+
+
+def test_volumes_without_measurements_use_the_region_rate(settings, listed):
+    settings.update(max_pairs_per_volume=1, max_pairs_per_region=1)
+    listed["snap-0"] = blocks(2 * BLOCKS_PER_GIB)
+
+    changed, source = estimate_changed_storage("test", "us-east-1", pairs(["vol-a", "vol-b"]), np.zeros(2))
+
+    assert list(source) == [CHANGE_FROM_BLOCKS, CHANGE_EXTRAPOLATED]
+    assert changed == pytest.approx([2.0, 2.0])
+
+
+def test_failed_listings_keep_the_fallback(settings, listed):
+    listed["snap-0"] = RuntimeError("AccessDenied")
+    listed["snap-1"] = RuntimeError("AccessDenied")
+
+    changed, source = estimate_changed_storage("test", "us-east-1", pairs(["vol-a", "vol-b"]), np.array([3.0, 4.0]))
+
+    assert list(source) == [CHANGE_FROM_VOLUME_SIZE] * 2
+    assert list(changed) == [3.0, 4.0]
+
+
+def test_failed_listings_keep_the_fallback_when_others_are_measured(settings, listed):
+    settings.update(max_pairs_per_volume=2, max_pairs_per_region=10)
+    # Pairs 0 and 2 are sampled, the listing of pair 2 fails and pair 1 is never sampled
+    listed["snap-0"] = blocks(BLOCKS_PER_GIB)
+    listed["snap-2"] = RuntimeError("AccessDenied")
+
+    changed, source = estimate_changed_storage("test", "us-east-1", pairs(["vol-a"] * 3), np.array([7.0, 8.0, 9.0]))
+
+    assert list(source) == [CHANGE_FROM_BLOCKS, CHANGE_EXTRAPOLATED, CHANGE_FROM_VOLUME_SIZE]
+    assert changed == pytest.approx([1.0, 1.0, 9.0])
+
+
+def test_sampled_listings_are_marked(settings, listed):
+    listed["snap-0"] = blocks(1024, last_block_index=10 * BLOCKS_PER_GIB - 1, complete=False)
+
+    changed, source = estimate_changed_storage("test", "us-east-1", pairs(["vol-a"]), np.zeros(1))
+
+    assert list(source) == [CHANGE_FROM_SAMPLED_BLOCKS]
+    assert changed == pytest.approx([5.0])
+
+
+def test_only_volume_size_estimates_are_halved_in_the_report():
+    savings = pd.DataFrame({
+        'SnapshotId': ["snap-1", "snap-2", "snap-3"],
+        'VolumeId': ["vol-a", "vol-a", "vol-a"],
+        'VolumeSize': [100, 100, 100],
+        'AgeDays': [400, 400, 400],
+        'CostUSD': [1.0, 1.0, 1.0],
+        'description': ["", "", ""],
+        'Status': ["In Use", "In Use", "In Use"],
+        'ChangedGB': [20.0, 20.0, 20.0],
+        'ChangedGBSource': [CHANGE_FROM_VOLUME_SIZE, CHANGE_FROM_BLOCKS, CHANGE_EXTRAPOLATED],
+    })
+
+    frame = build_snapshot_region_frame("us-east-1", savings)
+
+    assert list(frame["MonthlySavings"]) == [0.5, 1.0, 1.0]
+    assert list(frame["ChangedGBSource"]) == [CHANGE_FROM_VOLUME_SIZE, CHANGE_FROM_BLOCKS, CHANGE_EXTRAPOLATED]
@@ -0,0 +1,136 @@
+import time
+import pandas as pd
+import pytest
+import scanner.util.ebs_snapshots as ebs_snapshots
+from scanner.util.ebs_snapshots import (
+    classify_snapshots,
+    get_aws_snapshot_cost,
+    SNAPSHOT_AMI_BACKED,
+    SNAPSHOT_IN_USE,
+    SNAPSHOT_ORPHANED,
+)
+from scanner.util.records import SnapshotRecord
+
+REGION = "us-east-1"
+PRICE = 0.05
+DAY = 86400
+
+
+class FakeInventory:
+    def __init__(self, snapshots, image_snapshot_ids=(), volume_ids=()):
+        self.snapshots = snapshots
+        self.image_snapshot_ids = frozenset(image_snapshot_ids)
+        self.volume_ids = frozenset(volume_ids)
+        self.looked_up = None
+
+    def get_snapshots(self):
+        return self.snapshots
+
+    def get_image_snapshot_ids(self):
+        return self.image_snapshot_ids
+
+    def get_existing_volume_ids(self, volume_ids):
+        self.looked_up = set(volume_ids)
+        return self.volume_ids.intersection(volume_ids)
+
+
+def snapshot(snapshot_id, volume_id, size, age_days):
+    return SnapshotRecord(snapshot_id, REGION, volume_id, size, time.time() - age_days * DAY)
+
+
+@pytest.fixture
+def scan(monkeypatch):
+    def scan(inventory):
+        monkeypatch.setattr(ebs_snapshots, "get_inventory", lambda profile, region: inventory)
+        monkeypatch.setattr(ebs_snapshots, "get_snapshot_price", lambda profile, region: PRICE)
+        return get_aws_snapshot_cost("test", REGION).set_index("SnapshotId")
+    return scan
+
+
+def test_classify_snapshots():
+    status = classify_snapshots(
+        pd.Series(["snap-ami", "snap-live", "snap-gone", "snap-ami-gone"]),
+        pd.Series(["vol-live", "vol-live", "vol-gone", "vol-gone"]),
+        frozenset({"snap-ami", "snap-ami-gone"}),
+        frozenset({"vol-live"}),
+    )
+
+    assert list(status) == [SNAPSHOT_AMI_BACKED, SNAPSHOT_IN_USE, SNAPSHOT_ORPHANED, SNAPSHOT_AMI_BACKED]
+
+
+def test_sole_snapshots_are_classified_and_costed(scan):
+    inventory = FakeInventory(
+        [
+            snapshot("snap-a1", "vol-a", 100, 500),
+            snapshot("snap-a2", "vol-a", 120, 400),
+            snapshot("snap-gone", "vol-gone", 500, 400),
+            snapshot("snap-ami", "vol-b", 8, 400),
+        ],
+        image_snapshot_ids={"snap-ami"},
+        volume_ids={"vol-a", "vol-b"},
+    )
+    result = scan(inventory)
+
+    assert result["Status"].to_dict() == {
+        "snap-a1": SNAPSHOT_IN_USE,
+        "snap-a2": SNAPSHOT_IN_USE,
+        "snap-gone": SNAPSHOT_ORPHANED,
+        "snap-ami": SNAPSHOT_AMI_BACKED,
+    }
+    assert result.loc["snap-gone", "IsUnused"]
+    # The first snapshot of a volume is a full copy, later ones add half of the size change
+    assert result.loc["snap-gone", "CostUSD"] == pytest.approx(500 * PRICE)
+    assert result.loc["snap-a1", "CostUSD"] == pytest.approx(100 * PRICE)
+    assert result.loc["snap-a2", "CostUSD"] == pytest.approx(10 * PRICE)
+    assert result.loc["snap-a1", "ChangedGBSource"] == "full volume"
+    assert result.loc["snap-a2", "ChangedGBSource"] == "volume size"
+
+
+def test_snapshots_younger_than_the_cutoff_are_skipped(scan):
+    inventory = FakeInventory(
+        [snapshot("snap-old", "vol-old", 10, 400), snapshot("snap-new", "vol-new", 10, 30)],
+        volume_ids={"vol-old", "vol-new"},
+    )
+    result = scan(inventory)
+
+    assert list(result.index) == ["snap-old"]
+    assert inventory.looked_up == {"vol-old"}
+
+
+def test_snapshots_without_a_volume_start_their_own_lineage(scan):
+    inventory = FakeInventory([snapshot("snap-c1", "", 30, 500), snapshot("snap-c2", "", 40, 400)])
+    result = scan(inventory)
+
+    assert result["ChangedGB"].to_dict() == {"snap-c1": 30, "snap-c2": 40}
+    assert set(result["Status"]) == {SNAPSHOT_ORPHANED}
+
+
+def test_snapshots_of_deleted_volumes_start_their_own_lineage(scan):
+    inventory = FakeInventory(
+        [snapshot("snap-d1", "vol-ffffffff", 30, 500), snapshot("snap-d2", "vol-ffffffff", 40, 400)],
+        volume_ids={"vol-ffffffff"},
+    )
+    result = scan(inventory)
+
+    # Not diffed against each other, each copy is costed as a full volume
+    assert result["ChangedGB"].to_dict() == {"snap-d1": 30, "snap-d2": 40}
+    assert set(result["ChangedGBSource"]) == {"full volume"}
+    assert set(result["Status"]) == {SNAPSHOT_ORPHANED}
+    assert inventory.looked_up == set()
+
+
+def test_snapshots_without_a_known_volume_do_not_join_other_lineages(scan):
+    inventory = FakeInventory(
+        [
+            snapshot("snap-a1", "vol-a", 100, 500),
+            snapshot("snap-none", "", 10, 450),
+            snapshot("snap-deleted", "vol-ffffffff", 20, 450),
+            snapshot("snap-a2", "vol-a", 120, 400),
+        ],
+        volume_ids={"vol-a"},
+    )
+    result = scan(inventory)
+
+    assert result["ChangedGB"].to_dict() == {"snap-a1": 100, "snap-a2": 10, "snap-none": 10, "snap-deleted": 20}
+    assert pd.isna(result.loc["snap-deleted", "SnapshotSizeChange"])
+    assert inventory.looked_up == {"vol-a"}
@@ -0,0 +1,134 @@
+import time
+import pandas as pd
+import pytest
+import scanner.util.ebs_volumes as ebs_volumes
+from scanner.util.ebs_volumes import (
+    build_ebs_region_frame,
+    get_region_stopped_instance_volume_savings,
+    EBS_FINDINGS,
+    STOPPED_INSTANCE_SETTINGS,
+)
+from scanner.util.records import InstanceRecord, parse_stop_time, VolumeRecord
+
+REGION = "us-east-1"
+DAY = 86400
+
+
+class FakePricing:
+    volume_pricing = {"gp3": 0.08}
+    default_price_per_gb = 0.1
+
+
+class FakeInventory:
+    def __init__(self, instances, volumes):
+        self.instances = {instance.InstanceId: instance for instance in instances}
+        self.volumes = volumes
+        self.volume_requests = []
+
+    def get_stopped_instances(self):
+        return self.instances
+
+    def get_instance_volumes(self, instance_ids):
+        self.volume_requests.append(set(instance_ids))
+        return [volume for volume in self.volumes if set(instance_ids).intersection(volume.InstanceIds)]
+
+
+def stopped(instance_id, days):
+    return InstanceRecord(instance_id, REGION, "stopped", None if days is None else time.time() - days * DAY)
+
+
+def volume(volume_id, *instance_ids, volume_type="gp3", size=100):
+    return VolumeRecord(volume_id, REGION, volume_type, size, "in-use", instance_ids)
+
+
+def savings(rows):
+    return pd.DataFrame(rows, columns=["VolumeId", "Savings"])
+
+
+@pytest.fixture
+def scan(monkeypatch):
+    def scan(inventory):
+        monkeypatch.setattr(ebs_volumes, "get_all_volumes", lambda profile, region: FakePricing())
+        monkeypatch.setattr(ebs_volumes, "get_inventory", lambda profile, region: inventory)
+        return get_region_stopped_instance_volume_savings("test", REGION)
+    return scan
+
+
+def test_stop_time_is_read_from_the_state_reason():
+    assert parse_stop_time("User initiated (2024-01-31 12:00:00 GMT)") == 1706702400.0
+    assert parse_stop_time("Server.SpotInstanceTermination: Spot instance termination") is None
+    assert parse_stop_time(None) is None
+
+
+def test_only_stopped_instances_keep_a_stop_time():
+    reason = "User initiated (2024-01-31 12:00:00 GMT)"
+    running = InstanceRecord.from_api({"InstanceId": "i-1", "State": {"Name": "running"}, "StateTransitionReason": reason}, REGION)
+    stopped_instance = InstanceRecord.from_api({"InstanceId": "i-2", "State": {"Name": "stopped"}, "StateTransitionReason": reason}, REGION)
+
+    assert running.StoppedAt is None
+    assert stopped_instance.StoppedAt == 1706702400.0
+
+
+def test_volumes_of_long_stopped_instances_are_reported(scan):
+    min_days = STOPPED_INSTANCE_SETTINGS['min_stopped_days']
+    inventory = FakeInventory(
+        [stopped("i-old", min_days + 10), stopped("i-recent", min_days - 1), stopped("i-unknown", None)],
+        [
+            volume("vol-old", "i-old"),
+            volume("vol-io1", "i-old", volume_type="io1", size=10),
+            volume("vol-recent", "i-recent"),
+            volume("vol-unknown", "i-unknown"),
+            volume("vol-shared", "i-old", "i-running"),
+            volume("vol-detached"),
+        ],
+    )
+    result = scan(inventory).set_index("VolumeId")
+
+    assert list(result.index) == ["vol-old", "vol-io1"]
+    assert result.loc["vol-old", "InstanceId"] == "i-old"
+    assert result.loc["vol-old", "StoppedDays"] == min_days + 10
+    assert result["Savings"].to_dict() == pytest.approx({"vol-old": 8.0, "vol-io1": 1.0})
+
+
+def test_regions_without_stopped_instances_have_no_findings(scan):
+    assert scan(FakeInventory([], [volume("vol-1", "i-1")])) is None
+
+
+def test_only_the_volumes_of_long_stopped_instances_are_fetched(scan):
+    min_days = STOPPED_INSTANCE_SETTINGS['min_stopped_days']
+    recent = FakeInventory([stopped("i-recent", min_days - 1), stopped("i-unknown", None)], [volume("vol-1", "i-recent")])
+    old = FakeInventory([stopped("i-old", min_days + 1), stopped("i-recent", min_days - 1)], [volume("vol-1", "i-old")])
+
+    assert scan(recent) is None
+    assert recent.volume_requests == []
+    assert list(scan(old)["VolumeId"]) == ["vol-1"]
+    assert old.volume_requests == [{"i-old"}]
+
+
+def test_volumes_with_several_findings_are_counted_once():
+    frame = build_ebs_region_frame("us-east-1", {
+        "unused": savings([("vol-1", 10.0)]),
+        "gp2": savings([("vol-1", 2.0), ("vol-2", 3.0), ("vol-3", 4.0)]),
+        "stopped": savings([("vol-3", 20.0)]),
+    })
+    rows = {(row.VolumeId, row.Findings): row.MonthlySavings for row in frame.itertuples()}
+
+    assert rows == {
+        ("vol-1", EBS_FINDINGS["unused"]): 10.0,
+        ("vol-1", "{} (counted in {})".format(EBS_FINDINGS["gp2"], EBS_FINDINGS["unused"])): 0.0,
+        ("vol-2", EBS_FINDINGS["gp2"]): 3.0,
+        ("vol-3", "{} (counted in {})".format(EBS_FINDINGS["gp2"], EBS_FINDINGS["stopped"])): 0.0,
+        ("vol-3", EBS_FINDINGS["stopped"]): 20.0,
+    }
+    assert frame["MonthlySavings"].sum() == 33.0
+
+
+def test_gp2_findings_alone_keep_their_savings():
+    frame = build_ebs_region_frame("us-east-1", {"gp2": savings([("vol-2", 3.0)]), "unused": None})
+
+    assert list(frame["Findings"]) == [EBS_FINDINGS["gp2"]]
+    assert list(frame["MonthlySavings"]) == [3.0]
+
+
+def test_no_findings():
+    assert build_ebs_region_frame("us-east-1", {"unused": None, "gp2": savings([])}) is None
@@ -0,0 +1,236 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import scanner.util.inventory as inventory_module
+from scanner.util.inventory import RegionInventory, VOLUME_ID_FILTER_LIMIT, VOLUME_ID_LOOKUP_MAX_CALLS
+from scanner.util.records import VolumeRecord
+
+
+FILTER_FIELDS = {'volume-id': 'VolumeId', 'status': 'State', 'volume-type': 'VolumeType'}
+
+
+def filter_values(volume, name):
+    if name == 'attachment.instance-id':
+        return volume.InstanceIds
+    return (getattr(volume, FILTER_FIELDS[name]),)
+
+
+class FakeVolumes:
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.requests = []
+        self.error = None
+
+    def __call__(self, profile, region, page_size=None, filters=None):
+        self.requests.append(filters)
+        if self.error is not None:
+            raise self.error
+        for volume in self.volumes:
+            if all(set(values).intersection(filter_values(volume, name)) for name, values in (filters or {}).items()):
+                yield volume
+
+
+def volume(volume_id, volume_type="gp3", state="in-use", instance_ids=()):
+    return VolumeRecord(volume_id, "us-east-1", volume_type, 10, state, instance_ids)
+
+
+@pytest.fixture
+def volumes(monkeypatch):
+    volumes = FakeVolumes([volume("vol-1"), volume("vol-2"), volume("vol-3")])
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", volumes)
+    return volumes
+
+
+def test_source_volumes_are_looked_up_by_id(volumes):
+    inventory = RegionInventory("test", "us-east-1")
+
+    assert inventory.get_existing_volume_ids(["vol-1", "vol-9", ""]) == {"vol-1"}
+    assert volumes.requests == [{'volume-id': ["vol-1", "vol-9"]}]
+
+    # Known and missing volumes are not looked up again
+    assert inventory.get_existing_volume_ids(["vol-1", "vol-9", "vol-2"]) == {"vol-1", "vol-2"}
+    assert volumes.requests[1:] == [{'volume-id': ["vol-2"]}]
+
+
+def test_lookups_are_chunked_to_the_filter_limit(volumes):
+    volume_ids = ["vol-{}".format(index) for index in range(VOLUME_ID_FILTER_LIMIT + 1)]
+
+    assert RegionInventory("test", "us-east-1").get_existing_volume_ids(volume_ids) == {"vol-1", "vol-2", "vol-3"}
+    assert [len(request['volume-id']) for request in volumes.requests] == [VOLUME_ID_FILTER_LIMIT, 1]
+
+
+def test_too_many_lookups_fetch_the_whole_inventory(volumes):
+    volume_ids = ["vol-{}".format(index) for index in range(VOLUME_ID_FILTER_LIMIT * VOLUME_ID_LOOKUP_MAX_CALLS + 1)]
+
+    assert RegionInventory("test", "us-east-1").get_existing_volume_ids(volume_ids) == {"vol-1", "vol-2", "vol-3"}
+    assert volumes.requests == [None]
+
+
+def test_filtered_fetches_answer_for_their_volumes(volumes):
+    inventory = RegionInventory("test", "us-east-1")
+    inventory.get_volumes({'status': ['in-use']})
+
+    assert inventory.get_existing_volume_ids(["vol-1", "vol-2"]) == {"vol-1", "vol-2"}
+    assert volumes.requests == [{'status': ('in-use',)}]
+
+
+def test_resources_of_a_region_are_fetched_in_parallel(monkeypatch):
+    # Each fetch waits for the other two, so the barrier breaks if they run one after another
+    barrier = threading.Barrier(3, timeout=5)
+
+    def fetch(result):
+        def fetch(*args, **kwargs):
+            barrier.wait()
+            return iter(result)
+        return fetch
+
+    monkeypatch.setattr(inventory_module, "get_ebs_snapshots", fetch(["snap-1"]))
+    monkeypatch.setattr(inventory_module, "get_image_snapshot_ids", fetch(["snap-2"]))
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", fetch([VolumeRecord("vol-1", "us-east-1", "gp2", 10, "in-use")]))
+    inventory = RegionInventory("test", "us-east-1")
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        snapshots = executor.submit(inventory.get_snapshots)
+        image_snapshot_ids = executor.submit(inventory.get_image_snapshot_ids)
+        volumes = executor.submit(inventory.get_volumes)
+
+    assert snapshots.result() == ["snap-1"]
+    assert image_snapshot_ids.result() == frozenset({"snap-2"})
+    assert [volume.VolumeId for volume in volumes.result()] == ["vol-1"]
+
+
+def test_volume_fetches_in_flight_are_shared(volumes, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    fetch = volumes.__call__
+
+    def slow_volumes(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return fetch(*args, **kwargs)
+
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", slow_volumes)
+    inventory = RegionInventory("test", "us-east-1")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(inventory.get_volumes)
+        started.wait(5)
+        second = executor.submit(inventory.get_volumes, {'status': ['in-use']})
+        release.set()
+
+    assert len(first.result()) == len(second.result()) == 3
+    assert volumes.requests == [None]
+
+
+@pytest.fixture
+def mixed_volumes(monkeypatch):
+    volumes = FakeVolumes([
+        volume("vol-free", state="available"),
+        volume("vol-free-gp2", volume_type="gp2", state="available"),
+        volume("vol-used-gp2", volume_type="gp2"),
+        volume("vol-creating-gp2", volume_type="gp2", state="creating"),
+        volume("vol-used"),
+    ])
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", volumes)
+    return volumes
+
+
+def test_registered_needs_are_fetched_together_without_overlap(mixed_volumes):
+    inventory = RegionInventory("test", "us-east-1")
+    inventory.require_volumes({'status': ['available']})
+    inventory.require_volumes({'volume-type': ['gp2']})
+
+    assert [volume.VolumeId for volume in inventory.get_volumes({'status': ['available']})] == ["vol-free", "vol-free-gp2"]
+    assert mixed_volumes.requests == [
+        {'status': ('available',)},
+        {'volume-type': ('gp2',), 'status': ('creating', 'deleted', 'deleting', 'error', 'in-use')},
+    ]
+
+    # Later needs covered by the merged fetches are answered without another call
+    gp2 = inventory.get_volume_frame({'volume-type': ['gp2']})
+    assert sorted(gp2['VolumeId']) == ["vol-creating-gp2", "vol-free-gp2", "vol-used-gp2"]
+    assert len(mixed_volumes.requests) == 2
+
+    inventory.get_volumes()
+    assert mixed_volumes.requests[2:] == [None]
+
+
+def test_needs_of_a_failed_fetch_are_fetched_again(mixed_volumes):
+    inventory = RegionInventory("test", "us-east-1")
+    inventory.require_volumes({'status': ['available']})
+    inventory.require_volumes({'volume-type': ['gp2']})
+    mixed_volumes.error = RuntimeError("RequestLimitExceeded")
+
+    with pytest.raises(RuntimeError):
+        inventory.get_volumes({'status': ['available']})
+
+    mixed_volumes.error = None
+    del mixed_volumes.requests[:]
+    assert [volume.VolumeId for volume in inventory.get_volumes({'volume-type': ['gp2']})] == [
+        "vol-free-gp2", "vol-used-gp2", "vol-creating-gp2",
+    ]
+    assert mixed_volumes.requests == [
+        {'status': ('available',)},
+        {'volume-type': ('gp2',), 'status': ('creating', 'deleted', 'deleting', 'error', 'in-use')},
+    ]
+    assert [volume.VolumeId for volume in inventory.get_volumes({'status': ['available']})] == ["vol-free", "vol-free-gp2"]
+    assert len(mixed_volumes.requests) == 2
+
+
+def test_failed_fetches_are_raised_to_every_waiter(mixed_volumes, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_volumes(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        raise RuntimeError("RequestLimitExceeded")
+
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", failing_volumes)
+    inventory = RegionInventory("test", "us-east-1")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(inventory.get_volumes)
+        started.wait(5)
+        second = executor.submit(inventory.get_volumes, {'status': ['available']})
+        release.set()
+
+    for waiter in (first, second):
+        with pytest.raises(RuntimeError):
+            waiter.result()
+
+
+def test_instance_volumes_are_looked_up_by_attachment(monkeypatch):
+    volumes = FakeVolumes([
+        volume("vol-1", instance_ids=("i-1",)),
+        volume("vol-2", instance_ids=("i-2",)),
+        volume("vol-shared", instance_ids=("i-1", "i-2")),
+        volume("vol-free", state="available"),
+    ])
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", volumes)
+    inventory = RegionInventory("test", "us-east-1")
+
+    assert inventory.get_instance_volumes([]) == []
+    assert {v.VolumeId for v in inventory.get_instance_volumes(["i-1"])} == {"vol-1", "vol-shared"}
+    assert volumes.requests == [{'attachment.instance-id': ["i-1"]}]
+
+
+def test_instance_volume_lookups_are_chunked(monkeypatch):
+    volumes = FakeVolumes([volume("vol-1", instance_ids=("i-0",)), volume("vol-2", instance_ids=("i-0", "i-1"))])
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", volumes)
+    instance_ids = ["i-{}".format(index) for index in range(VOLUME_ID_FILTER_LIMIT + 1)]
+
+    result = RegionInventory("test", "us-east-1").get_instance_volumes(instance_ids)
+
+    assert sorted(v.VolumeId for v in result) == ["vol-1", "vol-2"]
+    assert [len(request['attachment.instance-id']) for request in volumes.requests] == [VOLUME_ID_FILTER_LIMIT, 1]
+
+
+def test_instance_volumes_are_answered_from_fetched_in_use_volumes(monkeypatch):
+    volumes = FakeVolumes([volume("vol-1", instance_ids=("i-1",)), volume("vol-2", instance_ids=("i-2",))])
+    monkeypatch.setattr(inventory_module, "get_ebs_volumes", volumes)
+    inventory = RegionInventory("test", "us-east-1")
+    inventory.get_volumes({'status': ['in-use']})
+
+    assert [v.VolumeId for v in inventory.get_instance_volumes(["i-2"])] == ["vol-2"]
+    assert volumes.requests == [{'status': ('in-use',)}]
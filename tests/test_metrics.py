@@ -0,0 +1,46 @@
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import scanner.util.metrics as metrics
+from scanner.util.metrics import profile_call, profile_task, save_profile, start_profiling
+
+
+def analyzer(region):
+    return sum(range(1000)) and region
+
+
+def scan(regions):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return list(executor.map(lambda region: profile_task(analyzer, region), regions))
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(metrics, "_profiles", None)
+    start_profiling()
+
+
+def test_workers_are_profiled_separately_when_cprofile_sees_one_thread(profiling, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "PROFILER_SEES_ALL_THREADS", False)
+
+    assert profile_call(scan, ["us-east-1", "eu-west-1"]) == ["us-east-1", "eu-west-1"]
+    assert len(metrics._profiles) == 3
+
+    save_profile(str(tmp_path / "scan.prof"))
+    functions = {function for _, _, function in pstats.Stats(str(tmp_path / "scan.prof")).stats}
+    assert {"scan", "analyzer"} <= functions
+
+
+def test_workers_start_no_profiler_when_cprofile_sees_every_thread(profiling, monkeypatch):
+    monkeypatch.setattr(metrics, "PROFILER_SEES_ALL_THREADS", True)
+
+    assert profile_call(scan, ["us-east-1", "eu-west-1"]) == ["us-east-1", "eu-west-1"]
+    # Only the profiler of the run, a second active one raises ValueError from Python 3.12
+    assert len(metrics._profiles) == 1
+
+
+def test_tasks_are_not_profiled_when_profiling_is_off(monkeypatch):
+    monkeypatch.setattr(metrics, "_profiles", None)
+
+    assert profile_task(analyzer, "us-east-1") == "us-east-1"
+    assert metrics._profiles is None
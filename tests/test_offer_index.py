@@ -0,0 +1,175 @@
+import io
+import json
+import os
+import pytest
+import scanner.util.offer_index as offer_index
+from scanner.util.offer_index import (
+    build_offer_index,
+    get_offline_index,
+    iter_csv_offer_prices,
+    iter_json_offer_prices,
+    set_offline_pricing,
+    OfferIndex,
+    SNAPSHOT_USAGE_TYPE,
+    VOLUME_USAGE_PREFIX,
+)
+
+
+def on_demand(price, unit="GB-Mo"):
+    return {"TERM": {"priceDimensions": {"DIM": {"unit": unit, "pricePerUnit": {"USD": price}}}}}
+
+
+OFFER = {
+    "formatVersion": "v1.0",
+    "offerCode": "AmazonEC2",
+    "version": 20240101000000,
+    "products": {
+        "GP3": {
+            "productFamily": "Storage",
+            "attributes": {"regionCode": "us-east-1", "volumeApiName": "gp3", "locationType": "AWS Region"},
+        },
+        "GP2": {
+            "productFamily": "Storage",
+            "attributes": {"regionCode": "eu-west-1", "volumeApiName": "gp2", "locationType": "AWS Region"},
+        },
+        "SNAP": {
+            "productFamily": "Storage Snapshot",
+            "attributes": {"regionCode": "eu-west-1", "usagetype": "EU-EBS:SnapshotUsage", "locationType": "AWS Region"},
+        },
+        "ARCHIVE": {
+            "productFamily": "Storage Snapshot",
+            "attributes": {"regionCode": "eu-west-1", "usagetype": "EU-EBS:SnapshotArchiveStorage"},
+        },
+        "LOCAL_ZONE": {
+            "productFamily": "Storage",
+            "attributes": {"regionCode": "us-east-1", "volumeApiName": "gp3", "locationType": "AWS Local Zone"},
+        },
+        "INSTANCE": {
+            "productFamily": "Compute Instance",
+            "attributes": {"regionCode": "us-east-1", "instanceType": "m5.large", "vcpu": 2},
+        },
+    },
+    "terms": {
+        "OnDemand": {
+            "GP3": on_demand("0.0800000000"),
+            "GP2": on_demand("0.1100000000"),
+            "SNAP": on_demand("0.0500000000"),
+            "ARCHIVE": on_demand("0.0125000000"),
+            "LOCAL_ZONE": on_demand("0.0960000000"),
+            "INSTANCE": on_demand("0.0960000000", unit="Hrs"),
+            # Terms of a product missing from the products section are skipped
+            "UNKNOWN": on_demand("1.0"),
+        },
+        "Reserved": {
+            "INSTANCE": {"RESERVED": {"termAttributes": {"LeaseContractLength": "1yr"}, "priceDimensions": {}}},
+        },
+    },
+}
+
+EXPECTED = [
+    ("us-east-1", VOLUME_USAGE_PREFIX + "gp3", 0.08),
+    ("eu-west-1", VOLUME_USAGE_PREFIX + "gp2", 0.11),
+    ("eu-west-1", SNAPSHOT_USAGE_TYPE, 0.05),
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 20])
+def test_json_offer_is_parsed_across_chunk_boundaries(chunk_size):
+    prices = list(iter_json_offer_prices(io.StringIO(json.dumps(OFFER, indent=1)), chunk_size=chunk_size))
+
+    assert sorted(prices) == sorted(EXPECTED)
+
+
+def test_numbers_split_across_chunks_are_read_whole():
+    offer = dict(OFFER, version=12345678901234567890)
+    document = json.dumps(offer, separators=(",", ":"))
+
+    for chunk_size in range(1, 24):
+        assert sorted(iter_json_offer_prices(io.StringIO(document), chunk_size=chunk_size)) == sorted(EXPECTED)
+
+
+def test_offer_without_products_has_no_prices():
+    offer = {"products": {}, "terms": {"OnDemand": {"GP3": on_demand("0.08")}}}
+
+    assert list(iter_json_offer_prices(io.StringIO(json.dumps(offer)), chunk_size=5)) == []
+
+
+def test_truncated_json_offer_is_an_error():
+    document = json.dumps(OFFER)
+
+    with pytest.raises(ValueError):
+        list(iter_json_offer_prices(io.StringIO(document[:len(document) // 2]), chunk_size=16))
+
+
+def test_csv_offer_skips_metadata_and_other_terms():
+    document = "\n".join([
+        '"FormatVersion","v1.0"',
+        '"Publication Date","2024-01-01T00:00:00Z"',
+        '"SKU","TermType","Unit","PricePerUnit","Product Family","Location Type","Region Code","Volume API Name","usageType"',
+        '"GP3","OnDemand","GB-Mo","0.08","Storage","AWS Region","us-east-1","gp3","EBS:VolumeUsage.gp3"',
+        '"GP3","Reserved","GB-Mo","0.07","Storage","AWS Region","us-east-1","gp3","EBS:VolumeUsage.gp3"',
+        '"SNAP","OnDemand","GB-Mo","0.05","Storage Snapshot","AWS Region","eu-west-1","","EU-EBS:SnapshotUsage"',
+        '"INSTANCE","OnDemand","Hrs","0.096","Compute Instance","AWS Region","us-east-1","",""',
+    ])
+
+    assert list(iter_csv_offer_prices(io.StringIO(document))) == [
+        ("us-east-1", VOLUME_USAGE_PREFIX + "gp3", 0.08),
+        ("eu-west-1", SNAPSHOT_USAGE_TYPE, 0.05),
+    ]
+
+
+def test_csv_offer_without_header_is_an_error():
+    with pytest.raises(ValueError):
+        list(iter_csv_offer_prices(io.StringIO('"FormatVersion","v1.0"\n')))
+
+
+@pytest.fixture
+def index(tmp_path):
+    offer_path = tmp_path / "offer.json"
+    offer_path.write_text(json.dumps(OFFER))
+    index = OfferIndex(build_offer_index(str(offer_path), str(tmp_path / "offer.idx")))
+    yield index
+    index.close()
+
+
+def test_index_finds_every_price(index):
+    assert len(index) == len(EXPECTED)
+    for region, usage_type, price in EXPECTED:
+        assert index.get_price(region, usage_type) == pytest.approx(price)
+    assert list(index.iter_prices()) == sorted(EXPECTED)
+
+
+def test_index_misses_are_none(index):
+    assert index.get_price("eu-west-1", VOLUME_USAGE_PREFIX + "gp3") is None
+    assert index.get_price("aa-east-1", SNAPSHOT_USAGE_TYPE) is None
+    assert index.get_price("zz-west-9", SNAPSHOT_USAGE_TYPE) is None
+
+
+def test_other_files_are_not_read_as_an_index(tmp_path):
+    path = tmp_path / "offer.idx"
+    path.write_bytes(b"NOTANIDX" + bytes(8))
+
+    with pytest.raises(ValueError):
+        OfferIndex(str(path))
+
+
+def test_index_is_rebuilt_when_the_offer_file_is_newer(tmp_path, monkeypatch):
+    offer_path = tmp_path / "offer.json"
+    index_path = tmp_path / "offer.idx"
+    offer_path.write_text(json.dumps(OFFER))
+    monkeypatch.setattr(offer_index, "_offline_index_path", None)
+    monkeypatch.setattr(offer_index, "_offline_index", None)
+
+    set_offline_pricing(str(offer_path), str(index_path))
+    built_at = index_path.stat().st_mtime
+    set_offline_pricing(str(offer_path), str(index_path))
+    assert index_path.stat().st_mtime == built_at
+
+    offer = json.loads(json.dumps(OFFER))
+    offer["terms"]["OnDemand"]["GP3"] = on_demand("0.0900000000")
+    offer_path.write_text(json.dumps(offer))
+    os.utime(offer_path, (built_at + 10, built_at + 10))
+    set_offline_pricing(str(offer_path), str(index_path))
+
+    assert get_offline_index().get_price("us-east-1", VOLUME_USAGE_PREFIX + "gp3") == pytest.approx(0.09)
+    get_offline_index().close()
@@ -0,0 +1,65 @@
+import pytest
+import scanner.util.pricing_cache as pricing_cache
+from scanner.util.pricing_cache import PricingCache
+
+KEY = ("AmazonEC2", "us-east-1", "EBS:SnapshotUsage")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pricing_cache, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return PricingCache(str(tmp_path / "pricing.json"), ttl=100)
+
+
+def test_entries_expire_after_the_ttl(cache, clock):
+    cache.put(*KEY, 0.05)
+    clock.now += 100
+    assert cache.get(*KEY) == 0.05
+
+    clock.now += 1
+    assert cache.get(*KEY) is None
+    assert cache.get(*KEY, allow_expired=True) == 0.05
+
+
+def test_refresh_only_skips_entries_cached_before_it(cache, clock, monkeypatch):
+    cache.put(*KEY, 0.05)
+    clock.now += 1
+    monkeypatch.setattr(pricing_cache, "get_pricing_cache", lambda: cache)
+    pricing_cache.configure_pricing_cache(refresh=True)
+
+    assert cache.get(*KEY) is None
+    assert cache.find("AmazonEC2", "EBS:") == {}
+
+    # Once refetched the price is fresh again, so later scans of a long running service reuse it
+    clock.now += 1
+    cache.put(*KEY, 0.06)
+    assert cache.get(*KEY) == 0.06
+    assert cache.find("AmazonEC2", "EBS:") == {("us-east-1", "EBS:SnapshotUsage"): 0.06}
+
+
+def test_saved_entries_are_merged_with_other_processes(cache, clock):
+    other = PricingCache(cache.path, ttl=100)
+    other.put("AmazonEC2", "eu-west-1", "EBS:SnapshotUsage", 0.055)
+    other.save()
+
+    clock.now += 1
+    cache.put(*KEY, 0.05)
+    cache.save()
+
+    reloaded = PricingCache(cache.path, ttl=100)
+    assert reloaded.get(*KEY) == 0.05
+    assert reloaded.get("AmazonEC2", "eu-west-1", "EBS:SnapshotUsage") == 0.055
@@ -0,0 +1,145 @@
+import pytest
+import scanner.util.rate_limiter as rate_limiter
+from scanner.util.rate_limiter import (
+    TokenBucket,
+    RateLimiter,
+    call_with_retries,
+    is_throttling_error,
+    MIN_RATE,
+    RATE_RECOVERY,
+    THROTTLE_BACKOFF,
+    THROTTLE_COOLDOWN,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ThrottlingError(Exception):
+    response = {"Error": {"Code": "ThrottlingException"}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def test_burst_is_served_without_waiting(clock):
+    bucket = TokenBucket(10.0, 5)
+
+    assert [bucket.acquire() for _ in range(5)] == [0.0] * 5
+    assert clock.sleeps == []
+
+
+def test_empty_bucket_waits_for_the_next_token(clock):
+    bucket = TokenBucket(10.0, 1)
+    bucket.acquire()
+
+    assert bucket.acquire() == pytest.approx(0.1)
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_throttle_backs_off_and_empties_the_bucket(clock):
+    bucket = TokenBucket(10.0, 5)
+    bucket.throttled()
+
+    assert bucket.rate == pytest.approx(10.0 * THROTTLE_BACKOFF)
+    assert bucket.tokens <= 0
+    assert bucket.throttles == 1
+
+
+def test_throttles_within_the_cooldown_back_off_once(clock):
+    bucket = TokenBucket(10.0, 5)
+    bucket.throttled()
+    clock.now += THROTTLE_COOLDOWN / 2
+    bucket.throttled()
+
+    assert bucket.rate == pytest.approx(10.0 * THROTTLE_BACKOFF)
+    assert bucket.throttles == 2
+
+    clock.now += THROTTLE_COOLDOWN
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(10.0 * THROTTLE_BACKOFF ** 2)
+
+
+def test_rate_never_drops_below_the_minimum(clock):
+    bucket = TokenBucket(1.0, 1)
+    for _ in range(10):
+        bucket.throttled()
+        clock.now += THROTTLE_COOLDOWN
+
+    assert bucket.rate == MIN_RATE
+
+
+def test_successful_calls_recover_up_to_the_configured_rate(clock):
+    bucket = TokenBucket(10.0, 5)
+    bucket.throttled()
+    bucket.succeeded()
+
+    assert bucket.rate == pytest.approx(10.0 * THROTTLE_BACKOFF + 10.0 * RATE_RECOVERY)
+
+    for _ in range(1000):
+        bucket.succeeded()
+    assert bucket.rate == 10.0
+
+
+def test_buckets_are_kept_per_profile_region_and_operation():
+    limiter = RateLimiter({"ec2": (20.0, 100), "ec2.DescribeSnapshots": (5.0, 5)})
+    bucket = limiter.get_bucket("a", "us-east-1", "ec2", "DescribeVolumes")
+
+    assert limiter.get_bucket("a", "us-east-1", "ec2", "DescribeVolumes") is bucket
+    assert limiter.get_bucket("a", "eu-west-1", "ec2", "DescribeVolumes") is not bucket
+    assert limiter.get_bucket("b", "us-east-1", "ec2", "DescribeVolumes") is not bucket
+    assert (bucket.rate, bucket.burst) == (20.0, 100)
+    assert limiter.get_bucket("a", "us-east-1", "ec2", "DescribeSnapshots").rate == 5.0
+    assert limiter.get_bucket("a", "us-east-1", "s3", "ListBuckets").rate == rate_limiter.DEFAULT_RATE_LIMIT[0]
+
+
+def test_throttling_is_found_in_the_cause_chain():
+    try:
+        try:
+            raise ThrottlingError()
+        except ThrottlingError as e:
+            raise RuntimeError("Unable to load the EBS volumes") from e
+    except RuntimeError as e:
+        assert is_throttling_error(e)
+
+    assert not is_throttling_error(ValueError("bad filter"))
+
+
+def test_throttled_calls_are_retried(clock):
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ThrottlingError()
+        return "done"
+
+    assert call_with_retries(flaky, attempts=3) == "done"
+    assert len(clock.sleeps) == 2
+
+
+def test_other_errors_are_not_retried(clock):
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ValueError("bad filter")
+
+    with pytest.raises(ValueError):
+        call_with_retries(broken, attempts=3)
+    assert len(calls) == 1
+    assert clock.sleeps == []
@@ -0,0 +1,116 @@
+import pandas as pd
+import pytest
+from scanner.util.report import (
+    ArrowReportSink,
+    CsvReportSink,
+    JsonlReportSink,
+    ParquetReportSink,
+    ReportSink,
+)
+
+SCHEMA = {"Region": "string", "VolumeId": "string", "SizeGB": "Int64", "MonthlySavings": "float64"}
+
+REGIONS = {
+    "us-east-1": [("vol-1", 100, 8.0), ("vol-2", None, 1.5)],
+    "eu-west-1": [("vol-3", 10, 0.25)],
+    "eu-west-2": [],
+}
+
+EXPECTED = pd.DataFrame([
+    ("us-east-1", "vol-1", 100, 8.0),
+    ("us-east-1", "vol-2", None, 1.5),
+    ("us-east-1", None, None, 9.5),
+    ("eu-west-1", "vol-3", 10, 0.25),
+    ("eu-west-1", None, None, 0.25),
+    ("Total Savings", None, None, 9.75),
+], columns=list(SCHEMA)).astype(SCHEMA)
+
+
+def build_region_frame(region, rows):
+    if not rows:
+        return None
+    return pd.DataFrame(rows, columns=["VolumeId", "SizeGB", "MonthlySavings"]).assign(Region=region)
+
+
+def build_total_frame(region, total):
+    return pd.DataFrame({"Region": [region or "Total Savings"], "MonthlySavings": [total]})
+
+
+def write_report(sink_class, path):
+    sink = sink_class(str(path), SCHEMA, build_region_frame, build_total_frame)
+    for region, rows in REGIONS.items():
+        sink.write_region(region, rows)
+    assert sink.region_totals == {"us-east-1": 9.5, "eu-west-1": 0.25}
+    return sink.close()
+
+
+def test_csv_report_round_trip(tmp_path):
+    path = write_report(CsvReportSink, tmp_path / "report.csv")
+
+    pd.testing.assert_frame_equal(pd.read_csv(path).astype(SCHEMA), EXPECTED)
+
+
+def test_jsonl_report_round_trip(tmp_path):
+    path = write_report(JsonlReportSink, tmp_path / "report.jsonl")
+
+    pd.testing.assert_frame_equal(pd.read_json(path, lines=True, dtype=False).astype(SCHEMA), EXPECTED)
+    with open(path) as infile:
+        assert infile.read().endswith("}\n")
+
+
+def test_parquet_report_has_one_row_group_per_region(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = write_report(ParquetReportSink, tmp_path / "report.parquet")
+
+    pd.testing.assert_frame_equal(pd.read_parquet(path).astype(SCHEMA), EXPECTED)
+    # us-east-1, eu-west-1 and the grand total
+    assert pq.ParquetFile(path).num_row_groups == 3
+
+
+def test_arrow_report_has_one_record_batch_per_region(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pytest.importorskip("pyarrow.ipc")
+    path = write_report(ArrowReportSink, tmp_path / "report.arrow")
+
+    with pa.ipc.open_file(path) as reader:
+        assert reader.num_record_batches == 3
+        assert reader.schema.field("SizeGB").type == pa.int64()
+        frame = reader.read_pandas()
+    pd.testing.assert_frame_equal(frame.astype(SCHEMA), EXPECTED)
+
+
+def test_reports_without_findings_are_not_written(tmp_path):
+    sink = CsvReportSink(str(tmp_path / "report.csv"), SCHEMA, build_region_frame, build_total_frame)
+    sink.write_region("us-east-1", [])
+
+    assert sink.close() is None
+    assert not (tmp_path / "report.csv").exists()
+
+
+def test_sinks_must_write_and_finish():
+    class IncompleteSink(ReportSink):
+        def write_frame(self, frame):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteSink(None, SCHEMA, build_region_frame, build_total_frame)
+
+
+def test_each_region_is_written_at_once():
+    class RecordingSink(ReportSink):
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.writes = []
+
+        def write_frame(self, frame):
+            self.writes.append(list(frame["Region"]))
+
+        def finish(self):
+            pass
+
+    sink = RecordingSink(None, SCHEMA, build_region_frame, build_total_frame)
+    for region, rows in REGIONS.items():
+        sink.write_region(region, rows)
+    sink.close()
+
+    assert sink.writes == [["us-east-1"] * 3, ["eu-west-1"] * 2, ["Total Savings"]]
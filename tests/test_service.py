@@ -0,0 +1,137 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pandas as pd
+import pytest
+import scanner.util.service as service
+from scanner.util.service import ScannerRequestHandler, ScannerService, ScanResult, ThreadingHTTPServer
+
+
+class FakeSink:
+    def __init__(self, frame):
+        self.frame = frame
+        self.region_totals = frame.groupby("Region")["MonthlySavings"].sum().to_dict()
+        self.total = frame["MonthlySavings"].sum()
+
+    def to_frame(self):
+        return self.frame
+
+
+def build_result():
+    frame = pd.DataFrame({
+        "Region": ["us-east-1", "eu-west-1"],
+        "VolumeId": ["vol-1", "vol-2"],
+        "MonthlySavings": [8.0, 1.5],
+    })
+    return ScanResult(0.0, ["us-east-1", "eu-west-1"], {"ebs_volumes": FakeSink(frame)}, {}, {"phases": {}})
+
+
+@pytest.fixture
+def server():
+    scanner_service = ScannerService("test")
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ScannerRequestHandler)
+    httpd.service = scanner_service
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def request(server, path, method="GET"):
+    url = "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method=method)) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_status_before_the_first_scan(server):
+    status, headers, body = request(server, "/status")
+
+    assert status == 200
+    assert headers["Content-Type"] == "application/json"
+    assert json.loads(body) == {"profile": "test", "scans": 0, "scanning": False, "next_scan_at": None, "latest": None}
+
+
+def test_reports_are_unavailable_before_the_first_scan(server):
+    status, _, body = request(server, "/reports/ebs_volumes.json")
+
+    assert status == 503
+    assert "error" in json.loads(body)
+
+
+def test_reports_are_served_as_json_and_csv(server):
+    server.service.latest = build_result()
+
+    status, headers, body = request(server, "/reports/ebs_volumes.json")
+    assert status == 200
+    assert "Last-Modified" in headers
+    assert [row["VolumeId"] for row in json.loads(body)] == ["vol-1", "vol-2"]
+
+    status, headers, body = request(server, "/totals.csv")
+    assert status == 200
+    assert headers["Content-Type"] == "text/csv; charset=utf-8"
+    assert body.decode().splitlines() == [
+        "Report,Region,MonthlySavings",
+        "ebs_volumes,eu-west-1,1.50",
+        "ebs_volumes,us-east-1,8.00",
+        "ebs_volumes,Total,9.50",
+    ]
+
+    status, _, body = request(server, "/status")
+    assert json.loads(body)["latest"]["savings"] == {"ebs_volumes": 9.5}
+
+
+@pytest.mark.parametrize("path, status", [
+    ("/reports/unknown.json", 404),
+    ("/reports/ebs_volumes.xml", 404),
+    ("/metrics.csv", 404),
+    ("/snapshots.json", 404),
+])
+def test_unknown_resources_are_not_found(server, path, status):
+    server.service.latest = build_result()
+
+    assert request(server, path)[0] == status
+
+
+def test_scan_requests_wake_the_schedule(server):
+    assert request(server, "/scan", method="POST")[0] == 202
+    assert server.service._wake.is_set()
+    assert request(server, "/other", method="POST")[0] == 404
+
+
+def test_schedule_survives_a_scan_that_fails_before_it_starts(monkeypatch):
+    scanner_service = ScannerService("test", regions=["us-east-1"], interval=0)
+    attempts = []
+
+    def create_frame_report_sinks():
+        attempts.append(True)
+        if len(attempts) == 3:
+            scanner_service.stop()
+        raise OSError("disk full")
+
+    monkeypatch.setattr(service, "create_frame_report_sinks", create_frame_report_sinks)
+    scanner_service.run_schedule()
+
+    assert len(attempts) == 3
+    assert not scanner_service.scanning
+    assert scanner_service.next_scan_at is not None
+
+
+def test_schedule_survives_errors_outside_the_scan(monkeypatch):
+    scanner_service = ScannerService("test", interval=0)
+    attempts = []
+
+    def scan():
+        attempts.append(True)
+        if len(attempts) == 2:
+            scanner_service.stop()
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(scanner_service, "scan", scan)
+    scanner_service.run_schedule()
+
+    assert len(attempts) == 2
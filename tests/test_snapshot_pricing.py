@@ -0,0 +1,113 @@
+import json
+import pytest
+import scanner.ebs_snapshots.snapshot as snapshot
+import scanner.util.offer_index as offer_index
+from scanner.ebs_snapshots.snapshot import EBSSnapshots
+
+
+class FakePricingCache:
+    def __init__(self, price=None, stale_price=None):
+        self.price = price
+        self.stale_price = stale_price
+        self.saved = {}
+
+    def get(self, service_code, region, usage_type, allow_expired=False):
+        return self.stale_price if allow_expired else self.price
+
+    def put(self, service_code, region, usage_type, price, unit=None):
+        self.saved[(service_code, region, usage_type)] = price
+
+    def save(self):
+        pass
+
+
+def snapshot_product(region, usage_type, price):
+    return json.dumps({
+        "product": {
+            "productFamily": "Storage Snapshot",
+            "attributes": {"regionCode": region, "usagetype": usage_type, "locationType": "AWS Region"},
+        },
+        "terms": {"OnDemand": {"SKU.TERM": {"priceDimensions": {
+            "SKU.TERM.DIM": {"unit": "GB-Mo", "pricePerUnit": {"USD": str(price)}},
+        }}}},
+    })
+
+
+def fail_pricing_api(*args):
+    raise AssertionError("The Pricing API should not be called")
+
+
+@pytest.fixture
+def offline_index(tmp_path, monkeypatch):
+    offer = {
+        "products": {
+            "SNAP": {
+                "productFamily": "Storage Snapshot",
+                "attributes": {"regionCode": "eu-north-1", "usagetype": "EUN1-EBS:SnapshotUsage", "locationType": "AWS Region"},
+            },
+        },
+        "terms": {"OnDemand": {"SNAP": {"SNAP.TERM": {"priceDimensions": {
+            "SNAP.TERM.DIM": {"unit": "GB-Mo", "pricePerUnit": {"USD": "0.0525"}},
+        }}}}},
+    }
+    offer_path = tmp_path / "offer.json"
+    offer_path.write_text(json.dumps(offer))
+    index_path = str(tmp_path / "offer.idx")
+    offer_index.build_offer_index(str(offer_path), index_path)
+    monkeypatch.setattr(offer_index, "_offline_index_path", index_path)
+    monkeypatch.setattr(offer_index, "_offline_index", None)
+
+
+def test_offline_index_prices_region_without_usage_type_prefix(offline_index, monkeypatch):
+    monkeypatch.setattr(snapshot, "get_price", fail_pricing_api)
+
+    assert EBSSnapshots("test", "eu-north-1").snapshot_pricing == pytest.approx(0.0525)
+
+
+def test_cached_price_is_used_before_the_pricing_api(monkeypatch):
+    monkeypatch.setattr(snapshot, "get_offline_index", lambda: None)
+    monkeypatch.setattr(snapshot, "get_pricing_cache", lambda: FakePricingCache(price=0.045))
+    monkeypatch.setattr(snapshot, "get_price", fail_pricing_api)
+
+    assert EBSSnapshots("test", "us-east-1").snapshot_pricing == pytest.approx(0.045)
+
+
+def test_pricing_api_is_queried_by_region_code(monkeypatch):
+    requests = []
+
+    def get_price(profile, service_code, filters):
+        requests.append(filters)
+        return {"PriceList": [
+            snapshot_product("me-central-1", "MEC1-EBS:SnapshotArchiveStorage", 0.0135),
+            snapshot_product("me-central-1", "MEC1-EBS:SnapshotUsage", 0.055),
+        ]}
+
+    cache = FakePricingCache()
+    monkeypatch.setattr(snapshot, "get_offline_index", lambda: None)
+    monkeypatch.setattr(snapshot, "get_pricing_cache", lambda: cache)
+    monkeypatch.setattr(snapshot, "get_price", get_price)
+
+    assert EBSSnapshots("test", "me-central-1").snapshot_pricing == pytest.approx(0.055)
+    filters = {item["Field"]: item["Value"] for item in requests[0]}
+    assert filters["regionCode"] == "me-central-1"
+    assert filters["productFamily"] == "Storage Snapshot"
+    assert cache.saved == {("AmazonEC2", "me-central-1", "EBS:SnapshotUsage"): pytest.approx(0.055)}
+
+
+def test_pricing_api_error_falls_back_to_stale_cache(monkeypatch):
+    def get_price(profile, service_code, filters):
+        raise RuntimeError("Pricing API unavailable")
+
+    monkeypatch.setattr(snapshot, "get_offline_index", lambda: None)
+    monkeypatch.setattr(snapshot, "get_pricing_cache", lambda: FakePricingCache(stale_price=0.06))
+    monkeypatch.setattr(snapshot, "get_price", get_price)
+
+    assert EBSSnapshots("test", "eu-north-1").snapshot_pricing == pytest.approx(0.06)
+
+
+def test_missing_price_is_reported_as_none(monkeypatch):
+    monkeypatch.setattr(snapshot, "get_offline_index", lambda: None)
+    monkeypatch.setattr(snapshot, "get_pricing_cache", lambda: FakePricingCache())
+    monkeypatch.setattr(snapshot, "get_price", lambda *args: {"PriceList": []})
+
+    assert EBSSnapshots("test", "eu-north-1").snapshot_pricing is None